@@ -0,0 +1,198 @@
+'''Bench_data.py
+Microbenchmarks for the data.py storage layer.
+
+Generates a synthetic guild data tree and times the data.py functions against it, with a cold cache
+(the guild is not in data.py's cache, so it is loaded from storage) and a warm cache (it is).
+Results are printed as a table and can be written as JSON with --output, to compare runs across commits.
+
+Example:
+python benchmarks/bench_data.py --guilds 10000 --locks 50 --authenticated-users 1000000 --output results.json'''
+
+import os, sys, json, time, random, shutil, argparse, tempfile, resource, platform, subprocess, statistics
+from array import array
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+REPOSITORY_DIRECTORY = os.path.dirname(SCRIPT_DIRECTORY)
+sys.path.insert(0, REPOSITORY_DIRECTORY)
+
+import data, storage
+
+#The first snowflake-sized IDs used for generated guilds, channels and users
+FIRST_GUILD_ID = 100000000000000000
+FIRST_CHANNEL_ID = 200000000000000000
+FIRST_USER_ID = 300000000000000000
+
+def generate_lock(channel_id):
+    '''Generates lock data like data.generate_lock_data does.'''
+    return {
+        "enabled": channel_id % 10 != 0, #Every tenth lock is disabled
+        "channel_id": channel_id,
+        "password": "sha256$benchmark$" + "0" * 64,
+        "custom_message": "Welcome to the benchmark server!",
+        "award_role_ids": [channel_id + 1, channel_id + 2],
+        "sent_information_message": {
+            "id": channel_id + 3
+        },
+        "created_at": "2021-07-10 12:00:00.000000+00:00"
+    }
+
+def generate_guild(guild_number, locks_per_guild, users_per_lock):
+    '''Generates the configuration and authenticated users of a guild.'''
+    locks = [generate_lock(FIRST_CHANNEL_ID + guild_number * 1000 + lock_number) for lock_number in range(random.randint(1, locks_per_guild))]
+    configuration = {"enabled_locks": locks, "configuration_created_at": "2021-07-10 12:00:00.000000+00:00"}
+    authenticated_users = {}
+    for lock in locks:
+        user_count = random.randint(0, 2 * users_per_lock) if users_per_lock > 0 else 0
+        first_user_id = FIRST_USER_ID + random.randint(0, 10 ** 9)
+        authenticated_users[lock["channel_id"]] = range(first_user_id, first_user_id + user_count)
+    return configuration, authenticated_users
+
+def generate_json_tree(guilds_path, guild_count, locks_per_guild, users_per_lock):
+    '''Writes a data/guilds tree directly (without syncing every file, which would make generation very slow).'''
+    for guild_number in range(guild_count):
+        configuration, authenticated_users = generate_guild(guild_number, locks_per_guild, users_per_lock)
+        guild_path = os.path.join(guilds_path, str(FIRST_GUILD_ID + guild_number))
+        os.makedirs(os.path.join(guild_path, storage.AUTHENTICATED_USERS_DIRECTORY_NAME))
+        with open(os.path.join(guild_path, "config.json"), "w") as configuration_file:
+            configuration_file.write(json.dumps(configuration))
+        for channel_id, user_ids in authenticated_users.items():
+            if len(user_ids) == 0:
+                continue
+            with open(os.path.join(guild_path, storage.AUTHENTICATED_USERS_DIRECTORY_NAME, f"{channel_id}.bin"), "wb") as authenticated_users_file:
+                user_id_array = array("Q", user_ids)
+                if sys.byteorder != "little":
+                    user_id_array.byteswap()
+                authenticated_users_file.write(user_id_array.tobytes())
+
+def generate_sqlite_database(sqlite_backend, guild_count, locks_per_guild, users_per_lock):
+    '''Writes generated guilds into a SQLite database.'''
+    for guild_number in range(guild_count):
+        configuration, authenticated_users = generate_guild(guild_number, locks_per_guild, users_per_lock)
+        sqlite_backend.write_guild(str(FIRST_GUILD_ID + guild_number), configuration, authenticated_users)
+
+def get_peak_rss_kilobytes():
+    '''Returns the peak resident set size of the process, in kilobytes.'''
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss // 1024 if sys.platform == "darwin" else peak_rss #macOS reports bytes, Linux kilobytes
+
+def percentile(sorted_values, fraction):
+    '''Returns a percentile of a sorted list.'''
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def empty_cache():
+    '''Empties the guild configuration cache and the tracked channels, so that the next call reads from storage.
+    Pending journals are compacted first, so that nothing that was written is lost.'''
+    data.guild_configuration_cache.clear()
+    data.guild_configuration_cache.journal_lengths.clear()
+    data.tracked_channels.clear()
+
+def measure(name, cache, function, arguments, clear_cache):
+    '''Calls function once for every argument tuple and returns the timing results.'''
+    latencies = []
+    for argument in arguments:
+        if clear_cache:
+            empty_cache()
+        started_at = time.perf_counter_ns()
+        function(*argument)
+        latencies.append(time.perf_counter_ns() - started_at)
+    latencies.sort()
+    total_seconds = sum(latencies) / 1e9
+    return {
+        "operation": name,
+        "cache": cache,
+        "samples": len(latencies),
+        "ops_per_second": round(len(latencies) / total_seconds, 1) if total_seconds > 0 else None,
+        "mean_us": round(statistics.mean(latencies) / 1000, 2),
+        "p50_us": round(percentile(latencies, 0.5) / 1000, 2),
+        "p99_us": round(percentile(latencies, 0.99) / 1000, 2),
+        "peak_rss_kb": get_peak_rss_kilobytes()
+    }
+
+def get_git_commit():
+    '''Returns the commit the benchmark is run on, if it can be found.'''
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPOSITORY_DIRECTORY, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(arguments):
+    '''Generates the data, runs every benchmark and returns the results.'''
+    random.seed(arguments.seed)
+    users_per_lock = arguments.authenticated_users // max(1, arguments.guilds * (arguments.locks + 1) // 2)
+    working_directory = arguments.path or tempfile.mkdtemp(prefix="policebot-benchmark-")
+    print(f"Generating {arguments.guilds} guilds with up to {arguments.locks} locks and about {users_per_lock} authenticated users per lock in {working_directory}...")
+    generation_started_at = time.perf_counter()
+    if arguments.backend == "json":
+        guilds_path = os.path.join(working_directory, "guilds")
+        generate_json_tree(guilds_path, arguments.guilds, arguments.locks, users_per_lock)
+        backend = storage.JSONStorageBackend(guilds_path)
+    else:
+        backend = storage.SQLiteStorageBackend(os.path.join(working_directory, "benchmark.sqlite3"))
+        generate_sqlite_database(backend, arguments.guilds, arguments.locks, users_per_lock)
+    print(f"Generated in {time.perf_counter() - generation_started_at:.1f} seconds.")
+    storage.JOURNAL_FSYNC = not arguments.no_fsync
+    data.set_storage_backend(backend)
+    data.guild_configuration_cache.max_size = max(arguments.guilds + arguments.samples, data.guild_configuration_cache.max_size)
+
+    guild_ids = [str(FIRST_GUILD_ID + guild_number) for guild_number in random.sample(range(arguments.guilds), min(arguments.samples, arguments.guilds))]
+    lock_arguments = []
+    for guild_id in guild_ids:
+        channel_ids = list(data.get_channel_ids_with_message(guild_id))
+        lock_arguments.append((guild_id, random.choice(channel_ids)))
+    user_arguments = [(guild_id, channel_id, FIRST_USER_ID) for guild_id, channel_id in lock_arguments]
+    results = []
+    for cache, clear_cache in (("cold", True), ("warm", False)):
+        if not clear_cache: #Load every sampled guild and its sampled authenticated users once, so that the warm runs only hit the cache
+            for user_argument in user_arguments:
+                data.is_user_authenticated(*user_argument)
+        results.append(measure("get_guild_configuration", cache, data.get_guild_configuration, [(guild_id,) for guild_id in guild_ids], clear_cache))
+        results.append(measure("get_channel_ids_with_message", cache, data.get_channel_ids_with_message, [(guild_id, True) for guild_id in guild_ids], clear_cache))
+        results.append(measure("get_lock_for_channel_id", cache, data.get_lock_for_channel_id, lock_arguments, clear_cache))
+        results.append(measure("is_user_authenticated", cache, data.is_user_authenticated, user_arguments, clear_cache))
+        results.append(measure("update_guild_config", cache, lambda guild_id: data.update_guild_config(guild_id, data.get_guild_configuration(guild_id)), [(guild_id,) for guild_id in guild_ids], clear_cache))
+    new_guild_ids = [(str(FIRST_GUILD_ID + arguments.guilds + number),) for number in range(len(guild_ids))]
+    results.append(measure("create_guild_configuration", "cold", data.create_guild_configuration, new_guild_ids, False))
+    data.stop_guild_configuration_flusher()
+    if arguments.path is None and not arguments.keep:
+        shutil.rmtree(working_directory)
+    return {
+        "git_commit": get_git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {
+            "backend": arguments.backend,
+            "guilds": arguments.guilds,
+            "locks_per_guild": arguments.locks,
+            "authenticated_users": arguments.authenticated_users,
+            "samples": arguments.samples,
+            "fsync": not arguments.no_fsync,
+            "seed": arguments.seed
+        },
+        "results": results
+    }
+
+def print_results(report):
+    '''Prints the results as a table.'''
+    print(f"{'operation':<30}{'cache':<7}{'ops/s':>12}{'p50 (us)':>12}{'p99 (us)':>12}{'peak RSS (KB)':>15}")
+    for result in report["results"]:
+        print(f"{result['operation']:<30}{result['cache']:<7}{result['ops_per_second']:>12}{result['p50_us']:>12}{result['p99_us']:>12}{result['peak_rss_kb']:>15}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the data.py storage layer.")
+    parser.add_argument("--guilds", type=int, default=1000, help="number of guilds to generate (default: 1000)")
+    parser.add_argument("--locks", type=int, default=10, help="maximum number of locks per guild, between 1 and 500 (default: 10)")
+    parser.add_argument("--authenticated-users", type=int, default=100000, help="approximate total number of authenticated users (default: 100000)")
+    parser.add_argument("--samples", type=int, default=500, help="number of guilds to time every operation on (default: 500)")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json", help="storage backend to benchmark (default: json)")
+    parser.add_argument("--path", help="directory to generate the data in (default: a temporary directory that is deleted afterwards)")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary directory")
+    parser.add_argument("--no-fsync", action="store_true", help="do not fsync journal records")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: 0)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    arguments = parser.parse_args()
+    report = run_benchmarks(arguments)
+    print_results(report)
+    if arguments.output is not None:
+        with open(arguments.output, "w") as output_file:
+            json.dump(report, output_file, indent=4)
+        print(f"Results written to {arguments.output}.")
@@ -0,0 +1,412 @@
+'''Fake_discord.py
+A local stand-in for the Discord gateway and HTTP API, for running the real bot in load tests.
+
+It implements the small part of Discord that the bot uses: logging in, the gateway handshake (HELLO, IDENTIFY, READY, GUILD_CREATE
+and heartbeats), DM channels, sending, editing and deleting messages, getting and editing members, and interactions (button presses and modals,
+with their responses). Everything else returns 404.
+Rate limits are applied per route bucket like Discord does, with X-RateLimit headers and 429 responses, so that
+discord.py's rate limit handling runs exactly like it does in production.
+
+Point discord.py at it by setting discord.http.Route.BASE to FakeDiscord.api_base before the bot logs in.'''
+
+import json, time, random, asyncio, logging, itertools
+from aiohttp import web, WSMsgType
+
+#Constants
+DISCORD_EPOCH = 1420070400000
+API_PREFIX = "/api/{version}" #Any API version is accepted
+HEARTBEAT_INTERVAL = 41250 #Milliseconds
+MAJOR_PARAMETERS = ("channels", "guilds", "webhooks", "interactions") #IDs after these path segments get their own rate limit bucket
+
+#Gateway opcodes
+DISPATCH = 0
+HEARTBEAT = 1
+IDENTIFY = 2
+PRESENCE_UPDATE = 3
+RESUME = 6
+INVALID_SESSION = 9
+HELLO = 10
+HEARTBEAT_ACK = 11
+
+#Interaction types
+MESSAGE_COMPONENT = 3
+MODAL_SUBMIT = 5
+
+#Permissions
+ADMINISTRATOR_PERMISSIONS = "8"
+DEFAULT_PERMISSIONS = "104324673"
+
+#Logging
+logger = logging.getLogger(__name__)
+
+def get_bucket_key(method, path):
+    '''Returns the rate limit bucket of a request: the method and the path with every ID replaced, except major parameters.'''
+    segments = path.split("/")
+    for index, segment in enumerate(segments):
+        if segment.isdigit() and (index == 0 or segments[index - 1] not in MAJOR_PARAMETERS):
+            segments[index] = "{id}"
+    return f"{method} {'/'.join(segments)}"
+
+def json_response(payload, status=200, headers=None):
+    '''Returns a JSON response. discord.py only decodes JSON if the content type is exactly application/json, without a charset.'''
+    return web.Response(body=json.dumps(payload).encode("utf-8"), status=status, headers={"Content-Type": "application/json", **(headers or {})})
+
+def get_shard_id(guild_id, shard_count):
+    '''Returns the shard that a guild belongs to.'''
+    return (int(guild_id) >> 22) % shard_count
+
+class RateLimiter:
+    '''Fixed window rate limits per bucket, and optionally a global limit.
+    limit requests are allowed per window seconds in every bucket, and global_limit requests per second in total.
+    random_429_probability adds rate limit responses at random, like the ones that Discord sometimes sends without warning.'''
+    def __init__(self, limit=None, window=1.0, global_limit=None, random_429_probability=0):
+        self.limit = limit
+        self.window = window
+        self.global_limit = global_limit
+        self.random_429_probability = random_429_probability
+        self.buckets = {} #Bucket key --> [remaining requests, time the window resets]
+        self.global_bucket = [global_limit, 0]
+        self.rate_limited_requests = 0
+
+    def take(self, bucket, limit, window, now):
+        '''Takes a request from a bucket. Returns the seconds until the bucket resets, and the remaining requests (-1 if none were left).'''
+        if now >= bucket[1]:
+            bucket[0], bucket[1] = limit, now + window
+        bucket[0] -= 1
+        return bucket[1] - now, bucket[0]
+
+    def check(self, bucket_key):
+        '''Checks a request. Returns (headers, 429 response body or None).'''
+        now = time.time()
+        if self.global_limit is not None:
+            reset_after, remaining = self.take(self.global_bucket, self.global_limit, 1.0, now)
+            if remaining < 0:
+                self.rate_limited_requests += 1
+                return {"X-RateLimit-Global": "true", "Retry-After": str(reset_after)}, {"message": "You are being rate limited.", "retry_after": reset_after * 1000, "global": True}
+        if self.limit is None:
+            return {}, None
+        bucket = self.buckets.setdefault(bucket_key, [self.limit, 0])
+        reset_after, remaining = self.take(bucket, self.limit, self.window, now)
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Remaining": str(max(remaining, 0)),
+            "X-RateLimit-Reset": str(now + reset_after),
+            "X-RateLimit-Reset-After": str(reset_after),
+            "X-RateLimit-Bucket": str(abs(hash(bucket_key)))
+        }
+        if remaining < 0 or random.random() < self.random_429_probability:
+            self.rate_limited_requests += 1
+            return headers, {"message": "You are being rate limited.", "retry_after": reset_after * 1000, "global": False}
+        return headers, None
+
+class GatewayConnection:
+    '''A bot connected to the fake gateway.'''
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.sequence = itertools.count(1)
+        self.shard_id = 0
+        self.shard_count = 1
+        self.identified = False
+
+    def owns_guild(self, guild_id):
+        return self.identified and get_shard_id(guild_id, self.shard_count) == self.shard_id
+
+    async def send(self, op, data, event_name=None):
+        payload = {"op": op, "d": data}
+        if op == DISPATCH:
+            payload["t"] = event_name
+            payload["s"] = next(self.sequence)
+        await self.websocket.send_str(json.dumps(payload))
+
+class FakeDiscord:
+    '''The fake Discord server. Guilds and users are added with add_guild and add_user before the bot connects.
+    Messages that the bot sends are passed to the callbacks in message_listeners as (channel ID, message payload),
+    and every API request is passed to the callbacks in request_listeners as (method, bucket key, status, seconds).
+    Responses to interactions are passed to the callbacks in interaction_listeners as (interaction ID, response payload),
+    where edits of the original response have the type "edit".'''
+    def __init__(self, host="127.0.0.1", port=0, rate_limiter=None, latency=0):
+        self.host = host
+        self.port = port
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.latency = latency #Seconds added to every API request
+        self.increment = itertools.count()
+        self.bot_user = self.make_user(self.generate_snowflake(), "PolicemanBot", bot=True)
+        self.guilds = {} #Guild ID --> guild payload
+        self.users = {} #User ID --> user payload
+        self.dm_channel_ids = {} #User ID --> DM channel ID
+        self.dm_channel_users = {} #DM channel ID --> user ID
+        self.connections = []
+        self.message_listeners = []
+        self.request_listeners = []
+        self.interaction_listeners = []
+        self.interaction_ids = {} #Interaction token --> interaction ID
+        self.request_counts = {} #Bucket key --> number of requests
+        self.runner = None
+        self.api_base = None
+
+    #Payloads
+    def generate_snowflake(self):
+        '''Generates an ID with the current time in it, like Discord's IDs.'''
+        return ((int(time.time() * 1000) - DISCORD_EPOCH) << 22) | (next(self.increment) % 4096)
+
+    def make_user(self, user_id, username, bot=False):
+        return {"id": str(user_id), "username": username, "discriminator": f"{user_id % 10000:04}", "avatar": None, "bot": bot}
+
+    def make_role(self, role_id, name, permissions, position):
+        #API v7 clients read permissions_new, newer ones permissions
+        return {"id": str(role_id), "name": name, "permissions": permissions, "permissions_new": permissions, "position": position, "color": 0}
+
+    def make_message(self, channel_id, author, content, guild_id=None, member=None, mention_role_ids=(), embeds=()):
+        message = {
+            "id": str(self.generate_snowflake()),
+            "channel_id": str(channel_id),
+            "author": author,
+            "content": content,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime()),
+            "edited_timestamp": None,
+            "tts": False,
+            "mention_everyone": False,
+            "mentions": [],
+            "mention_roles": [str(role_id) for role_id in mention_role_ids],
+            "attachments": [],
+            "embeds": list(embeds),
+            "pinned": False,
+            "type": 0
+        }
+        if guild_id is not None:
+            message["guild_id"] = str(guild_id)
+            message["member"] = member or {"roles": [], "joined_at": message["timestamp"], "deaf": False, "mute": False}
+        return message
+
+    def add_user(self, user_id, username=None):
+        self.users[user_id] = self.make_user(user_id, username or f"user{user_id}")
+        return self.users[user_id]
+
+    def add_guild(self, guild_id, channel_ids, role_ids=(), admin_role_id=None, name=None):
+        '''Adds a guild with text channels and roles. Members with the admin role are administrators.'''
+        roles = [self.make_role(guild_id, "@everyone", DEFAULT_PERMISSIONS, 0)]
+        roles.extend(self.make_role(role_id, f"role{role_id}", "0", position + 1) for position, role_id in enumerate(role_ids))
+        if admin_role_id is not None:
+            roles.append(self.make_role(admin_role_id, "admin", ADMINISTRATOR_PERMISSIONS, len(roles)))
+        self.guilds[guild_id] = {
+            "id": str(guild_id),
+            "name": name or f"Guild {guild_id}",
+            "owner_id": str(self.bot_user["id"]),
+            "roles": roles,
+            "channels": [{"id": str(channel_id), "type": 0, "name": f"channel{channel_id}", "position": position, "permission_overwrites": []} for position, channel_id in enumerate(channel_ids)],
+            "members": [],
+            "member_count": 0,
+            "large": False,
+            "unavailable": False
+        }
+        return self.guilds[guild_id]
+
+    #Gateway
+    async def dispatch(self, event_name, data, guild_id=None):
+        '''Sends an event to the connection that owns the guild, or to shard 0 for events without a guild.'''
+        for connection in self.connections:
+            if connection.owns_guild(guild_id if guild_id is not None else 0):
+                await connection.send(DISPATCH, data, event_name)
+                return
+        logger.warning("No connection owns the guild %s. Dropping %s event...", guild_id, event_name)
+
+    async def send_guild_message(self, guild_id, channel_id, user_id, content, role_ids=(), mention_role_ids=()):
+        '''Sends a MESSAGE_CREATE event for a user writing in a guild channel. Returns the message payload.'''
+        member = {"roles": [str(role_id) for role_id in role_ids], "joined_at": "2021-07-10T12:00:00+00:00", "deaf": False, "mute": False}
+        message = self.make_message(channel_id, self.users[user_id], content, guild_id, member, mention_role_ids)
+        await self.dispatch("MESSAGE_CREATE", message, guild_id)
+        return message
+
+    async def send_direct_message(self, user_id, content):
+        '''Sends a MESSAGE_CREATE event for a user writing to the bot in DMs. Returns the message payload.'''
+        channel_id = self.get_dm_channel_id(user_id)
+        message = self.make_message(channel_id, self.users[user_id], content)
+        await self.dispatch("MESSAGE_CREATE", message)
+        return message
+
+    async def send_interaction(self, guild_id, channel_id, user_id, interaction_type, data, role_ids=(), interaction_id=None):
+        '''Sends an INTERACTION_CREATE event for a user pressing a button or submitting a modal. Returns the interaction ID.
+        Pass interaction_id to listen for responses before the event is sent.'''
+        interaction_id = interaction_id or self.generate_snowflake()
+        token = f"token{interaction_id}"
+        self.interaction_ids[token] = interaction_id
+        await self.dispatch("INTERACTION_CREATE", {
+            "id": str(interaction_id),
+            "application_id": self.bot_user["id"],
+            "type": interaction_type,
+            "data": data,
+            "guild_id": str(guild_id),
+            "channel_id": str(channel_id),
+            "member": {"user": self.users[user_id], "roles": [str(role_id) for role_id in role_ids], "joined_at": "2021-07-10T12:00:00+00:00", "deaf": False, "mute": False, "permissions": "0"},
+            "token": token,
+            "version": 1
+        }, guild_id)
+        return interaction_id
+
+    def get_dm_channel_id(self, user_id):
+        channel_id = self.dm_channel_ids.get(user_id)
+        if channel_id is None:
+            channel_id = self.dm_channel_ids[user_id] = self.generate_snowflake()
+            self.dm_channel_users[channel_id] = user_id
+        return channel_id
+
+    async def handle_gateway(self, request):
+        '''Handles a gateway connection.'''
+        websocket = web.WebSocketResponse(max_msg_size=0)
+        await websocket.prepare(request)
+        connection = GatewayConnection(websocket)
+        self.connections.append(connection)
+        await connection.send(HELLO, {"heartbeat_interval": HEARTBEAT_INTERVAL})
+        try:
+            async for message in websocket:
+                if message.type != WSMsgType.TEXT:
+                    continue
+                payload = json.loads(message.data)
+                op = payload["op"]
+                if op == HEARTBEAT:
+                    await connection.send(HEARTBEAT_ACK, None)
+                elif op == IDENTIFY:
+                    await self.identify(connection, payload["d"])
+                elif op == RESUME:
+                    await connection.send(INVALID_SESSION, False)
+        finally:
+            self.connections.remove(connection)
+        return websocket
+
+    async def identify(self, connection, data):
+        '''Answers an IDENTIFY with READY, then sends the guilds of the connection's shard.'''
+        connection.shard_id, connection.shard_count = data.get("shard", [0, 1])
+        connection.identified = True
+        guilds = [guild for guild_id, guild in self.guilds.items() if connection.owns_guild(guild_id)]
+        logger.info("Shard %s/%s identified. Sending %s guilds...", connection.shard_id, connection.shard_count, len(guilds))
+        await connection.send(DISPATCH, {
+            "v": 7,
+            "user": self.bot_user,
+            "guilds": [{"id": guild["id"], "unavailable": True} for guild in guilds],
+            "session_id": f"fake-session-{connection.shard_id}",
+            "shard": [connection.shard_id, connection.shard_count],
+            "private_channels": [],
+            "relationships": [],
+            "application": {"id": self.bot_user["id"], "flags": 0}
+        }, "READY")
+        for guild in guilds:
+            await connection.send(DISPATCH, guild, "GUILD_CREATE")
+
+    #HTTP API
+    @web.middleware
+    async def api_middleware(self, request, handler):
+        '''Applies the rate limits and the latency to API requests, and reports them to the request listeners.'''
+        if request.path.startswith("/gateway/ws"):
+            return await handler(request)
+        started_at = time.perf_counter()
+        path = request.path.split("/", 3)[-1] #Without /api/v7
+        bucket_key = get_bucket_key(request.method, "/" + path)
+        self.request_counts[bucket_key] = self.request_counts.get(bucket_key, 0) + 1
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        headers, rate_limit_body = self.rate_limiter.check(bucket_key)
+        if rate_limit_body is not None:
+            headers["Via"] = "1.1 google" #discord.py treats 429s without it as Cloudflare bans
+            response = json_response(rate_limit_body, status=429, headers=headers)
+        else:
+            try:
+                response = await handler(request)
+            except web.HTTPNotFound:
+                response = json_response({"message": "404: Not Found", "code": 0}, status=404)
+            response.headers.update(headers)
+        for listener in self.request_listeners:
+            listener(request.method, bucket_key, response.status, time.perf_counter() - started_at)
+        return response
+
+    async def get_current_user(self, request):
+        return json_response(self.bot_user)
+
+    async def get_gateway(self, request):
+        return json_response({"url": f"ws://{self.host}:{self.port}/gateway/ws", "shards": 1, "session_start_limit": {"total": 1000, "remaining": 1000, "reset_after": 0, "max_concurrency": 1}})
+
+    async def create_dm(self, request):
+        user_id = int((await request.json())["recipient_id"])
+        if user_id not in self.users:
+            self.add_user(user_id)
+        return json_response({"id": str(self.get_dm_channel_id(user_id)), "type": 1, "last_message_id": None, "recipients": [self.users[user_id]]})
+
+    async def create_message(self, request):
+        channel_id = int(request.match_info["channel_id"])
+        body = await request.json()
+        embeds = body.get("embeds") or ([body["embed"]] if body.get("embed") else [])
+        message = self.make_message(channel_id, self.bot_user, body.get("content") or "", embeds=embeds)
+        for listener in self.message_listeners:
+            listener(channel_id, message)
+        return json_response(message)
+
+    async def create_interaction_response(self, request):
+        interaction_id = int(request.match_info["interaction_id"])
+        response = await request.json()
+        for listener in self.interaction_listeners:
+            listener(interaction_id, response)
+        return web.Response(status=204)
+
+    async def edit_interaction_response(self, request):
+        interaction_id = self.interaction_ids[request.match_info["token"]]
+        body = await request.json()
+        for listener in self.interaction_listeners:
+            listener(interaction_id, {"type": "edit", "data": body})
+        return json_response(self.make_message(0, self.bot_user, body.get("content") or "", embeds=body.get("embeds") or ()))
+
+    async def edit_message(self, request):
+        channel_id = int(request.match_info["channel_id"])
+        body = await request.json()
+        embeds = body.get("embeds") or ([body["embed"]] if body.get("embed") else [])
+        message = self.make_message(channel_id, self.bot_user, body.get("content") or "", embeds=embeds)
+        message["id"] = request.match_info["message_id"]
+        for listener in self.message_listeners:
+            listener(channel_id, message)
+        return json_response(message)
+
+    async def delete_message(self, request):
+        return web.Response(status=204)
+
+    async def get_member(self, request):
+        user_id = int(request.match_info["member_id"])
+        if user_id not in self.users:
+            return json_response({"message": "Unknown Member", "code": 10007}, status=404)
+        return json_response({"user": self.users[user_id], "roles": [], "joined_at": "2021-07-10T12:00:00+00:00", "deaf": False, "mute": False})
+
+    async def edit_member(self, request):
+        return web.Response(status=204)
+
+    async def edit_member_role(self, request):
+        return web.Response(status=204)
+
+    def create_app(self):
+        app = web.Application(middlewares=[self.api_middleware])
+        app.router.add_get("/gateway/ws", self.handle_gateway)
+        app.router.add_get(API_PREFIX + "/users/@me", self.get_current_user)
+        app.router.add_get(API_PREFIX + "/gateway", self.get_gateway)
+        app.router.add_get(API_PREFIX + "/gateway/bot", self.get_gateway)
+        app.router.add_post(API_PREFIX + "/users/@me/channels", self.create_dm)
+        app.router.add_post(API_PREFIX + "/channels/{channel_id}/messages", self.create_message)
+        app.router.add_patch(API_PREFIX + "/channels/{channel_id}/messages/{message_id}", self.edit_message)
+        app.router.add_delete(API_PREFIX + "/channels/{channel_id}/messages/{message_id}", self.delete_message)
+        app.router.add_get(API_PREFIX + "/guilds/{guild_id}/members/{member_id}", self.get_member)
+        app.router.add_patch(API_PREFIX + "/guilds/{guild_id}/members/{member_id}", self.edit_member)
+        app.router.add_put(API_PREFIX + "/guilds/{guild_id}/members/{member_id}/roles/{role_id}", self.edit_member_role)
+        app.router.add_delete(API_PREFIX + "/guilds/{guild_id}/members/{member_id}/roles/{role_id}", self.edit_member_role)
+        app.router.add_post(API_PREFIX + "/interactions/{interaction_id}/{token}/callback", self.create_interaction_response)
+        app.router.add_patch(API_PREFIX + "/webhooks/{application_id}/{token}/messages/@original", self.edit_interaction_response)
+        return app
+
+    async def start(self):
+        '''Starts the server. Afterwards, api_base is the URL to use as discord.http.Route.BASE.'''
+        self.runner = web.AppRunner(self.create_app(), access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1] #The real port, if port 0 was passed
+        self.api_base = f"http://{self.host}:{self.port}/api/v7"
+        logger.info("Fake Discord listening on %s...", self.api_base)
+
+    async def stop(self):
+        for connection in list(self.connections):
+            await connection.websocket.close()
+        await self.runner.cleanup()
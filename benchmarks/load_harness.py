@@ -0,0 +1,455 @@
+'''Load_harness.py
+End-to-end load test that runs the real bot from main.py against a local fake Discord (see fake_discord.py).
+
+Simulated users call ?a in a locked channel and answer the DM with the right or a wrong password (or press the Unlock
+button and enter the password in the modal, see --button-fraction), while simulated admins create locks with ?al and remove them again with ?rl.
+The fake Discord and the simulated users run in a child process, so that they don't share the bot's event loop and CPU time.
+Every run is done at one or more concurrency levels (flows in progress at the same time), and reports:
+* throughput and end-to-end flow latency
+* a latency breakdown per stage: deleting the ?a message, opening the DM channel, sending DMs and channel messages,
+  responding to interactions, waiting for replies, hashing, adding roles and writing the configuration
+* the bot's event loop lag
+* how many API requests the fake Discord received and rate limited
+
+Example:
+python benchmarks/load_harness.py --guilds 100 --flows 2000 --concurrency 50,200,1000 --rate-limit 50 --output results.json'''
+
+import os, sys, json, time, types, random, asyncio, logging, argparse, tempfile, resource, shutil, multiprocessing
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+REPOSITORY_DIRECTORY = os.path.dirname(SCRIPT_DIRECTORY)
+sys.path.insert(0, REPOSITORY_DIRECTORY)
+#main.py reads these when it is imported
+os.environ.setdefault("POLICEBOT_BOT_TOKEN", "load-harness-token")
+os.environ.setdefault("POLICEBOT_METRICS_PORT", "0")
+os.environ.setdefault("POLICEBOT_LOG_LEVEL", "WARNING")
+#The harness measures how much load the bot can take, so the authentication limits of ratelimit.py are off unless they are set
+os.environ.setdefault("POLICEBOT_LOCK_ATTEMPTS_PER_MINUTE", "0")
+os.environ.setdefault("POLICEBOT_GUILD_ATTEMPTS_PER_MINUTE", "0")
+os.environ.setdefault("POLICEBOT_GUILD_PENDING_LIMIT", "0")
+
+import discord.http
+from werkzeug.security import generate_password_hash
+import main, data, data_async, storage, hashing, dispatcher, interactions
+from fake_discord import FakeDiscord, RateLimiter
+
+#Constants
+PASSWORD = "correct horse battery staple"
+WRONG_PASSWORD = "hunter2"
+LOOP_LAG_INTERVAL = 0.05 #Seconds between event loop lag samples
+DRAIN_SECONDS = 1 #Seconds to let commands send their last messages before the bot is stopped
+
+#Logging
+logger = logging.getLogger("load_harness")
+
+def summarize(values):
+    '''Returns count, mean, p50, p95, p99 and max of a list of seconds, in milliseconds.'''
+    if len(values) == 0:
+        return {"count": 0}
+    values = sorted(values)
+    def percentile(fraction):
+        return round(values[min(len(values) - 1, int(len(values) * fraction))] * 1000, 3)
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 3),
+        "p50_ms": percentile(0.5),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "max_ms": round(values[-1] * 1000, 3)
+    }
+
+#The simulated world (child process)
+class SimulatedGuild:
+    '''A guild in the fake Discord with one lock, and spare channels that admins create and remove locks in.'''
+    def __init__(self, fake_discord, spare_channel_count):
+        self.id = fake_discord.generate_snowflake()
+        self.lock_channel_id = fake_discord.generate_snowflake()
+        self.award_role_id = fake_discord.generate_snowflake()
+        self.admin_role_id = fake_discord.generate_snowflake()
+        self.spare_channel_ids = asyncio.Queue()
+        channel_ids = [self.lock_channel_id]
+        for _ in range(spare_channel_count):
+            channel_id = fake_discord.generate_snowflake()
+            channel_ids.append(channel_id)
+            self.spare_channel_ids.put_nowait(channel_id)
+        fake_discord.add_guild(self.id, channel_ids, [self.award_role_id], self.admin_role_id)
+
+class SimulatedWorld:
+    '''The fake Discord and the users and admins that use the bot through it.'''
+    def __init__(self, arguments):
+        self.arguments = arguments
+        self.fake_discord = FakeDiscord(rate_limiter=RateLimiter(arguments.rate_limit, arguments.rate_limit_window, arguments.global_rate_limit, arguments.random_429_probability), latency=arguments.api_latency)
+        self.fake_discord.message_listeners.append(self.on_bot_message)
+        self.fake_discord.request_listeners.append(self.on_request)
+        self.fake_discord.interaction_listeners.append(self.on_interaction_response)
+        self.guilds = []
+        self.user_ids = iter(range(10 ** 17, 10 ** 18))
+        self.inboxes = {} #DM channel or guild channel ID --> queue of messages that the bot sent there
+        self.interaction_inboxes = {} #Interaction ID --> queue of the bot's responses to it
+        self.api_requests = 0
+        self.api_rate_limited = 0
+
+    def on_bot_message(self, channel_id, message):
+        inbox = self.inboxes.get(channel_id)
+        if inbox is not None:
+            inbox.put_nowait(message)
+
+    def on_interaction_response(self, interaction_id, response):
+        inbox = self.interaction_inboxes.get(interaction_id)
+        if inbox is not None:
+            inbox.put_nowait(response)
+
+    def on_request(self, method, bucket_key, status, seconds):
+        self.api_requests += 1
+        if status == 429:
+            self.api_rate_limited += 1
+
+    def get_inbox(self, channel_id):
+        return self.inboxes.setdefault(channel_id, asyncio.Queue())
+
+    async def wait_for_message(self, inbox, title_prefixes):
+        '''Waits until the bot sends a message with an embed title that starts with one of the prefixes. Returns the title.'''
+        while True:
+            message = await inbox.get()
+            title = message["embeds"][0].get("title", "") if message["embeds"] else ""
+            if title.startswith(title_prefixes):
+                return title
+
+    def new_user(self):
+        user_id = next(self.user_ids)
+        self.fake_discord.add_user(user_id)
+        return user_id
+
+    async def authenticate_flow(self, progress):
+        '''A user calls ?a and answers the DM. Returns the outcome. progress["step"] is what the flow is waiting for.'''
+        guild = random.choice(self.guilds)
+        user_id = self.new_user()
+        dm_channel_id = self.fake_discord.get_dm_channel_id(user_id)
+        inbox = self.get_inbox(dm_channel_id)
+        try:
+            progress["step"] = "password_request"
+            await self.fake_discord.send_guild_message(guild.id, guild.lock_channel_id, user_id, "?a")
+            await self.wait_for_message(inbox, ("🔒",))
+            if self.arguments.think_time > 0:
+                await asyncio.sleep(random.uniform(0, 2 * self.arguments.think_time))
+            password_is_wrong = random.random() < self.arguments.wrong_password_fraction
+            progress["step"] = "result"
+            await self.fake_discord.send_direct_message(user_id, WRONG_PASSWORD if password_is_wrong else PASSWORD)
+            title = await self.wait_for_message(inbox, ("✅", "✋", "I'm swamped"))
+        finally:
+            del self.inboxes[dm_channel_id]
+        return "success" if title.startswith("✅") else "wrong_password" if title.startswith("✋") else "busy"
+
+    async def send_interaction(self, guild, user_id, interaction_type, data):
+        '''Sends an interaction from a user in the guild's locked channel, and returns the bot's final response to it.
+        A deferred response is skipped, and the edit that follows it is returned instead.'''
+        interaction_id = self.fake_discord.generate_snowflake()
+        inbox = self.interaction_inboxes[interaction_id] = asyncio.Queue()
+        try:
+            await self.fake_discord.send_interaction(guild.id, guild.lock_channel_id, user_id, interaction_type, data, interaction_id=interaction_id)
+            while True:
+                response = await inbox.get()
+                if response["type"] != interactions.DEFERRED_CHANNEL_MESSAGE_WITH_SOURCE:
+                    return response
+        finally:
+            del self.interaction_inboxes[interaction_id]
+
+    async def button_flow(self, progress):
+        '''A user presses the Unlock button and submits the password modal. Returns the outcome.'''
+        guild = random.choice(self.guilds)
+        user_id = self.new_user()
+        progress["step"] = "password_modal"
+        response = await self.send_interaction(guild, user_id, interactions.MESSAGE_COMPONENT, {"custom_id": interactions.UNLOCK_BUTTON_ID, "component_type": interactions.BUTTON})
+        if response["type"] != interactions.MODAL:
+            return "no_modal"
+        if self.arguments.think_time > 0:
+            await asyncio.sleep(random.uniform(0, 2 * self.arguments.think_time))
+        password_is_wrong = random.random() < self.arguments.wrong_password_fraction
+        progress["step"] = "result"
+        modal_data = {"custom_id": interactions.PASSWORD_MODAL_ID, "components": [{"type": interactions.ACTION_ROW, "components": [
+            {"type": interactions.TEXT_INPUT, "custom_id": interactions.PASSWORD_INPUT_ID, "value": WRONG_PASSWORD if password_is_wrong else PASSWORD}
+        ]}]}
+        response = await self.send_interaction(guild, user_id, interactions.MODAL_SUBMIT, modal_data)
+        title = response["data"]["embeds"][0].get("title", "")
+        return "success" if title.startswith("✅") else "wrong_password" if title.startswith("✋") else "busy" if title.startswith("I'm swamped") else "cooldown"
+
+    async def admin_flow(self, progress):
+        '''An admin creates a lock in a spare channel with ?al, then removes it with ?rl. Returns the outcome.'''
+        guild = random.choice(self.guilds)
+        progress["step"] = "spare_channel"
+        channel_id = await guild.spare_channel_ids.get()
+        inbox = self.get_inbox(channel_id)
+        try:
+            admin_id = self.new_user()
+            admin_role_ids = [guild.admin_role_id]
+            answers = {
+                "Step 1": dict(content=PASSWORD),
+                "Step 2": dict(content=f"<@&{guild.award_role_id}>", mention_role_ids=[guild.award_role_id]),
+                "Step 3": dict(content=f"<#{channel_id}>"),
+                "Step 4": dict(content="nomessagepls"),
+                "Step 5": dict(content="forever")
+            }
+            await self.fake_discord.send_guild_message(guild.id, channel_id, admin_id, "?al", admin_role_ids)
+            for step in ("Step 1", "Step 2", "Step 3", "Step 4", "Step 5"):
+                progress["step"] = step.lower().replace(" ", "_")
+                await self.wait_for_message(inbox, (step,))
+                await self.fake_discord.send_guild_message(guild.id, channel_id, admin_id, role_ids=admin_role_ids, **answers[step])
+            progress["step"] = "lock_created"
+            await self.wait_for_message(inbox, ("✅ Message created!",))
+            progress["step"] = "lock_removed"
+            await self.fake_discord.send_guild_message(guild.id, channel_id, admin_id, "?rl", admin_role_ids)
+            await self.wait_for_message(inbox, ("✅ Lock removed",))
+            return "lock_added_and_removed"
+        finally:
+            del self.inboxes[channel_id]
+            guild.spare_channel_ids.put_nowait(channel_id)
+
+    async def run_flow(self, flow_latencies, outcomes):
+        '''Runs one user or admin flow and records its latency and outcome.'''
+        if random.random() < self.arguments.admin_fraction:
+            kind, flow = "admin", self.admin_flow
+        elif random.random() < self.arguments.button_fraction:
+            kind, flow = "button", self.button_flow
+        else:
+            kind, flow = "authenticate", self.authenticate_flow
+        progress = {"step": None}
+        started_at = time.perf_counter()
+        try:
+            outcome = await asyncio.wait_for(flow(progress), self.arguments.flow_timeout)
+            flow_latencies.setdefault(kind, []).append(time.perf_counter() - started_at)
+        except asyncio.TimeoutError:
+            outcome = f"timeout waiting for {progress['step']}"
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    async def run_level(self, concurrency):
+        '''Runs the configured number of flows, with at most concurrency flows in progress at once.'''
+        self.api_requests = self.api_rate_limited = 0
+        flow_latencies = {}
+        outcomes = {}
+        semaphore = asyncio.Semaphore(concurrency)
+        async def run_limited_flow():
+            async with semaphore:
+                await self.run_flow(flow_latencies, outcomes)
+        started_at = time.perf_counter()
+        await asyncio.gather(*[run_limited_flow() for _ in range(self.arguments.flows)])
+        duration = time.perf_counter() - started_at
+        completed_flows = sum(count for outcome, count in outcomes.items() if not outcome.startswith("timeout"))
+        return {
+            "concurrency": concurrency,
+            "flows": self.arguments.flows,
+            "duration_seconds": round(duration, 3),
+            "throughput_flows_per_second": round(completed_flows / duration, 2),
+            "outcomes": outcomes,
+            "flow_latency": {kind: summarize(latencies) for kind, latencies in flow_latencies.items()},
+            "api_requests": self.api_requests,
+            "api_rate_limited": self.api_rate_limited
+        }
+
+    async def serve(self, connection):
+        '''Starts the fake Discord, sends its address and guilds to the bot process, then runs the levels that the bot process asks for.'''
+        loop = asyncio.get_event_loop()
+        await self.fake_discord.start()
+        for _ in range(self.arguments.guilds):
+            self.guilds.append(SimulatedGuild(self.fake_discord, self.arguments.spare_channels))
+        connection.send({
+            "api_base": self.fake_discord.api_base,
+            "guilds": [(guild.id, guild.lock_channel_id, guild.award_role_id) for guild in self.guilds]
+        })
+        while True:
+            command, argument = await loop.run_in_executor(None, connection.recv)
+            if command != "run":
+                break
+            connection.send(await self.run_level(argument))
+        await self.fake_discord.stop()
+
+def run_world(arguments, connection):
+    '''Entry point of the child process.'''
+    logging.basicConfig(level=logging.WARNING, force=True) #The log queue listener of the bot process does not run in this process
+    random.seed(arguments.seed)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(SimulatedWorld(arguments).serve(connection))
+
+#The bot (this process)
+class StageRecorder:
+    '''Records how long each stage of the bot's flows takes, by wrapping the functions that the bot calls for them.'''
+    def __init__(self):
+        self.stages = {}
+        self.dm_channel_ids = set()
+
+    def record(self, stage, seconds):
+        self.stages.setdefault(stage, []).append(seconds)
+
+    def reset(self):
+        self.stages = {}
+
+    def wrap_async(self, stage, function):
+        async def timed(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - started_at)
+        return timed
+
+    def wrap(self, stage, function):
+        def timed(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - started_at)
+        return timed
+
+    def get_http_stage(self, route):
+        '''Returns the stage that a Discord API request belongs to.'''
+        if route.method == "DELETE" and route.path == "/channels/{channel_id}/messages/{message_id}":
+            return "delete_message"
+        if route.method == "POST" and route.path == "/users/@me/channels":
+            return "dm_open"
+        if route.method == "POST" and route.path == "/channels/{channel_id}/messages":
+            return "dm_send" if route.channel_id in self.dm_channel_ids else "channel_send"
+        if route.method == "PATCH" and route.path.startswith("/guilds/{guild_id}/members/"):
+            return "add_roles"
+        if route.path.startswith(("/interactions/", "/webhooks/")):
+            return "interaction_response"
+        return f"http {route.method} {route.path}"
+
+    def install(self, bot):
+        '''Wraps the bot's API client and the functions in main.py for every stage.'''
+        request = bot.http.request
+        async def timed_request(route, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                result = await request(route, **kwargs)
+                if route.path == "/users/@me/channels":
+                    self.dm_channel_ids.add(int(result["id"]))
+                return result
+            finally:
+                self.record(self.get_http_stage(route), time.perf_counter() - started_at)
+        bot.http.request = timed_request
+        dispatcher.ReplySession.wait = self.wrap_async("wait", dispatcher.ReplySession.wait)
+        hashing.hash_executor.check_password = self.wrap_async("hash", hashing.hash_executor.check_password)
+        hashing.hash_executor.generate_password_hash = self.wrap_async("hash", hashing.hash_executor.generate_password_hash)
+        for function_name in ("add_authenticated_user", "add_guild_lock", "remove_guild_lock"):
+            setattr(data_async, function_name, self.wrap_async("config_write", getattr(data_async, function_name)))
+
+class LoopLagMonitor:
+    '''Measures how late the event loop wakes up a task that sleeps for a fixed interval.'''
+    def __init__(self, interval=LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.lags = []
+        self.task = None
+
+    async def run(self):
+        while True:
+            started_at = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0, time.perf_counter() - started_at - self.interval))
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        self.task.cancel()
+
+class LoadHarness:
+    '''Runs the bot in this process against the simulated world in a child process.'''
+    def __init__(self, arguments):
+        self.arguments = arguments
+        self.stage_recorder = StageRecorder()
+        self.connection = None
+        self.world_process = None
+
+    def start_world(self):
+        '''Starts the child process. Called before the event loop runs, so that the child doesn't inherit a running loop.'''
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.world_process = multiprocessing.Process(target=run_world, args=(self.arguments, child_connection), daemon=True)
+        self.world_process.start()
+
+    async def receive(self):
+        return await asyncio.get_event_loop().run_in_executor(None, self.connection.recv)
+
+    def seed_guilds(self, guilds):
+        '''Creates a lock for every simulated guild in the bot's storage.'''
+        password_hash = generate_password_hash(PASSWORD, hashing.PASSWORD_HASH_METHOD)
+        for guild_id, lock_channel_id, award_role_id in guilds:
+            data.create_guild_configuration(str(guild_id))
+            lock_message = types.SimpleNamespace(id=lock_channel_id + 1)
+            data.add_guild_lock(str(guild_id), data.generate_lock_data(lock_channel_id, password_hash, "Load test", [award_role_id], lock_message))
+
+    async def run_level(self, concurrency):
+        logger.warning("Running %s flows at concurrency %s...", self.arguments.flows, concurrency)
+        self.stage_recorder.reset()
+        loop_lag_monitor = LoopLagMonitor()
+        loop_lag_monitor.start()
+        self.connection.send(("run", concurrency))
+        result = await self.receive()
+        loop_lag_monitor.stop()
+        result["stages"] = {stage: summarize(latencies) for stage, latencies in sorted(self.stage_recorder.stages.items())}
+        result["event_loop_lag"] = summarize(loop_lag_monitor.lags)
+        result["bot_peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return result
+
+    async def run(self):
+        world = await self.receive()
+        discord.http.Route.BASE = interactions.InteractionRoute.BASE = world["api_base"]
+        self.seed_guilds(world["guilds"])
+        self.stage_recorder.install(main.bot)
+        bot_task = asyncio.ensure_future(main.bot.start(main.BOT_TOKEN))
+        results = []
+        try:
+            await asyncio.wait_for(main.bot.wait_until_ready(), 60)
+            for concurrency in self.arguments.concurrency:
+                results.append(await self.run_level(concurrency))
+            await asyncio.sleep(DRAIN_SECONDS)
+        finally:
+            self.connection.send(("stop", None))
+            await main.bot.close()
+            await asyncio.gather(bot_task, return_exceptions=True)
+            self.world_process.join(10)
+        return results
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="End-to-end load test of the bot against a local fake Discord.")
+    parser.add_argument("--guilds", type=int, default=50, help="number of guilds with a lock (default: 50)")
+    parser.add_argument("--flows", type=int, default=1000, help="number of flows to run at every concurrency level (default: 1000)")
+    parser.add_argument("--concurrency", type=lambda value: [int(level) for level in value.split(",")], default=[100], help="comma separated concurrency levels (default: 100)")
+    parser.add_argument("--wrong-password-fraction", type=float, default=0.2, help="fraction of users that enter a wrong password (default: 0.2)")
+    parser.add_argument("--button-fraction", type=float, default=0, help="fraction of users that unlock with the Unlock button instead of ?a (default: 0)")
+    parser.add_argument("--admin-fraction", type=float, default=0.02, help="fraction of flows that are admins adding and removing a lock (default: 0.02)")
+    parser.add_argument("--spare-channels", type=int, default=3, help="channels per guild that admins can create locks in (default: 3)")
+    parser.add_argument("--think-time", type=float, default=0, help="average seconds a user takes to answer the DM (default: 0)")
+    parser.add_argument("--flow-timeout", type=float, default=120, help="seconds before a flow counts as timed out (default: 120)")
+    parser.add_argument("--rate-limit", type=int, help="requests allowed per rate limit bucket and window (default: no limit)")
+    parser.add_argument("--rate-limit-window", type=float, default=1.0, help="length of a rate limit window in seconds (default: 1)")
+    parser.add_argument("--global-rate-limit", type=int, help="requests allowed per second in total (default: no limit)")
+    parser.add_argument("--random-429-probability", type=float, default=0, help="probability of an unexpected 429 response (default: 0)")
+    parser.add_argument("--api-latency", type=float, default=0, help="seconds added to every API request (default: 0)")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json", help="storage backend (default: json)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: 0)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    working_directory = tempfile.mkdtemp(prefix="policebot-load-")
+    if arguments.backend == "json":
+        data.set_storage_backend(storage.JSONStorageBackend(os.path.join(working_directory, "guilds")))
+    else:
+        data.set_storage_backend(storage.SQLiteStorageBackend(os.path.join(working_directory, "load.sqlite3")))
+    harness = LoadHarness(arguments)
+    harness.start_world()
+    data.start_guild_configuration_flusher()
+    try:
+        report = {
+            "parameters": {key: value for key, value in vars(arguments).items() if key != "output"},
+            "results": asyncio.get_event_loop().run_until_complete(harness.run())
+        }
+    finally:
+        data.stop_guild_configuration_flusher()
+        shutil.rmtree(working_directory)
+    print(json.dumps(report, indent=4, ensure_ascii=False))
+    if arguments.output is not None:
+        with open(arguments.output, "w") as output_file:
+            json.dump(report, output_file, indent=4, ensure_ascii=False)
@@ -0,0 +1,393 @@
+'''Replay_trace.py
+Replays a trace captured with POLICEBOT_CAPTURE_PATH (see capture.py) through the real bot from main.py, against a local fake Discord
+(see fake_discord.py) and a fresh data directory, so that a real burst of traffic can be run against two versions of the bot and compared.
+
+The fake Discord gets a guild for every guild in the trace, with the channels and roles that the trace uses and an admin role.
+Channels that users authenticate in get a lock before the replay starts, unless a ?al in the trace creates one. The password of such a lock
+is the reply that users gave most often in its channel, so that the right and wrong passwords of the trace stay right and wrong.
+Events are sent from a child process at the times they were recorded, divided by --speed. A reply to the bot (a DM, an answer to ?al
+or a password modal) is sent no earlier than the bot's prompt for it, and every user's events are sent in order, so that a sped up replay
+still goes through the same flows. The run reports:
+* how long every command and interaction handler took
+* a latency breakdown per stage, like load_harness.py
+* the authentication outcomes, and the attempts that ratelimit.py shed
+* the calls to the storage backend, and the bytes the bot process read and wrote
+* the bot's event loop lag
+
+Example:
+python benchmarks/replay_trace.py trace.jsonl.gz --speed 10 --output results.json'''
+
+import os, sys, gzip, json, time, types, asyncio, logging, argparse, tempfile, resource, shutil, functools, multiprocessing
+from collections import Counter
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+REPOSITORY_DIRECTORY = os.path.dirname(SCRIPT_DIRECTORY)
+sys.path.insert(0, REPOSITORY_DIRECTORY)
+#main.py reads these when it is imported. Unlike in load_harness.py, the authentication limits keep their defaults, like in production
+os.environ.setdefault("POLICEBOT_BOT_TOKEN", "replay-token")
+os.environ.setdefault("POLICEBOT_METRICS_PORT", "0")
+os.environ.setdefault("POLICEBOT_LOG_LEVEL", "WARNING")
+
+import discord.http
+from werkzeug.security import generate_password_hash
+import main, data, storage, hashing, interactions
+from metrics import AUTHENTICATION_OUTCOMES, SHED_AUTHENTICATIONS
+from capture import TRACE_FORMAT, TRACE_VERSION, MENTION_PATTERN
+from dispatcher import SESSION_CODE_PATTERN
+from fake_discord import FakeDiscord
+from load_harness import StageRecorder, LoopLagMonitor, summarize
+
+#Constants
+DEFAULT_PASSWORD = "replay" #Password of seeded locks that nobody replied to in the trace
+PROMPT_TIMEOUT = 10 #Seconds to wait for the bot's prompt before a reply is sent anyway
+STORAGE_METHODS = ("load_guild", "load_authenticated_users", "load_authentication_expirations", "create_guild", "record_change", "write_guild", "delete_authenticated_users")
+
+#Logging
+logger = logging.getLogger("replay_trace")
+
+def read_trace(path):
+    '''Reads a trace file. Returns its header and its events.'''
+    with gzip.open(path, "rt", encoding="utf-8") as trace_file:
+        header = json.loads(next(trace_file))
+        if header.get("format") != TRACE_FORMAT or header.get("version") != TRACE_VERSION:
+            raise ValueError(f"{path} is not a version {TRACE_VERSION} trace.")
+        return header, [json.loads(line) for line in trace_file if line.strip()]
+
+def read_process_io():
+    '''Returns the I/O counters of this process from /proc/self/io, or None where they are not available.'''
+    try:
+        with open("/proc/self/io") as io_file:
+            return {key: int(value) for key, value in (line.split(":") for line in io_file)}
+    except OSError:
+        return None
+
+#The replayed world (child process)
+class ReplayWorld:
+    '''The guilds, channels, roles and users of a trace in the fake Discord, which sends the events of the trace to the bot.'''
+    def __init__(self, arguments, header, events):
+        self.arguments = arguments
+        self.events = events
+        self.prefix = header["prefix"]
+        self.fake_discord = FakeDiscord(latency=arguments.api_latency)
+        self.ids = {} #Pseudonym in the trace --> ID in the fake Discord
+        self.admin_role_ids = {} #Guild pseudonym --> ID of its admin role
+        self.award_role_ids = {} #Guild pseudonym --> ID of the role that seeded locks award
+        self.fake_discord.message_listeners.append(self.on_bot_message)
+        self.fake_discord.interaction_listeners.append(self.on_interaction_response)
+        self.bot_message_counts = Counter() #Channel ID --> messages that the bot sent there
+        self.answered_interaction_ids = set()
+        self.bot_activity = asyncio.Event() #Set and replaced whenever the bot sends something
+        self.user_tasks = {} #User pseudonym --> task sending their last event
+        self.user_marks = {} #User pseudonym --> (DM message count, channel ID, channel message count, interaction ID) when their last event was sent
+
+    def on_bot_message(self, channel_id, message):
+        self.bot_message_counts[channel_id] += 1
+        self.notify()
+
+    def on_interaction_response(self, interaction_id, response):
+        self.answered_interaction_ids.add(interaction_id)
+        self.notify()
+
+    def notify(self):
+        self.bot_activity.set()
+        self.bot_activity = asyncio.Event()
+
+    async def wait_for_bot(self, is_done):
+        '''Waits until is_done returns True after something the bot sent, or until PROMPT_TIMEOUT has passed.'''
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + PROMPT_TIMEOUT
+        while not is_done() and loop.time() < deadline:
+            try:
+                await asyncio.wait_for(self.bot_activity.wait(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                logger.debug("The bot sent no prompt in %s seconds. Sending the reply anyway...", PROMPT_TIMEOUT)
+
+    def get_id(self, pseudonym):
+        '''Returns the ID in the fake Discord for a pseudonym in the trace.'''
+        fake_id = self.ids.get(pseudonym)
+        if fake_id is None:
+            fake_id = self.ids[pseudonym] = self.fake_discord.generate_snowflake()
+        return fake_id
+
+    def add_user(self, pseudonym):
+        if pseudonym not in self.ids:
+            self.fake_discord.add_user(self.get_id(pseudonym))
+
+    def rewrite_content(self, content):
+        '''Replaces the pseudonyms in mentions with the IDs in the fake Discord.'''
+        return MENTION_PATTERN.sub(lambda match: f"<{match.group(1)}{self.get_id(int(match.group(2)))}>", content)
+
+    def get_command(self, content):
+        '''Returns the command that message content calls, or None.'''
+        words = content.split(None, 1)
+        return main.bot.all_commands.get(words[0][len(self.prefix):]) if len(words) > 0 and words[0].startswith(self.prefix) else None
+
+    def add_guilds(self):
+        '''Adds a guild to the fake Discord for every guild in the trace, with the channels and roles that the trace uses.'''
+        guilds = {} #Guild pseudonym --> (channel pseudonyms, role pseudonyms)
+        for event in self.events:
+            self.add_user(event["user"])
+            if event["guild"] is None:
+                continue
+            channels, roles = guilds.setdefault(event["guild"], (set(), set()))
+            channels.add(event["channel"])
+            roles.update(event.get("roles", ()))
+            for kind, pseudonym in MENTION_PATTERN.findall(event.get("content", "")):
+                if kind == "#":
+                    channels.add(int(pseudonym))
+                elif kind == "@&":
+                    roles.add(int(pseudonym))
+                else:
+                    self.add_user(int(pseudonym))
+        for guild, (channels, roles) in guilds.items():
+            self.admin_role_ids[guild] = self.fake_discord.generate_snowflake()
+            self.award_role_ids[guild] = self.fake_discord.generate_snowflake()
+            role_ids = [self.get_id(role) for role in sorted(roles)] + [self.award_role_ids[guild]]
+            self.fake_discord.add_guild(self.get_id(guild), [self.get_id(channel) for channel in sorted(channels)], role_ids, self.admin_role_ids[guild])
+
+    def get_locks(self):
+        '''Returns (guild ID, channel ID, award role ID, password) for every channel that users authenticate in, unless a ?al in the trace
+        creates its lock. The password is the reply that users gave most often after ?a in the channel, or in the password modal there.'''
+        replies = {} #(guild pseudonym, channel pseudonym) --> Counter of password replies
+        authenticating_in = {} #User pseudonym --> (guild pseudonym, channel pseudonym) of their last ?a
+        created_locks = set()
+        for event in self.events:
+            lock = (event["guild"], event["channel"])
+            if event["type"] == "interaction":
+                channel_replies = replies.setdefault(lock, Counter())
+                if interactions.PASSWORD_INPUT_ID in event["inputs"]:
+                    channel_replies[event["inputs"][interactions.PASSWORD_INPUT_ID]] += 1
+            elif event["guild"] is not None:
+                if self.get_command(event["content"]) is main.authenticate:
+                    authenticating_in[event["user"]] = lock
+                    replies.setdefault(lock, Counter())
+                created_locks.update((event["guild"], int(pseudonym)) for kind, pseudonym in MENTION_PATTERN.findall(event["content"]) if kind == "#")
+            elif event["user"] in authenticating_in:
+                replies[authenticating_in[event["user"]]][SESSION_CODE_PATTERN.sub("", event["content"])] += 1
+        return [
+            (self.get_id(guild), self.get_id(channel), self.award_role_ids[guild], self.rewrite_content(channel_replies.most_common(1)[0][0]) if len(channel_replies) > 0 else DEFAULT_PASSWORD)
+            for (guild, channel), channel_replies in replies.items() if (guild, channel) not in created_locks
+        ]
+
+    async def wait_for_prompt(self, event):
+        '''Waits until the bot has prompted for an event that replies to it, since the user's last event.'''
+        mark = self.user_marks.get(event["user"])
+        if mark is None:
+            return
+        dm_message_count, channel_id, channel_message_count, interaction_id = mark
+        if event["type"] == "interaction":
+            if event["interaction_type"] == interactions.MODAL_SUBMIT and interaction_id is not None:
+                await self.wait_for_bot(lambda: interaction_id in self.answered_interaction_ids)
+        elif event["guild"] is None:
+            dm_channel_id = self.fake_discord.get_dm_channel_id(self.get_id(event["user"]))
+            await self.wait_for_bot(lambda: self.bot_message_counts[dm_channel_id] > dm_message_count)
+        elif self.get_command(event["content"]) is None and self.get_id(event["channel"]) == channel_id:
+            await self.wait_for_bot(lambda: self.bot_message_counts[channel_id] > channel_message_count)
+
+    async def send_event(self, event, previous_task):
+        '''Sends an event of the trace to the bot, after the user's previous event and the bot's prompt for it.'''
+        if previous_task is not None:
+            await previous_task
+        await self.wait_for_prompt(event)
+        user_id = self.get_id(event["user"])
+        channel_id = self.get_id(event["channel"])
+        dm_channel_id = self.fake_discord.get_dm_channel_id(user_id)
+        interaction_id = self.fake_discord.generate_snowflake() if event["type"] == "interaction" else None
+        self.user_marks[event["user"]] = (self.bot_message_counts[dm_channel_id], channel_id, self.bot_message_counts[channel_id], interaction_id)
+        if event["type"] == "message":
+            content = self.rewrite_content(event["content"])
+            if event["guild"] is None:
+                await self.fake_discord.send_direct_message(user_id, content)
+            else:
+                role_ids = [self.admin_role_ids[event["guild"]]] if event.get("admin") else []
+                mention_role_ids = [self.get_id(role) for role in event.get("roles", ())]
+                await self.fake_discord.send_guild_message(self.get_id(event["guild"]), channel_id, user_id, content, role_ids, mention_role_ids)
+            return
+        interaction_data = {"custom_id": event["custom_id"]}
+        if event["interaction_type"] == interactions.MESSAGE_COMPONENT:
+            interaction_data["component_type"] = interactions.BUTTON
+        else:
+            interaction_data["components"] = [{"type": interactions.ACTION_ROW, "components": [
+                {"type": interactions.TEXT_INPUT, "custom_id": custom_id, "value": self.rewrite_content(value)} for custom_id, value in event["inputs"].items()
+            ]}]
+        await self.fake_discord.send_interaction(self.get_id(event["guild"]), channel_id, user_id, event["interaction_type"], interaction_data, interaction_id=interaction_id)
+
+    async def replay(self):
+        '''Sends the events at their recorded times, divided by the speed. Returns the seconds that it took.'''
+        loop = asyncio.get_event_loop()
+        started_at = loop.time()
+        for event in self.events:
+            if self.arguments.speed > 0:
+                delay = started_at + event["t"] / self.arguments.speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self.user_tasks[event["user"]] = asyncio.ensure_future(self.send_event(event, self.user_tasks.get(event["user"])))
+        await asyncio.gather(*self.user_tasks.values())
+        return loop.time() - started_at
+
+    async def serve(self, connection):
+        '''Starts the fake Discord, sends its address and the locks to seed to the bot process, then replays the trace when the bot process asks for it.'''
+        loop = asyncio.get_event_loop()
+        await self.fake_discord.start()
+        self.add_guilds()
+        connection.send({"api_base": self.fake_discord.api_base, "locks": self.get_locks()})
+        while True:
+            command, argument = await loop.run_in_executor(None, connection.recv)
+            if command != "run":
+                break
+            connection.send(await self.replay())
+        await self.fake_discord.stop()
+
+def run_world(arguments, header, events, connection):
+    '''Entry point of the child process.'''
+    logging.basicConfig(level=logging.WARNING, force=True) #The log queue listener of the bot process does not run in this process
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(ReplayWorld(arguments, header, events).serve(connection))
+
+#The bot (this process)
+class StorageRecorder:
+    '''Records how often, and for how long, the bot calls the methods of its storage backend.'''
+    def __init__(self):
+        self.calls = {}
+
+    def install(self, backend):
+        for method_name in STORAGE_METHODS:
+            setattr(backend, method_name, self.wrap(method_name, getattr(backend, method_name)))
+
+    def wrap(self, method_name, method):
+        def timed(*args, **kwargs):
+            started_at = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.calls.setdefault(method_name, []).append(time.perf_counter() - started_at)
+        return timed
+
+class TraceReplayer:
+    '''Runs the bot in this process against the replayed world in a child process.'''
+    def __init__(self, arguments, header, events):
+        self.arguments = arguments
+        self.header = header
+        self.events = events
+        self.stage_recorder = StageRecorder()
+        self.storage_recorder = StorageRecorder()
+        self.handler_latencies = {} #"command <name>" or "interaction <custom ID>" --> seconds
+        self.connection = None
+        self.world_process = None
+
+    def start_world(self):
+        '''Starts the child process. Called before the event loop runs, so that the child doesn't inherit a running loop.'''
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.world_process = multiprocessing.Process(target=run_world, args=(self.arguments, self.header, self.events, child_connection), daemon=True)
+        self.world_process.start()
+
+    async def receive(self):
+        return await asyncio.get_event_loop().run_in_executor(None, self.connection.recv)
+
+    def seed_locks(self, locks):
+        '''Creates the locks that the trace needs in the bot's storage.'''
+        for guild_id, channel_id, award_role_id, password in locks:
+            data.create_guild_configuration(str(guild_id))
+            lock_message = types.SimpleNamespace(id=channel_id + 1)
+            data.add_guild_lock(str(guild_id), data.generate_lock_data(channel_id, generate_password_hash(password, hashing.PASSWORD_HASH_METHOD), "Replay", [award_role_id], lock_message))
+
+    def record_handler(self, name, seconds):
+        self.handler_latencies.setdefault(name, []).append(seconds)
+
+    def wrap_handler(self, custom_id, handler):
+        @functools.wraps(handler) #The interaction router labels its metrics with the name of the handler
+        async def timed_handler(interaction):
+            started_at = time.perf_counter()
+            try:
+                return await handler(interaction)
+            finally:
+                self.record_handler(f"interaction {custom_id}", time.perf_counter() - started_at)
+        return timed_handler
+
+    def install(self, bot):
+        '''Times every command invocation and interaction handler of the bot, and the stages and storage calls they make.'''
+        invoke = bot.invoke
+        async def timed_invoke(ctx):
+            started_at = time.perf_counter()
+            try:
+                return await invoke(ctx)
+            finally:
+                if ctx.command is not None:
+                    self.record_handler(f"command {ctx.command.name}", time.perf_counter() - started_at)
+        bot.invoke = timed_invoke
+        for custom_id, handler in list(interactions.interaction_router.handlers.items()):
+            interactions.interaction_router.handlers[custom_id] = self.wrap_handler(custom_id, handler)
+        self.stage_recorder.install(bot)
+        self.storage_recorder.install(data.storage_backend)
+
+    async def run(self):
+        world = await self.receive()
+        discord.http.Route.BASE = interactions.InteractionRoute.BASE = world["api_base"]
+        self.seed_locks(world["locks"])
+        self.install(main.bot)
+        bot_task = asyncio.ensure_future(main.bot.start(main.BOT_TOKEN))
+        try:
+            await asyncio.wait_for(main.bot.wait_until_ready(), 60)
+            logger.warning("Replaying %s events from %.1f recorded seconds at %s speed...", len(self.events), self.events[-1]["t"] if self.events else 0, f"{self.arguments.speed:g}x" if self.arguments.speed > 0 else "full")
+            process_io_before = read_process_io()
+            loop_lag_monitor = LoopLagMonitor()
+            loop_lag_monitor.start()
+            self.connection.send(("run", None))
+            replay_seconds = await self.receive()
+            await asyncio.sleep(self.arguments.drain)
+            loop_lag_monitor.stop()
+            process_io_after = read_process_io()
+        finally:
+            self.connection.send(("stop", None))
+            await main.bot.close()
+            await asyncio.gather(bot_task, return_exceptions=True)
+            self.world_process.join(10)
+        return {
+            "events": len(self.events),
+            "seeded_locks": len(world["locks"]),
+            "recorded_seconds": self.events[-1]["t"] if self.events else 0,
+            "replay_seconds": round(replay_seconds, 3),
+            "handlers": {name: summarize(latencies) for name, latencies in sorted(self.handler_latencies.items())},
+            "stages": {stage: summarize(latencies) for stage, latencies in sorted(self.stage_recorder.stages.items())},
+            "authentication_outcomes": {labelvalues[0]: value for labelvalues, value in sorted(AUTHENTICATION_OUTCOMES.values.items())},
+            "shed_authentications": {labelvalues[0]: value for labelvalues, value in sorted(SHED_AUTHENTICATIONS.values.items())},
+            "storage_calls": {method_name: summarize(latencies) for method_name, latencies in sorted(self.storage_recorder.calls.items())},
+            "process_io": {key: process_io_after[key] - process_io_before[key] for key in process_io_after} if process_io_before is not None else None,
+            "event_loop_lag": summarize(loop_lag_monitor.lags),
+            "bot_peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        }
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Replays a captured trace through the bot against a local fake Discord.")
+    parser.add_argument("trace", help="trace file written with POLICEBOT_CAPTURE_PATH")
+    parser.add_argument("--speed", type=float, default=1, help="how many times faster than recorded to send the events, or 0 to send them as fast as possible (default: 1)")
+    parser.add_argument("--drain", type=float, default=5, help="seconds to let the last commands finish after the last event (default: 5)")
+    parser.add_argument("--api-latency", type=float, default=0, help="seconds added to every API request (default: 0)")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json", help="storage backend (default: json)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    header, events = read_trace(arguments.trace)
+    working_directory = tempfile.mkdtemp(prefix="policebot-replay-")
+    if arguments.backend == "json":
+        data.set_storage_backend(storage.JSONStorageBackend(os.path.join(working_directory, "guilds")))
+    else:
+        data.set_storage_backend(storage.SQLiteStorageBackend(os.path.join(working_directory, "replay.sqlite3")))
+    replayer = TraceReplayer(arguments, header, events)
+    replayer.start_world()
+    data.start_guild_configuration_flusher()
+    try:
+        report = {
+            "parameters": {key: value for key, value in vars(arguments).items() if key != "output"},
+            "results": asyncio.get_event_loop().run_until_complete(replayer.run())
+        }
+    finally:
+        data.stop_guild_configuration_flusher()
+        shutil.rmtree(working_directory)
+    print(json.dumps(report, indent=4, ensure_ascii=False))
+    if arguments.output is not None:
+        with open(arguments.output, "w") as output_file:
+            json.dump(report, output_file, indent=4, ensure_ascii=False)
@@ -0,0 +1,194 @@
+'''Capture.py
+Records the gateway traffic that the bot acts on to a trace file, so that real bursts (like a verification wave after an announcement)
+can be replayed against a local fake Discord with benchmarks/replay_trace.py.
+
+The trace is a gzipped JSON lines file: a header, then one line per command message, reply to a waiting command, DM or interaction,
+with the seconds since the capture started. Other chat is not recorded. Nothing in it points back to real users:
+* IDs of guilds, channels, users and roles are replaced by small numbers, which are only kept in memory
+* DMs, password modals and the password step of ?al are replaced by a keyed hash as a whole, so that replies with the same text
+  (like the right password) still match each other. Only a session code that picks one of the open sessions is kept in front of it.
+* other messages only keep the command, mentions, and the fixed answers of the steps of ?al that are not secret
+  (like "24h" for how long access lasts). The rest is replaced by a keyed hash.
+The key is random and only kept in memory, so the hashes can't be reversed by guessing passwords.
+
+Capturing is turned on by setting POLICEBOT_CAPTURE_PATH. When it isn't set, nothing is registered with the bot.'''
+
+import os, re, gzip, hmac, json, time, logging, weakref
+from dispatcher import reply_dispatcher, DM, GUILD, SESSION_CODE_PATTERN
+from interactions import Interaction
+
+#Settings
+CAPTURE_PATH = os.environ.get("POLICEBOT_CAPTURE_PATH") #Where to write the trace, or None to not capture
+
+#Constants
+TRACE_FORMAT = "policebot-trace"
+TRACE_VERSION = 1
+MENTION_PATTERN = re.compile(r"<(#|@&|@!?)(\d+)>")
+#Replies to ?al (the only command with guild sessions) by their position, for the steps whose fixed answers are kept as they are
+ADD_LOCK_PASSWORD_STEP = 0 #"Step 1: Select password"
+ADD_LOCK_MESSAGE_STEP = 3 #"Step 4: Select a custom message", where "nomessagepls" is kept
+ADD_LOCK_DURATION_STEP = 4 #"Step 5: How long should access last?", where "forever" and durations are kept
+HASH_LENGTH = 12 #Hex digits kept of the keyed hash of redacted text
+
+#Logging
+logger = logging.getLogger(__name__)
+
+class TrafficCapture:
+    '''Writes the gateway events that the bot acts on to a trace file, with IDs replaced and contents redacted.'''
+    def __init__(self):
+        self.bot = None
+        self.file = None
+        self.key = None
+        self.duration_pattern = None
+        self.started_at = None
+        self.pseudonyms = {} #Real ID --> pseudonym
+        self.session_replies = weakref.WeakKeyDictionary() #Guild session --> replies to it that have been captured
+        self.event_count = 0
+
+    def start(self, bot, path, duration_pattern):
+        '''Starts capturing the traffic of a bot. duration_pattern matches durations, which are answers to ?al that are kept as they are.'''
+        self.bot = bot
+        self.key = os.urandom(32)
+        self.duration_pattern = duration_pattern
+        self.started_at = time.monotonic()
+        self.file = gzip.open(path, "wt", encoding="utf-8")
+        self.write({"format": TRACE_FORMAT, "version": TRACE_VERSION, "prefix": bot.command_prefix, "started_at": time.time()})
+        bot.add_listener(self.on_socket_response, "on_socket_response")
+        logger.info("Capturing gateway traffic to %s...", path)
+
+    def stop(self):
+        '''Stops capturing and closes the trace file.'''
+        if self.file is None:
+            return
+        self.bot.remove_listener(self.on_socket_response, "on_socket_response")
+        self.file.close()
+        self.file = None
+        logger.info("Captured %s events.", self.event_count)
+
+    def write(self, event):
+        self.file.write(json.dumps(event, separators=(",", ":")) + "\n")
+
+    def get_pseudonym(self, real_id):
+        '''Returns the number that replaces an ID in the trace.'''
+        real_id = int(real_id)
+        pseudonym = self.pseudonyms.get(real_id)
+        if pseudonym is None:
+            pseudonym = self.pseudonyms[real_id] = len(self.pseudonyms) + 1
+        return pseudonym
+
+    def hash_text(self, text):
+        return "~" + hmac.new(self.key, text.encode("utf-8"), "sha256").hexdigest()[:HASH_LENGTH]
+
+    def redact_text(self, text):
+        '''Returns text with mentions kept (with their IDs replaced) and the rest replaced by its keyed hash.'''
+        kept = [f"<{kind}{self.get_pseudonym(mentioned_id)}>" for kind, mentioned_id in MENTION_PATTERN.findall(text)]
+        text = MENTION_PATTERN.sub("", text).strip()
+        if len(text) > 0:
+            kept.append(self.hash_text(text))
+        return " ".join(kept)
+
+    def redact_command(self, content):
+        '''Returns a command message with only the command kept, and its arguments redacted with redact_text.'''
+        prefix = self.bot.command_prefix
+        words = content.split(None, 1)
+        if len(words) == 0 or words[0][len(prefix):] not in self.bot.all_commands:
+            return self.redact_text(content)
+        return " ".join([words[0]] + ([self.redact_text(words[1])] if len(words) > 1 else []))
+
+    def redact_secret(self, content, sessions):
+        '''Returns a reply that can be a password as one keyed hash.
+        A session code that picks one of the open sessions is kept, like the dispatcher strips it (see dispatcher.py).'''
+        code_match = SESSION_CODE_PATTERN.match(content)
+        if code_match is not None and any(session.code == int(code_match.group(1)) for session in sessions):
+            return f"#{code_match.group(1)} {self.hash_text(content[code_match.end():])}"
+        return self.hash_text(content)
+
+    def redact_add_lock_reply(self, content, sessions):
+        '''Returns a reply to ?al, redacted according to the step that it answers.'''
+        session = sessions[0] if len(sessions) == 1 else None
+        step = self.session_replies.get(session, 0) if session is not None else ADD_LOCK_PASSWORD_STEP #Treated as a password if the step is unknown
+        if session is not None:
+            self.session_replies[session] = step + 1
+        if step == ADD_LOCK_MESSAGE_STEP and content.lower() == "nomessagepls":
+            return content
+        if step == ADD_LOCK_DURATION_STEP and (content.strip().lower() == "forever" or self.duration_pattern.match(content)):
+            return content.strip()
+        if step == ADD_LOCK_PASSWORD_STEP:
+            return self.redact_secret(content, sessions)
+        return self.redact_text(content)
+
+    def get_sessions(self, user_id, kind, channel_id, message_id):
+        '''Returns the sessions of a user that a message could be a reply to, like ReplyDispatcher.find_sessions.'''
+        return [session for session in reply_dispatcher.sessions.get((user_id, kind), ()) if session.accepts_replies() and (session.channel_id is None or session.channel_id == channel_id) and (session.after_message_id is None or message_id > session.after_message_id)]
+
+    def is_admin(self, guild_id, member_role_ids, user_id):
+        '''Returns whether a member is an administrator of a guild, from the roles in an event.'''
+        guild = self.bot.get_guild(int(guild_id))
+        if guild is None:
+            return False
+        if guild.owner_id == int(user_id):
+            return True
+        return any(role is not None and role.permissions.administrator for role in (guild.get_role(int(role_id)) for role_id in member_role_ids))
+
+    async def on_socket_response(self, message):
+        event_name = message.get("t")
+        if event_name == "MESSAGE_CREATE":
+            event = self.get_message_event(message["d"])
+        elif event_name == "INTERACTION_CREATE":
+            event = self.get_interaction_event(message["d"])
+        else:
+            return
+        if event is not None:
+            self.write(event)
+            self.event_count += 1
+
+    def get_message_event(self, payload):
+        '''Returns the trace event for a message, or None if the bot doesn't act on it.'''
+        author = payload["author"]
+        if author.get("bot"):
+            return None
+        guild_id = payload.get("guild_id")
+        content = payload.get("content", "")
+        user_id, channel_id, message_id = int(author["id"]), int(payload["channel_id"]), int(payload["id"])
+        if guild_id is None:
+            content = self.redact_secret(content, self.get_sessions(user_id, DM, channel_id, message_id))
+        else:
+            sessions = self.get_sessions(user_id, GUILD, channel_id, message_id)
+            if len(sessions) > 0:
+                content = self.redact_add_lock_reply(content, sessions)
+            elif content.startswith(self.bot.command_prefix):
+                content = self.redact_command(content)
+            else:
+                return None #Chat that is neither a command nor a reply to a waiting command
+        event = {
+            "t": round(time.monotonic() - self.started_at, 4),
+            "type": "message",
+            "guild": self.get_pseudonym(guild_id) if guild_id is not None else None,
+            "channel": self.get_pseudonym(payload["channel_id"]),
+            "user": self.get_pseudonym(author["id"]),
+            "content": content
+        }
+        if len(payload.get("mention_roles", [])) > 0:
+            event["roles"] = [self.get_pseudonym(role_id) for role_id in payload["mention_roles"]]
+        if guild_id is not None and self.is_admin(guild_id, payload.get("member", {}).get("roles", []), author["id"]):
+            event["admin"] = True
+        return event
+
+    def get_interaction_event(self, payload):
+        '''Returns the trace event for an interaction.'''
+        interaction = Interaction(None, payload)
+        return {
+            "t": round(time.monotonic() - self.started_at, 4),
+            "type": "interaction",
+            "guild": self.get_pseudonym(interaction.guild_id) if interaction.guild_id is not None else None,
+            "channel": self.get_pseudonym(interaction.channel_id),
+            "user": self.get_pseudonym(interaction.user_id),
+            "interaction_type": interaction.type,
+            "custom_id": interaction.custom_id,
+            "inputs": {
+                component["custom_id"]: self.hash_text(component["value"])
+                for row in interaction.data.get("components", []) for component in row.get("components", []) if "value" in component
+            }
+        }
+
+traffic_capture = TrafficCapture()
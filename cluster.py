@@ -0,0 +1,186 @@
+'''Cluster.py
+Sharding settings, and a supervisor that runs the bot as a cluster of worker processes.
+
+Discord splits the guilds of a bot between shards: a guild belongs to shard (guild_id >> 22) % shard_count.
+In cluster mode, every worker process runs main.py as an AutoShardedBot for its own range of shards, so each guild is
+served by exactly one process. Guild data is only ever read and written by the process that serves the guild,
+so the workers can share one data directory (or one SQLite database) without stepping on each other.
+DMs are the exception: Discord only sends them to shard 0, so only the worker that serves shard 0 gets DM replies.
+Workers without shard 0 can't ask for the password in a DM, and answer ?a with an Unlock button instead (see interactions.py).
+The supervisor restarts workers that exit, with a backoff for workers that keep crashing.
+
+Start a cluster with:
+python cluster.py
+
+Settings (environment variables):
+* POLICEBOT_SHARD_COUNT - the total number of shards, or "auto" to use the number that Discord recommends.
+  If it is not set, main.py runs a single unsharded bot.
+* POLICEBOT_SHARD_IDS - the shards that one process serves, like "0-3" or "0,2,4". Set by the supervisor for its workers.
+* POLICEBOT_CLUSTER_WORKERS - the number of worker processes (default: the number of CPUs, at most one per shard)'''
+
+import os, sys, json, time, signal, logging, subprocess
+from urllib.request import Request, urlopen
+from log_setup import setup_logging
+
+#Paths
+SCRIPT_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
+MAIN_PATH = os.path.join(SCRIPT_DIRECTORY, "main.py")
+
+#Settings
+SHARD_COUNT = os.environ.get("POLICEBOT_SHARD_COUNT") #None, "auto" or a number
+SHARD_IDS = os.environ.get("POLICEBOT_SHARD_IDS")
+CLUSTER_WORKERS = int(os.environ.get("POLICEBOT_CLUSTER_WORKERS", os.cpu_count() or 1))
+RESTART_BACKOFF_BASE = 1 #Seconds to wait before restarting a crashed worker the first time. Doubled for every crash in a row
+RESTART_BACKOFF_MAX = 300
+STABLE_SECONDS = 600 #A worker that ran for this long is no longer counted as crashing in a row
+SHUTDOWN_TIMEOUT = 30 #Seconds to wait for workers to stop before they are killed
+GATEWAY_BOT_URL = "https://discord.com/api/v7/gateway/bot"
+
+#Logging
+logger = logging.getLogger(__name__)
+
+def parse_shard_ids(shard_ids):
+    '''Parses a shard ID list like "0-3,8,10-11" into a sorted list of ints.'''
+    parsed_shard_ids = set()
+    for part in shard_ids.split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            parsed_shard_ids.update(range(int(first), int(last) + 1))
+        else:
+            parsed_shard_ids.add(int(part))
+    return sorted(parsed_shard_ids)
+
+def format_shard_ids(shard_ids):
+    '''Formats a list of consecutive shard IDs as a range, like "0-3".'''
+    return f"{shard_ids[0]}-{shard_ids[-1]}" if len(shard_ids) > 1 else str(shard_ids[0])
+
+def get_guild_shard_id(guild_id, shard_count):
+    '''Returns the shard that a guild belongs to.'''
+    return (int(guild_id) >> 22) % shard_count
+
+def receives_direct_messages(sharding_options):
+    '''Returns whether a bot with the passed sharding options gets DMs, which Discord only sends to shard 0.'''
+    return sharding_options is None or sharding_options["shard_ids"] is None or 0 in sharding_options["shard_ids"]
+
+def get_sharding_options():
+    '''Returns the shard_count and shard_ids options for an AutoShardedBot, or None if the bot should not be sharded.'''
+    if SHARD_COUNT is None:
+        return None
+    if SHARD_COUNT == "auto":
+        return {"shard_count": None, "shard_ids": None} #discord.py asks Discord for the recommended shard count
+    return {"shard_count": int(SHARD_COUNT), "shard_ids": parse_shard_ids(SHARD_IDS) if SHARD_IDS else None}
+
+def split_shards(shard_count, worker_count):
+    '''Splits the shards into at most worker_count ranges of consecutive shards, as even as possible.'''
+    worker_count = max(1, min(worker_count, shard_count))
+    ranges = []
+    first_shard_id = 0
+    for worker_index in range(worker_count):
+        size = shard_count // worker_count + (1 if worker_index < shard_count % worker_count else 0)
+        ranges.append(list(range(first_shard_id, first_shard_id + size)))
+        first_shard_id += size
+    return ranges
+
+def fetch_recommended_shard_count(bot_token):
+    '''Asks Discord how many shards the bot should use.'''
+    request = Request(GATEWAY_BOT_URL, headers={"Authorization": f"Bot {bot_token}", "User-Agent": "DiscordBot (PoliceBot cluster)"})
+    with urlopen(request, timeout=30) as response:
+        return json.loads(response.read())["shards"]
+
+class Worker:
+    '''A worker process serving a range of shards.'''
+    def __init__(self, index, shard_ids):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.process = None
+        self.started_at = None
+        self.crashes_in_a_row = 0
+        self.restart_at = 0 #Monotonic time when the worker should be (re)started
+
+    def __str__(self):
+        return f"worker {self.index} (shards {format_shard_ids(self.shard_ids)})"
+
+class Supervisor:
+    '''Starts one worker per shard range and restarts workers that exit.'''
+    def __init__(self, shard_count, worker_count, command=None):
+        self.shard_count = shard_count
+        self.command = command or [sys.executable, MAIN_PATH]
+        self.workers = [Worker(index, shard_ids) for index, shard_ids in enumerate(split_shards(shard_count, worker_count))]
+        self.stopping = False
+
+    def get_worker_environment(self, worker):
+        '''Returns the environment variables of a worker process.'''
+        environment = dict(os.environ)
+        environment["POLICEBOT_SHARD_COUNT"] = str(self.shard_count)
+        environment["POLICEBOT_SHARD_IDS"] = format_shard_ids(worker.shard_ids)
+        environment["POLICEBOT_CLUSTER_WORKER_ID"] = str(worker.index)
+        metrics_port = int(os.environ.get("POLICEBOT_METRICS_PORT", 9464))
+        if metrics_port != 0: #Every worker serves its metrics on its own port
+            environment["POLICEBOT_METRICS_PORT"] = str(metrics_port + worker.index)
+        return environment
+
+    def start_worker(self, worker):
+        logger.info("Starting %s...", worker)
+        worker.process = subprocess.Popen(self.command, env=self.get_worker_environment(worker))
+        worker.started_at = time.monotonic()
+
+    def check_worker(self, worker):
+        '''Starts a worker if it is due, and schedules a restart if it has exited.'''
+        now = time.monotonic()
+        if worker.process is None:
+            if now >= worker.restart_at:
+                self.start_worker(worker)
+            return
+        exit_code = worker.process.poll()
+        if exit_code is None:
+            return
+        worker.process = None
+        if now - worker.started_at >= STABLE_SECONDS:
+            worker.crashes_in_a_row = 0
+        backoff = min(RESTART_BACKOFF_MAX, RESTART_BACKOFF_BASE * 2 ** worker.crashes_in_a_row)
+        worker.crashes_in_a_row += 1
+        worker.restart_at = now + backoff
+        logger.error("%s exited with code %s! Restarting it in %s seconds...", str(worker).capitalize(), exit_code, backoff)
+
+    def stop(self, signal_number=None, frame=None):
+        '''Stops the supervisor loop. Called from the signal handlers.'''
+        logger.info("Got signal %s. Stopping workers...", signal_number)
+        self.stopping = True
+
+    def stop_workers(self):
+        '''Asks every worker to stop, and kills the ones that don't stop in time.'''
+        running_workers = [worker for worker in self.workers if worker.process is not None]
+        for worker in running_workers:
+            worker.process.terminate()
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for worker in running_workers:
+            try:
+                worker.process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                logger.warning("%s did not stop in time! Killing it...", str(worker).capitalize())
+                worker.process.kill()
+                worker.process.wait()
+        logger.info("All workers stopped.")
+
+    def run(self, check_interval=1):
+        '''Runs the workers until the supervisor gets SIGINT or SIGTERM.'''
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        logger.info("Running %s shards in %s workers.", self.shard_count, len(self.workers))
+        while not self.stopping:
+            for worker in self.workers:
+                self.check_worker(worker)
+            time.sleep(check_interval)
+        self.stop_workers()
+
+if __name__ == "__main__":
+    setup_logging()
+    if SHARD_COUNT is None or SHARD_COUNT == "auto":
+        logger.info("Asking Discord for the recommended shard count...")
+        shard_count = fetch_recommended_shard_count(os.environ["POLICEBOT_BOT_TOKEN"])
+    else:
+        shard_count = int(SHARD_COUNT)
+    Supervisor(shard_count, CLUSTER_WORKERS).run()
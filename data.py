@@ -1,19 +1,31 @@
 '''Data.py
-Various functions related to data readings and writings.'''
+Various functions related to data readings and writings.
 
-import os, json, logging, datetime, pytz
+Guild data is cached in memory and persisted through a storage backend (see storage.py).
+Changes are applied in memory and recorded by the backend as small change records. The JSON backend appends them
+to a per-guild journal, which is compacted into new snapshots in the background.'''
 
-#Paths
-SCRIPT_PATH = os.path.realpath(__file__)
-SCRIPT_DIRECTORY = os.path.dirname(SCRIPT_PATH)
-DATA_PATH = os.path.join(SCRIPT_DIRECTORY, "data/")
-GUILDS_PATH = os.path.join(DATA_PATH, "guilds/")
+import os, sys, time, mmap, struct, marshal, logging, datetime, pytz, threading, atexit, asyncio, weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from storage import create_storage_backend, write_file_atomically, DATA_PATH, \
+    JOURNAL_ADD_LOCK, JOURNAL_UPDATE_LOCK, JOURNAL_REMOVE_LOCK, JOURNAL_AUTHENTICATE, JOURNAL_SET_CONFIGURATION, JOURNAL_CLEAR_AUTHENTICATED_USERS, JOURNAL_DEAUTHENTICATE
+from models import Lock, GuildConfig
 
-#Defaults
-DEFAULT_GUILD_CONFIGURATION = {
-    "enabled_locks": [],
-    "configuration_created_at": None
-}
+#Cache settings
+GUILD_CACHE_MAX_SIZE = int(os.environ.get("POLICEBOT_GUILD_CACHE_SIZE", 5000)) #Maximum number of guild configurations kept in memory
+GUILD_CACHE_FLUSH_INTERVAL = float(os.environ.get("POLICEBOT_GUILD_CACHE_FLUSH_INTERVAL", 5)) #Seconds between checks for journals to compact
+#Journal settings
+JOURNAL_COMPACTION_THRESHOLD = int(os.environ.get("POLICEBOT_JOURNAL_COMPACTION_THRESHOLD", 500)) #Number of journal records before a guild is compacted
+#Startup settings
+PRELOAD_GUILDS = os.environ.get("POLICEBOT_PRELOAD_GUILDS", "0") == "1" #Whether to load the configurations of all guilds when the bot is ready
+PRELOAD_WORKERS = int(os.environ.get("POLICEBOT_PRELOAD_WORKERS", 8)) #Number of threads reading guild configurations during a preload
+GUILD_SNAPSHOT_ENABLED = os.environ.get("POLICEBOT_GUILD_SNAPSHOT", "0") == "1" #Whether to write the cache to a snapshot on shutdown and read it on start
+GUILD_SNAPSHOT_PATH = os.path.join(DATA_PATH, "guild_snapshot.bin")
+#Guild snapshot format: a header followed by the marshalled guilds. Marshal data can only be read by the Python version that wrote it
+GUILD_SNAPSHOT_HEADER = struct.Struct("<4sHBB") #Magic, snapshot format version, Python major and minor version
+GUILD_SNAPSHOT_MAGIC = b"PBGS"
+GUILD_SNAPSHOT_VERSION = 1
 
 #Exceptions
 class GuildDoesNotExistError(Exception):
@@ -22,118 +34,665 @@ class GuildDoesNotExistError(Exception):
 #Logging
 logger = logging.getLogger(__name__)
 
+#Cache
+class GuildLockIndex:
+    '''Index over the locks of one guild, keyed by channel ID.
+    Maps every channel ID to its lock (see models.py) and the lock's position in the configuration's locks,
+    and keeps sets of all and enabled channel IDs so that lookups never scan the lock list.
+    Authenticated users are kept in one set per lock, loaded from storage the first time they are needed.
+    The same goes for when their authentications expire, for locks where they do.'''
+    def __init__(self, guild_id, configuration, storage_backend=None):
+        self.guild_id = guild_id
+        self.configuration = configuration
+        self.storage_backend = storage_backend #The backend that authenticated users are loaded from, or None for the current one
+        self.locks_by_channel_id = {} #Channel ID --> (lock, position in "enabled_locks")
+        self.channel_ids = set()
+        self.enabled_channel_ids = set()
+        self.authenticated_users = {} #Channel ID --> set of authenticated user IDs
+        self.authentication_expirations = {} #Channel ID --> dict of user ID --> Unix timestamp when the authentication expires
+        self.changed_authenticated_users = set() #Channel IDs whose authenticated users have changed since the last compaction
+        for position, lock in enumerate(configuration.locks):
+            self.index_lock(lock, position)
+
+    def index_lock(self, lock, position):
+        '''Adds a lock at a certain position to the index.'''
+        channel_id = lock.channel_id
+        self.locks_by_channel_id[channel_id] = (lock, position)
+        self.channel_ids.add(channel_id)
+        if lock.enabled:
+            self.enabled_channel_ids.add(channel_id)
+        else:
+            self.enabled_channel_ids.discard(channel_id)
+
+    def get_authenticated_users(self, channel_id):
+        '''Returns the set of authenticated user IDs for the lock in a channel.'''
+        authenticated_users = self.authenticated_users.get(channel_id)
+        if authenticated_users is None:
+            authenticated_users = (self.storage_backend or storage_backend).load_authenticated_users(self.guild_id, channel_id)
+            self.authenticated_users[channel_id] = authenticated_users
+        return authenticated_users
+
+    def get_authentication_expirations(self, channel_id):
+        '''Returns the dict of user ID --> expiry timestamp for the authentications of the lock in a channel that expire.'''
+        authentication_expirations = self.authentication_expirations.get(channel_id)
+        if authentication_expirations is None:
+            authentication_expirations = (self.storage_backend or storage_backend).load_authentication_expirations(self.guild_id, channel_id)
+            self.authentication_expirations[channel_id] = authentication_expirations
+        return authentication_expirations
+
+    def get_lock(self, channel_id, return_only_enabled_locks=True):
+        '''Returns the lock for a channel ID, or None if there is no (enabled) lock for it.'''
+        indexed_lock = self.locks_by_channel_id.get(channel_id)
+        if indexed_lock is None:
+            return None
+        lock = indexed_lock[0]
+        if return_only_enabled_locks and not lock.enabled:
+            return None
+        return lock
+
+    def add_lock(self, lock):
+        '''Appends a lock to the configuration and indexes it.
+        If the channel already has a lock, it is replaced instead.'''
+        if lock.channel_id in self.locks_by_channel_id:
+            self.update_lock(lock)
+            return
+        locks = self.configuration.locks
+        locks.append(lock)
+        self.index_lock(lock, len(locks) - 1)
+
+    def update_lock(self, lock):
+        '''Replaces the lock for the channel of the passed lock, keeping its position.'''
+        position = self.locks_by_channel_id[lock.channel_id][1]
+        self.configuration.locks[position] = lock
+        self.index_lock(lock, position)
+
+    def remove_lock(self, channel_id):
+        '''Removes the lock for a channel ID and returns it.
+        The last lock in the list is moved into the removed lock's position, so removal does not shift the other locks.'''
+        lock, position = self.locks_by_channel_id.pop(channel_id)
+        self.authenticated_users.pop(channel_id, None)
+        self.authentication_expirations.pop(channel_id, None)
+        self.changed_authenticated_users.discard(channel_id)
+        self.channel_ids.discard(channel_id)
+        self.enabled_channel_ids.discard(channel_id)
+        locks = self.configuration.locks
+        last_lock = locks.pop()
+        if position < len(locks): #The removed lock was not the last one
+            locks[position] = last_lock
+            self.locks_by_channel_id[last_lock.channel_id] = (last_lock, position)
+        return lock
+
+    def add_authenticated_user(self, channel_id, user_id, expires_at=None):
+        '''Adds a user to the authenticated users of a lock, with the timestamp when the authentication expires if it does.
+        Returns False if the user was already authenticated.'''
+        authenticated_users = self.get_authenticated_users(channel_id)
+        if user_id in authenticated_users:
+            return False
+        authenticated_users.add(user_id)
+        if expires_at is not None:
+            self.get_authentication_expirations(channel_id)[user_id] = expires_at
+        self.changed_authenticated_users.add(channel_id)
+        return True
+
+    def remove_authenticated_users(self, channel_id, user_ids):
+        '''Removes users from the authenticated users of a lock.'''
+        if channel_id not in self.channel_ids:
+            return
+        authenticated_users = self.get_authenticated_users(channel_id)
+        authentication_expirations = self.get_authentication_expirations(channel_id)
+        for user_id in user_ids:
+            authenticated_users.discard(user_id)
+            authentication_expirations.pop(user_id, None)
+        self.changed_authenticated_users.add(channel_id)
+
+    def clear_authenticated_users(self, channel_id):
+        '''Forgets every user that has authenticated with the lock in a channel.'''
+        if channel_id in self.channel_ids:
+            self.authenticated_users[channel_id] = set()
+            self.authentication_expirations[channel_id] = {}
+            self.changed_authenticated_users.add(channel_id)
+
+    def set_configuration(self, configuration):
+        '''Replaces the whole configuration and rebuilds the index.
+        Authenticated users are kept for the channels that still have a lock.'''
+        authenticated_users = self.authenticated_users
+        authentication_expirations = self.authentication_expirations
+        changed_authenticated_users = self.changed_authenticated_users
+        self.__init__(self.guild_id, configuration, self.storage_backend)
+        self.authenticated_users = {channel_id: user_ids for channel_id, user_ids in authenticated_users.items() if channel_id in self.channel_ids}
+        self.authentication_expirations = {channel_id: expirations for channel_id, expirations in authentication_expirations.items() if channel_id in self.channel_ids}
+        self.changed_authenticated_users = changed_authenticated_users & self.channel_ids
+
+    def apply_journal_record(self, record):
+        '''Applies a journal record to the index.
+        Records are idempotent, so a record that is already part of the snapshots can safely be applied again.
+        Records hold locks and configurations in the JSON layout, so they are converted to models here.'''
+        operation = record["op"]
+        if operation in (JOURNAL_ADD_LOCK, JOURNAL_UPDATE_LOCK):
+            self.add_lock(Lock.from_dict(record["lock"]))
+        elif operation == JOURNAL_REMOVE_LOCK:
+            if record["channel_id"] in self.locks_by_channel_id:
+                self.remove_lock(record["channel_id"])
+        elif operation == JOURNAL_AUTHENTICATE:
+            self.add_authenticated_user(record["channel_id"], record["user_id"], record.get("expires_at"))
+        elif operation == JOURNAL_DEAUTHENTICATE:
+            self.remove_authenticated_users(record["channel_id"], record["user_ids"])
+        elif operation == JOURNAL_SET_CONFIGURATION:
+            self.set_configuration(GuildConfig.from_dict(record["configuration"]))
+        elif operation == JOURNAL_CLEAR_AUTHENTICATED_USERS:
+            self.clear_authenticated_users(record["channel_id"])
+        else:
+            logger.warning("Unknown journal record operation %s for guild %s! Ignoring...", operation, self.guild_id)
+
+class TrackedChannels:
+    '''The channels with a lock, for every guild whose configuration has been loaded since the bot started.
+    Unlike the configurations, they are kept when a guild is evicted from the cache, since they only take one set entry per lock.
+    This lets messages be filtered by channel without touching the cache (see is_channel_tracked).'''
+    def __init__(self):
+        self.channel_ids = set()
+        self.guild_channel_ids = {} #Guild ID (int) --> frozenset of the guild's tracked channel IDs
+
+    def is_known(self, guild_id):
+        '''Returns whether the tracked channels of a guild are known.'''
+        return int(guild_id) in self.guild_channel_ids
+
+    def set_guild(self, guild_id, channel_ids):
+        '''Sets the tracked channels of a guild. Must be called with the cache lock held.'''
+        guild_id = int(guild_id)
+        channel_ids = frozenset(channel_ids)
+        old_channel_ids = self.guild_channel_ids.get(guild_id)
+        if old_channel_ids == channel_ids:
+            return
+        if old_channel_ids is not None: #Channels that stay tracked are never removed, since the set is read without the cache lock
+            self.channel_ids.difference_update(old_channel_ids - channel_ids)
+        self.channel_ids.update(channel_ids)
+        self.guild_channel_ids[guild_id] = channel_ids
+
+    def clear(self):
+        self.channel_ids.clear()
+        self.guild_channel_ids.clear()
+
+tracked_channels = TrackedChannels()
+
+class GuildConfigurationCache:
+    '''A process-wide LRU cache for guild configurations.
+    Reads are served from memory after the first load. Changes are applied in memory and recorded by the storage backend.
+    If the backend uses a journal, the journal is compacted into new snapshots by the flusher once it has grown long enough (and on shutdown).'''
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict() #Guild ID --> GuildLockIndex (or None if the guild has no configuration)
+        self.journal_lengths = {} #Guild ID --> number of journal records written since the last compaction
+        self.changed_guild_ids = None #Guild IDs changed while a preload is running (see preload_guild_configurations)
+        self.loading_guild_ids = {} #Guild ID --> whether the guild has been cached or changed while it is read outside of the lock (see load_guild_lock_index)
+        self.lock = threading.RLock()
+
+    def get(self, guild_id):
+        '''Returns a (found, index) tuple for a guild and marks it as recently used.'''
+        with self.lock:
+            if guild_id not in self.entries:
+                return False, None
+            self.entries.move_to_end(guild_id)
+            return True, self.entries[guild_id]
+
+    def put(self, guild_id, configuration):
+        '''Stores a configuration in the cache and returns its lock index.'''
+        with self.lock:
+            index = GuildLockIndex(guild_id, configuration) if configuration is not None else None
+            if guild_id in self.loading_guild_ids:
+                self.loading_guild_ids[guild_id] = True
+            tracked_channels.set_guild(guild_id, index.channel_ids if index is not None else ())
+            self.entries[guild_id] = index
+            self.entries.move_to_end(guild_id)
+            self.evict()
+            return index
+
+    def evict(self):
+        '''Evicts the least recently used guilds until the cache is within its size limit.
+        Evicted guilds do not need to be written here, since their journal is replayed when they are loaded again,
+        and the flusher still compacts it from storage (see compact_guild).'''
+        while len(self.entries) > self.max_size:
+            guild_id, index = self.entries.popitem(last=False)
+            logger.debug("Evicting guild %s from the configuration cache...", guild_id)
+
+    def mark_changed(self, guild_id):
+        '''Remembers that a guild has been changed in storage, if a preload is running or the guild is being loaded.'''
+        if self.changed_guild_ids is not None:
+            self.changed_guild_ids.add(guild_id)
+        if guild_id in self.loading_guild_ids:
+            self.loading_guild_ids[guild_id] = True
+
+    def record_change(self, guild_id, record):
+        '''Stores a change record for a guild with the storage backend.'''
+        with self.lock:
+            self.mark_changed(guild_id)
+            storage_backend.record_change(guild_id, record)
+            if storage_backend.uses_journal:
+                self.journal_lengths[guild_id] = self.journal_lengths.get(guild_id, 0) + 1
+
+    def compact_guild(self, guild_id):
+        '''Writes new snapshots for a guild and empties its journal.
+        A guild that has been evicted is read from storage and its journal replayed first, without caching it again.'''
+        with self.lock:
+            found, index = self.get(guild_id)
+            if not found:
+                configuration, change_records = storage_backend.load_guild(guild_id)
+                index = GuildLockIndex(guild_id, GuildConfig.from_dict(configuration)) if configuration is not None else None
+                for record in change_records if index is not None else ():
+                    index.apply_journal_record(record)
+                self.mark_changed(guild_id) #A load running outside of the lock might read the new snapshots with the old journal
+            if index is None:
+                self.journal_lengths.pop(guild_id, None)
+                return
+            logger.debug("Compacting journal for guild %s...", guild_id)
+            changed_authenticated_users = {channel_id: index.authenticated_users[channel_id] for channel_id in index.changed_authenticated_users}
+            changed_authentication_expirations = {channel_id: index.get_authentication_expirations(channel_id) for channel_id in index.changed_authenticated_users}
+            storage_backend.write_guild(guild_id, index.configuration.to_dict(), changed_authenticated_users, changed_authentication_expirations)
+            index.changed_authenticated_users = set()
+            self.journal_lengths.pop(guild_id, None)
+
+    def flush(self, force=False):
+        '''Compacts the journals that have reached the compaction threshold, or all journals if force is True.'''
+        with self.lock:
+            for guild_id, journal_length in list(self.journal_lengths.items()):
+                if force or journal_length >= JOURNAL_COMPACTION_THRESHOLD:
+                    try:
+                        self.compact_guild(guild_id)
+                    except Exception:
+                        logger.critical("Failed to compact journal for guild %s!", guild_id, exc_info=True)
+
+    def clear(self):
+        '''Compacts all journals and then empties the cache.'''
+        with self.lock:
+            self.flush(force=True)
+            self.entries.clear()
+
+guild_configuration_cache = GuildConfigurationCache(GUILD_CACHE_MAX_SIZE)
+
+class GuildConfigurationFlusher(threading.Thread):
+    '''Background thread that periodically compacts guild journals.'''
+    def __init__(self, cache, interval):
+        super().__init__(name="GuildConfigurationFlusher", daemon=True)
+        self.cache = cache
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.cache.flush()
+
+    def stop(self):
+        '''Stops the flusher and compacts everything that is left.'''
+        self.stopped.set()
+        self.join()
+        self.cache.flush(force=True)
+
+guild_configuration_flusher = None
+
+def start_guild_configuration_flusher(interval=GUILD_CACHE_FLUSH_INTERVAL):
+    '''Starts the background flusher for the guild configuration cache.'''
+    global guild_configuration_flusher
+    if guild_configuration_flusher is not None:
+        return
+    logger.info("Starting guild configuration flusher...")
+    guild_configuration_flusher = GuildConfigurationFlusher(guild_configuration_cache, interval)
+    guild_configuration_flusher.start()
+    #Make sure that the journals are compacted when the process exits. atexit handlers run in reverse order, so registering
+    #here (after logging is set up, see log_setup.py) stops the flusher before logging is stopped, and its log records are kept
+    atexit.unregister(stop_guild_configuration_flusher)
+    atexit.register(stop_guild_configuration_flusher)
+
+def stop_guild_configuration_flusher():
+    '''Stops the background flusher (if it is running) and compacts all journals.'''
+    global guild_configuration_flusher
+    if guild_configuration_flusher is not None:
+        logger.info("Stopping guild configuration flusher...")
+        guild_configuration_flusher.stop()
+        guild_configuration_flusher = None
+    guild_configuration_cache.flush(force=True)
+
+#Storage
+storage_backend = create_storage_backend()
+
+def set_storage_backend(new_storage_backend):
+    '''Function for switching to another storage backend. Pending changes are written and the cache is emptied first.'''
+    global storage_backend
+    with guild_configuration_cache.lock:
+        guild_configuration_cache.clear()
+        tracked_channels.clear()
+        storage_backend.close()
+        storage_backend = new_storage_backend
+
+#Mutation locks
+guild_mutation_locks = weakref.WeakValueDictionary() #Guild ID --> asyncio.Lock
+
+def get_guild_mutation_lock(guild_id):
+    '''Function for getting the asyncio lock that orders changes to a guild.
+    Hold it around read-modify-write sequences (such as checking that a channel has no lock and then adding one).'''
+    guild_id = str(guild_id)
+    lock = guild_mutation_locks.get(guild_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        guild_mutation_locks[guild_id] = lock
+    return lock
+
 #Functions
 def get_now():
     '''Function for getting the current time.
     The PolicemanBot uses UTC for simplicity.'''
     return datetime.datetime.now(tz=pytz.timezone("UTC"))
 
-def read_json_from_file(filepath):
-    '''Read JSON from a file and returns it as a dict'''
-    logger.debug(f"Reading JSON from filepath {filepath}...")
-    return json.loads(open(filepath, "r").read())
+def migrate_authenticated_users(guild_index):
+    '''Moves authenticated users stored in the guild configuration (as they were by older versions of the bot)
+    into the authenticated users of their locks.'''
+    migrated = False
+    for lock in list(guild_index.configuration.locks):
+        if lock.extra is None or "authenticated_users" not in lock.extra:
+            continue
+        logger.info("Migrating authenticated users for channel %s in guild %s...", lock.channel_id, guild_index.guild_id)
+        for user_id in lock.extra["authenticated_users"]:
+            guild_index.add_authenticated_user(lock.channel_id, user_id)
+        extra = {key: value for key, value in lock.extra.items() if key != "authenticated_users"}
+        guild_index.update_lock(lock.replace(extra=extra if len(extra) > 0 else None)) #Locks are shared, so they are replaced instead of changed
+        migrated = True
+    if migrated:
+        guild_configuration_cache.compact_guild(guild_index.guild_id)
 
-def write_json_to_file(data, filepath):
-    '''Updates JSON to a file.'''
-    logger.debug(f"Updating JSON from filepath {filepath}...")
-    with open(filepath, "w") as json_file:
-        json_file.write(json.dumps(data))
+def get_guild_configuration(guild_id):
+    '''Function for getting the guild configuration (a GuildConfig, see models.py) for a certain guild.
+    The configuration is served from the guild configuration cache if it has been loaded before, and should not be modified.'''
+    guild_index = get_guild_lock_index(guild_id)
+    return guild_index.configuration if guild_index is not None else None
 
-def get_guild_paths(guild_id):
-    '''Function for getting the filepaths associated with a guild.'''
-    logger.info(f"Getting guild paths for {guild_id}...")
-    guild_path = os.path.join(GUILDS_PATH, str(guild_id))
-    guild_configuration_path = os.path.join(guild_path, "config.json")
-    return guild_path, guild_configuration_path
+def get_guild_lock_index(guild_id):
+    '''Function for getting the lock index for a certain guild, loading the guild configuration if it is not cached.
+    Returns None if the guild does not have a configuration.'''
+    guild_id = str(guild_id)
+    found, guild_index = guild_configuration_cache.get(guild_id)
+    if found:
+        return guild_index
+    with guild_configuration_cache.lock:
+        found, guild_index = guild_configuration_cache.get(guild_id) #Another thread might have loaded the guild while we waited for the lock
+        if found:
+            return guild_index
+        configuration, change_records = storage_backend.load_guild(guild_id)
+        return cache_loaded_guild(guild_id, configuration, change_records)
 
-def get_guild_configuration(guild_id):
-    '''Function for getting the guild configuration for a certain guild.'''
-    logger.info(f"Getting configuration for {guild_id}...")
-    guild_path, guild_configuration_path = get_guild_paths(guild_id) #Get guild file paths
-    if not os.path.exists(guild_path):
-        logger.info("Guild directory does not exist.")
-        return None
-    elif not os.path.exists(guild_configuration_path):
-        logger.info("Guild configuration does not exist.")
-        return None
-    logger.info("Configuration file exists. Returning...")
-    return read_json_from_file(guild_configuration_path)
+def load_guild_lock_index(guild_id):
+    '''Function for getting the lock index for a certain guild like get_guild_lock_index, but reading an uncached guild
+    from storage outside of the cache lock, so that other threads can use the cache in the meantime (see data_async.py).'''
+    guild_id = str(guild_id)
+    with guild_configuration_cache.lock:
+        found, guild_index = guild_configuration_cache.get(guild_id)
+        if found:
+            return guild_index
+        if guild_id in guild_configuration_cache.loading_guild_ids: #Another thread is reading the guild already
+            return get_guild_lock_index(guild_id)
+        guild_configuration_cache.loading_guild_ids[guild_id] = False
+        backend = storage_backend
+    try:
+        configuration, change_records = backend.load_guild(guild_id)
+    except Exception:
+        with guild_configuration_cache.lock:
+            guild_configuration_cache.loading_guild_ids.pop(guild_id, None)
+        raise
+    with guild_configuration_cache.lock:
+        #A guild that was cached or changed in the meantime might have changes that we didn't read
+        if guild_configuration_cache.loading_guild_ids.pop(guild_id) or backend is not storage_backend:
+            return get_guild_lock_index(guild_id)
+        return cache_loaded_guild(guild_id, configuration, change_records)
+
+def cache_loaded_guild(guild_id, configuration, change_records):
+    '''Function for putting a guild loaded from storage (in the JSON layout) into the cache and replaying its journal. Returns its lock index.
+    Must be called with the cache lock held.'''
+    guild_index = guild_configuration_cache.put(guild_id, GuildConfig.from_dict(configuration) if configuration is not None else None)
+    if guild_index is not None:
+        for record in change_records:
+            guild_index.apply_journal_record(record)
+        if len(change_records) > 0:
+            guild_configuration_cache.journal_lengths[guild_id] = len(change_records)
+            tracked_channels.set_guild(guild_id, guild_index.channel_ids)
+        migrate_authenticated_users(guild_index)
+    return guild_index
+
+def preload_guild_configurations(guild_ids, worker_count=PRELOAD_WORKERS):
+    '''Function for loading the configurations of many guilds at once, for example all guilds of the bot when it starts.
+    The configurations are read from storage by a thread pool, outside of the cache lock, so commands are not held up.
+    Guilds that are already cached are skipped, and no more guilds are loaded than fit in the cache. Returns the number of guilds loaded.'''
+    with guild_configuration_cache.lock:
+        free_entries = guild_configuration_cache.max_size - len(guild_configuration_cache.entries)
+        guild_ids = [str(guild_id) for guild_id in guild_ids if str(guild_id) not in guild_configuration_cache.entries][:max(0, free_entries)]
+        guild_configuration_cache.changed_guild_ids = set()
+    logger.info("Preloading %s guild configurations with %s threads...", len(guild_ids), worker_count)
+    started_at = time.perf_counter()
+    loaded_guilds = 0
+    backend = storage_backend
+    try:
+        with ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="GuildPreloader") as executor:
+            for guild_id, (configuration, change_records) in zip(guild_ids, executor.map(backend.load_guild, guild_ids)):
+                with guild_configuration_cache.lock:
+                    #A guild that was loaded or changed in the meantime might have changes that we didn't read
+                    if guild_id in guild_configuration_cache.entries or guild_id in guild_configuration_cache.changed_guild_ids or backend is not storage_backend:
+                        continue
+                    cache_loaded_guild(guild_id, configuration, change_records)
+                    loaded_guilds += 1
+    finally:
+        guild_configuration_cache.changed_guild_ids = None
+    logger.info("Preloaded %s guild configurations in %.2f seconds.", loaded_guilds, time.perf_counter() - started_at)
+    return loaded_guilds
+
+def write_guild_snapshot(path=GUILD_SNAPSHOT_PATH):
+    '''Function for writing every cached guild, with the authenticated users that have been loaded, into one snapshot file.
+    load_guild_snapshot reads it on the next start instead of reading every guild from storage.
+    Only call this when the bot has stopped, so that the snapshot matches what is in storage. Returns whether a snapshot was written.'''
+    with guild_configuration_cache.lock:
+        guild_configuration_cache.flush(force=True)
+        if len(guild_configuration_cache.journal_lengths) > 0:
+            logger.warning("Some guild journals could not be compacted! Not writing a guild snapshot...")
+            return False
+        guilds = {}
+        for guild_id, guild_index in guild_configuration_cache.entries.items():
+            guilds[guild_id] = None if guild_index is None else (guild_index.configuration.to_dict(), guild_index.authenticated_users)
+        snapshot = marshal.dumps({"storage_backend": type(storage_backend).__name__, "guilds": guilds})
+    header = GUILD_SNAPSHOT_HEADER.pack(GUILD_SNAPSHOT_MAGIC, GUILD_SNAPSHOT_VERSION, sys.version_info.major, sys.version_info.minor)
+    write_file_atomically(header + snapshot, path, "wb")
+    logger.info("Wrote a snapshot of %s guilds (%s bytes) to %s.", len(guilds), len(header) + len(snapshot), path)
+    return True
+
+def read_guild_snapshot(path):
+    '''Function for reading a snapshot written by write_guild_snapshot. The file is memory-mapped instead of read into a buffer first.
+    Returns the snapshot, or None if it was written by another snapshot format or Python version.'''
+    expected_header = (GUILD_SNAPSHOT_MAGIC, GUILD_SNAPSHOT_VERSION, sys.version_info.major, sys.version_info.minor)
+    with open(path, "rb") as snapshot_file, mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as snapshot_map:
+        if GUILD_SNAPSHOT_HEADER.unpack_from(snapshot_map) != expected_header:
+            return None
+        with memoryview(snapshot_map) as snapshot_view, snapshot_view[GUILD_SNAPSHOT_HEADER.size:] as payload_view:
+            return marshal.loads(payload_view)
+
+def load_guild_snapshot(path=GUILD_SNAPSHOT_PATH):
+    '''Function for filling the cache from a snapshot written by write_guild_snapshot. Returns the number of guilds loaded.
+    The snapshot is deleted after it has been read, so that it can never be used again once the data in storage has changed.'''
+    if not os.path.exists(path):
+        return 0
+    try:
+        snapshot = read_guild_snapshot(path)
+    except (OSError, ValueError, EOFError, TypeError, struct.error):
+        logger.warning("Could not read the guild snapshot! Ignoring it...", exc_info=True)
+        return 0
+    finally:
+        os.remove(path)
+    if snapshot is None or snapshot["storage_backend"] != type(storage_backend).__name__:
+        logger.warning("The guild snapshot was written by another version or storage backend! Ignoring it...")
+        return 0
+    loaded_guilds = 0
+    with guild_configuration_cache.lock:
+        for guild_id, guild in snapshot["guilds"].items():
+            if guild_id in guild_configuration_cache.entries:
+                continue
+            if guild is None:
+                guild_configuration_cache.put(guild_id, None)
+            else:
+                configuration, authenticated_users = guild
+                guild_configuration_cache.put(guild_id, GuildConfig.from_dict(configuration)).authenticated_users = authenticated_users
+            loaded_guilds += 1
+    logger.info("Loaded %s guilds from the guild snapshot.", loaded_guilds)
+    return loaded_guilds
 
 def create_guild_configuration(guild_id):
-    '''Function for creating a guild configuration.'''
-    logger.info(f"Creating guild configuration for {guild_id}...")
-    guild_path, guild_configuration_path = get_guild_paths(guild_id) #Get guild file paths
-    if not os.path.exists(guild_path): #If the guild directory does not exist
-        logger.info("Guild directory does not exist. Creating...")
-        os.mkdir(guild_path)
-        logger.info("Guild directory created.")
-    if not os.path.exists(guild_configuration_path): #If the guild configuration file does not exist
-        logger.info("Guild configuration file does not exist. Creating...")
-        guild_data = DEFAULT_GUILD_CONFIGURATION
-        guild_data["configuration_created_at"] = str(get_now())
-        write_json_to_file(guild_data, guild_configuration_path)
-        logger.info("Guild configuration file created.")
+    '''Function for creating a guild configuration, if the guild does not have one already.'''
+    guild_id = str(guild_id)
+    logger.info("Creating guild configuration for %s...", guild_id)
+    with guild_configuration_cache.lock:
+        if get_guild_lock_index(guild_id) is not None:
+            logger.info("Guild configuration already exists.")
+            return
+        configuration = GuildConfig(created_at=time.time())
+        guild_configuration_cache.mark_changed(guild_id)
+        storage_backend.create_guild(guild_id, configuration.to_dict())
+        guild_configuration_cache.put(guild_id, configuration)
     logger.info("Done with creation.")
 
 def get_channel_ids_with_message(guild_id, return_only_enabled_locks=False):
-    '''Function for getting the list of channel IDs for a guild
-    where a lock message has been created
-    '''
-    logger.info(f"Getting channel IDs with bot message for guild {guild_id}...")
-    #Get the guild data
-    guild_configuration = get_guild_configuration(guild_id)
-    #Now, check if the channel is set up for authentication
-    logger.info("Guild configuration retrieved.")
-    #Find the channel
-    locked_channel_ids = []
-    if guild_configuration == None: #This will be None if a configuration does not exist for the guild
-        logger.info("Configuration is None, returning empty list...")
-        return []
-    logger.info("Iterating through enabled locks...")
-    for lock in guild_configuration["enabled_locks"]:
-        if lock["enabled"] or return_only_enabled_locks == False:
-            locked_channel_ids.append(lock["channel_id"])
-    logger.info(f"Found {len(locked_channel_ids)} locked channels.")
-    logger.info(f"Locked channel list for server: {locked_channel_ids}")
-    #Return the list of locks
-    return locked_channel_ids
+    '''Function for getting the set of channel IDs for a guild
+    where a lock message has been created.
+    The returned set is owned by the cache and should not be modified.'''
+    logger.debug("Getting channel IDs with bot message for guild %s...", guild_id)
+    guild_index = get_guild_lock_index(guild_id)
+    if guild_index is None: #This will be None if a configuration does not exist for the guild
+        logger.debug("Configuration is None, returning empty set...")
+        return frozenset()
+    return guild_index.enabled_channel_ids if return_only_enabled_locks else guild_index.channel_ids
 
 def get_lock_for_channel_id(guild_id, channel_id, return_only_enabled_locks=True):
     '''Function for finding the enabled lock for the channel ID.'''
-    logger.info(f"Getting lock for guild ID {guild_id}, channel ID {channel_id}...")
-    #Get the guild data
-    guild_configuration = get_guild_configuration(guild_id)
-    #Now, check if the channel is set up for authentication
-    logger.info("Guild configuration retrieved.")
-    #Find the locked channel
-    for lock in guild_configuration["enabled_locks"]:
-        if lock["enabled"] or not return_only_enabled_locks:
-            if lock["channel_id"] == channel_id:
-                logger.info("Found enabled lock! Returning...")
-                return lock
-    logger.warning("Did not find enabled lock! Returning None...")
-    return None
-
-def generate_lock_data(channel_id, hashed_password, custom_message, award_role_ids, sent_information_message, enabled=True):
-    '''Function for generating a dict of lock data. This will then get dumped into a JSON.
+    logger.debug("Getting lock for guild ID %s, channel ID %s...", guild_id, channel_id)
+    guild_index = get_guild_lock_index(guild_id)
+    lock = guild_index.get_lock(channel_id, return_only_enabled_locks) if guild_index is not None else None
+    if lock is None:
+        logger.debug("Did not find enabled lock! Returning None...")
+    return lock
+
+def is_channel_tracked(guild_id, channel_id):
+    '''Function for checking if a channel has a lock (enabled or not). Once a guild has been loaded, this is a set lookup
+    that does not touch the guild configuration cache, so it is cheap enough to run for every message.'''
+    if channel_id in tracked_channels.channel_ids:
+        return True
+    if not tracked_channels.is_known(guild_id): #Loading the guild fills in its tracked channels
+        get_guild_lock_index(guild_id)
+    return channel_id in tracked_channels.channel_ids
+
+def is_user_authenticated(guild_id, channel_id, user_id):
+    '''Function for checking if a user has authenticated with the lock in a channel.'''
+    guild_index = get_guild_lock_index(guild_id)
+    return guild_index is not None and user_id in guild_index.get_authenticated_users(channel_id)
+
+def get_authenticated_users(guild_id, channel_id):
+    '''Function for getting a copy of the set of users that have authenticated with the lock in a channel.'''
+    with guild_configuration_cache.lock:
+        guild_index = get_guild_lock_index(guild_id)
+        return set(guild_index.get_authenticated_users(channel_id)) if guild_index is not None else set()
+
+def record_guild_change(guild_id, record):
+    '''Function for applying a change to a cached guild and appending it to the guild's journal.
+    If the flusher is not running, the journal is compacted here once it reaches the compaction threshold.'''
+    guild_id = str(guild_id)
+    with guild_configuration_cache.lock:
+        guild_index = get_guild_lock_index(guild_id)
+        if guild_index is None:
+            raise GuildDoesNotExistError(f"Guild {guild_id} does not have a configuration.")
+        guild_index.apply_journal_record(record)
+        tracked_channels.set_guild(guild_id, guild_index.channel_ids)
+        guild_configuration_cache.record_change(guild_id, record)
+        if guild_configuration_flusher is None and guild_configuration_cache.journal_lengths.get(guild_id, 0) >= JOURNAL_COMPACTION_THRESHOLD:
+            guild_configuration_cache.compact_guild(guild_id)
+
+def add_authenticated_user(guild_id, channel_id, user_id, expires_at=None):
+    '''Function for recording that a user has authenticated with the lock in a channel.
+    expires_at is the Unix timestamp when the authentication expires, or None if it doesn't.
+    Only a small journal record is written, so this costs the same no matter how many users have authenticated before.'''
+    logger.info("Adding authenticated user %s for channel %s in guild %s...", user_id, channel_id, guild_id)
+    with guild_configuration_cache.lock:
+        if is_user_authenticated(guild_id, channel_id, user_id):
+            return
+        record = {"op": JOURNAL_AUTHENTICATE, "channel_id": channel_id, "user_id": user_id}
+        if expires_at is not None:
+            record["expires_at"] = expires_at
+        record_guild_change(guild_id, record)
+
+def get_authentication_expirations(guild_id):
+    '''Function for getting every authentication that expires in a guild, as a list of (channel ID, user ID, expiry timestamp).'''
+    with guild_configuration_cache.lock:
+        guild_index = get_guild_lock_index(guild_id)
+        if guild_index is None:
+            return []
+        return [
+            (channel_id, user_id, expires_at)
+            for channel_id in guild_index.channel_ids
+            for user_id, expires_at in guild_index.get_authentication_expirations(channel_id).items()
+        ]
+
+def remove_expired_authentications(guild_id, channel_id, expirations):
+    '''Function for removing authentications that have expired. expirations is a list of (user ID, expiry timestamp), and only users
+    whose authentication still expires at that time are removed, so that users that have authenticated again are kept.
+    All users are removed with one journal record. Returns the IDs of the removed users.'''
+    with guild_configuration_cache.lock:
+        guild_index = get_guild_lock_index(guild_id)
+        if guild_index is None or channel_id not in guild_index.channel_ids:
+            return []
+        current_expirations = guild_index.get_authentication_expirations(channel_id)
+        user_ids = [user_id for user_id, expires_at in expirations if current_expirations.get(user_id) == expires_at]
+        if len(user_ids) > 0:
+            logger.info("Removing %s expired authentications for channel %s in guild %s...", len(user_ids), channel_id, guild_id)
+            record_guild_change(guild_id, {"op": JOURNAL_DEAUTHENTICATE, "channel_id": channel_id, "user_ids": user_ids})
+        return user_ids
+
+def clear_authenticated_users(guild_id, channel_id):
+    '''Function for forgetting every user that has authenticated with the lock in a channel, so that they have to authenticate again.'''
+    logger.info("Clearing authenticated users for channel %s in guild %s...", channel_id, guild_id)
+    record_guild_change(guild_id, {"op": JOURNAL_CLEAR_AUTHENTICATED_USERS, "channel_id": channel_id})
+
+def add_guild_lock(guild_id, lock):
+    '''Function for adding a Lock to the configuration of a guild. The guild configuration must exist.'''
+    logger.info("Adding lock for channel %s in guild %s...", lock.channel_id, guild_id)
+    with guild_configuration_cache.lock:
+        if get_lock_for_channel_id(guild_id, lock.channel_id, return_only_enabled_locks=False) is None:
+            storage_backend.delete_authenticated_users(str(guild_id), lock.channel_id) #Left behind if a crash happened while removing an earlier lock
+        record_guild_change(guild_id, {"op": JOURNAL_ADD_LOCK, "lock": lock.to_dict()})
+
+def update_guild_lock(guild_id, lock):
+    '''Function for replacing the existing lock for the channel of a Lock in a guild.'''
+    logger.info("Updating lock for channel %s in guild %s...", lock.channel_id, guild_id)
+    record_guild_change(guild_id, {"op": JOURNAL_UPDATE_LOCK, "lock": lock.to_dict()})
+
+def remove_guild_lock(guild_id, channel_id):
+    '''Function for removing the lock for a channel ID from a guild. Returns the removed lock.'''
+    logger.info("Removing lock for channel %s in guild %s...", channel_id, guild_id)
+    with guild_configuration_cache.lock:
+        lock = get_lock_for_channel_id(guild_id, channel_id, return_only_enabled_locks=False)
+        record_guild_change(guild_id, {"op": JOURNAL_REMOVE_LOCK, "channel_id": channel_id})
+        storage_backend.delete_authenticated_users(str(guild_id), channel_id)
+    return lock
+
+def generate_lock_data(channel_id, hashed_password, custom_message, award_role_ids, sent_information_message, enabled=True, authentication_duration=None):
+    '''Function for generating a new Lock (see models.py).
     Channel_ID is passed as an integer, hashed_password is passed as a string, custom_message is passed as a string,
-    sent_information_message is a discord.Message object, and embed is a boolean'''
-    lock_data = {
-        "enabled": enabled,
-        "channel_id": channel_id,
-        "password": hashed_password,
-        "custom_message": custom_message,
-        "award_role_ids": award_role_ids,
-        "sent_information_message": {
-            "id": sent_information_message.id
-        },
-        "created_at": str(get_now())
-    }
-    return lock_data
+    sent_information_message is a discord.Message object, and embed is a boolean.
+    authentication_duration is the number of seconds until the roles are taken back from a user that authenticated, or None to never take them back.'''
+    return Lock(
+        channel_id,
+        hashed_password,
+        award_role_ids,
+        sent_information_message.id,
+        custom_message=custom_message,
+        enabled=enabled,
+        created_at=time.time(),
+        authentication_duration=authentication_duration
+    )
 
 def update_guild_config(guild_id, new_config):
-    '''Function for updating the guild config for a certain ID'''
-    logger.info(f"Updating guild configuration for {guild_id}...")
-    guild_path, guild_configuration_path = get_guild_paths(guild_id)
-    write_json_to_file(new_config, guild_configuration_path)
+    '''Function for updating the guild config (a GuildConfig) for a certain ID.
+    The new configuration is recorded by the storage backend.'''
+    logger.info("Updating guild configuration for %s...", guild_id)
+    if get_guild_lock_index(guild_id) is None:
+        create_guild_configuration(guild_id)
+    record_guild_change(guild_id, {"op": JOURNAL_SET_CONFIGURATION, "configuration": new_config.to_dict()})
     logger.info("Guild configuration updated.")
@@ -0,0 +1,134 @@
+'''Data_async.py
+Awaitable versions of the data API in data.py, for the coroutines of the bot.
+
+The functions in data.py read and write storage directly, which stalls the whole event loop when the disk is slow.
+The functions here answer from the guild configuration cache on the event loop when they can, and run everything else
+in a small, bounded I/O thread pool. Concurrent loads of the same guild, or of the authenticated users of the same lock,
+share one load. Scripts and threads keep using the synchronous functions in data.py.'''
+
+import os, asyncio, logging, functools
+from concurrent.futures import ThreadPoolExecutor
+import data
+
+#Settings
+IO_WORKERS = int(os.environ.get("POLICEBOT_IO_WORKERS", 4)) #Number of threads reading and writing guild data
+
+#Logging
+logger = logging.getLogger(__name__)
+
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="GuildIO")
+in_flight_loads = {} #Load key --> future of the load, for loads that are running
+
+async def run_io(function, *args, **kwargs):
+    '''Runs a blocking function in the I/O thread pool and returns its result.'''
+    return await asyncio.get_event_loop().run_in_executor(io_executor, functools.partial(function, *args, **kwargs))
+
+async def run_coalesced(key, function, *args):
+    '''Runs a blocking load in the I/O thread pool, or waits for the load with the same key if one is already running.'''
+    future = in_flight_loads.get(key)
+    if future is None:
+        future = asyncio.ensure_future(run_io(function, *args))
+        in_flight_loads[key] = future
+        future.add_done_callback(lambda _: in_flight_loads.pop(key, None))
+    return await asyncio.shield(future) #A waiter that is cancelled does not cancel the load for the others
+
+def get_cached_guild_lock_index(guild_id):
+    '''Returns a (found, index) tuple for a guild from the cache. found is also False if a thread is holding the cache lock,
+    since waiting for it would block the event loop.'''
+    cache_lock = data.guild_configuration_cache.lock
+    if not cache_lock.acquire(blocking=False):
+        return False, None
+    try:
+        return data.guild_configuration_cache.get(guild_id)
+    finally:
+        cache_lock.release()
+
+def load_authenticated_users(guild_index, channel_id):
+    '''Loads the authenticated users of a lock into its guild's lock index, with the cache lock held like changes to the index are.'''
+    with data.guild_configuration_cache.lock:
+        return guild_index.get_authenticated_users(channel_id)
+
+#Reads
+async def get_guild_lock_index(guild_id):
+    '''Awaitable version of data.get_guild_lock_index.'''
+    guild_id = str(guild_id)
+    found, guild_index = get_cached_guild_lock_index(guild_id)
+    if found:
+        return guild_index
+    return await run_coalesced(("guild", guild_id), data.load_guild_lock_index, guild_id)
+
+async def get_guild_configuration(guild_id):
+    '''Awaitable version of data.get_guild_configuration.'''
+    guild_index = await get_guild_lock_index(guild_id)
+    return guild_index.configuration if guild_index is not None else None
+
+async def get_channel_ids_with_message(guild_id, return_only_enabled_locks=False):
+    '''Awaitable version of data.get_channel_ids_with_message.'''
+    guild_index = await get_guild_lock_index(guild_id)
+    if guild_index is None:
+        return frozenset()
+    return guild_index.enabled_channel_ids if return_only_enabled_locks else guild_index.channel_ids
+
+async def get_lock_for_channel_id(guild_id, channel_id, return_only_enabled_locks=True):
+    '''Awaitable version of data.get_lock_for_channel_id.'''
+    guild_index = await get_guild_lock_index(guild_id)
+    return guild_index.get_lock(channel_id, return_only_enabled_locks) if guild_index is not None else None
+
+async def is_channel_tracked(guild_id, channel_id):
+    '''Awaitable version of data.is_channel_tracked.'''
+    if channel_id in data.tracked_channels.channel_ids:
+        return True
+    if not data.tracked_channels.is_known(guild_id): #Loading the guild fills in its tracked channels
+        await get_guild_lock_index(guild_id)
+    return channel_id in data.tracked_channels.channel_ids
+
+async def is_user_authenticated(guild_id, channel_id, user_id):
+    '''Awaitable version of data.is_user_authenticated.'''
+    guild_index = await get_guild_lock_index(guild_id)
+    if guild_index is None:
+        return False
+    authenticated_users = guild_index.authenticated_users.get(channel_id)
+    if authenticated_users is None:
+        authenticated_users = await run_coalesced(("authenticated_users", guild_index.guild_id, channel_id), load_authenticated_users, guild_index, channel_id)
+    return user_id in authenticated_users
+
+async def get_authenticated_users(guild_id, channel_id):
+    '''Awaitable version of data.get_authenticated_users.'''
+    return await run_io(data.get_authenticated_users, guild_id, channel_id)
+
+async def get_authentication_expirations(guild_id):
+    '''Awaitable version of data.get_authentication_expirations.'''
+    return await run_io(data.get_authentication_expirations, guild_id)
+
+#Changes (hold the guild's mutation lock around read-modify-write sequences, see data.get_guild_mutation_lock)
+async def create_guild_configuration(guild_id):
+    '''Awaitable version of data.create_guild_configuration.'''
+    await run_io(data.create_guild_configuration, guild_id)
+
+async def add_authenticated_user(guild_id, channel_id, user_id, expires_at=None):
+    '''Awaitable version of data.add_authenticated_user.'''
+    await run_io(data.add_authenticated_user, guild_id, channel_id, user_id, expires_at)
+
+async def remove_expired_authentications(guild_id, channel_id, expirations):
+    '''Awaitable version of data.remove_expired_authentications.'''
+    return await run_io(data.remove_expired_authentications, guild_id, channel_id, expirations)
+
+async def clear_authenticated_users(guild_id, channel_id):
+    '''Awaitable version of data.clear_authenticated_users.'''
+    await run_io(data.clear_authenticated_users, guild_id, channel_id)
+
+async def add_guild_lock(guild_id, lock):
+    '''Awaitable version of data.add_guild_lock.'''
+    await run_io(data.add_guild_lock, guild_id, lock)
+
+async def update_guild_lock(guild_id, lock):
+    '''Awaitable version of data.update_guild_lock.'''
+    await run_io(data.update_guild_lock, guild_id, lock)
+
+async def remove_guild_lock(guild_id, channel_id):
+    '''Awaitable version of data.remove_guild_lock.'''
+    return await run_io(data.remove_guild_lock, guild_id, channel_id)
+
+async def update_guild_config(guild_id, new_config):
+    '''Awaitable version of data.update_guild_config.'''
+    await run_io(data.update_guild_config, guild_id, new_config)
@@ -0,0 +1,175 @@
+'''Dispatcher.py
+Routes replies from users to the commands that are waiting for them.
+
+Instead of registering one bot.wait_for (with its own check function and timeout) per waiting command,
+every waiting command opens a session here. Incoming messages are looked up by (user ID, channel kind),
+so routing a message costs the same no matter how many sessions are open, and all sessions share one expiry timer.'''
+
+import asyncio, heapq, itertools, logging, re
+
+#Channel kinds
+DM = "dm"
+GUILD = "guild"
+
+#A reply can start with a session code (like "#2") to pick a session when a user has several open
+SESSION_CODE_PATTERN = re.compile(r"^\s*#(\d+)\s+")
+
+#Logging
+logger = logging.getLogger(__name__)
+
+class Reply:
+    '''A reply to a session. content is the message content without the session code.'''
+    __slots__ = ("message", "content")
+
+    def __init__(self, message, content):
+        self.message = message
+        self.content = content
+
+class ReplySession:
+    '''A command waiting for a reply from a user.
+    Use it as a context manager so that it is closed even if the command fails before waiting.'''
+    def __init__(self, dispatcher, user_id, kind, channel_id, timeout, code, label, after_message_id):
+        self.dispatcher = dispatcher
+        self.user_id = user_id
+        self.kind = kind
+        self.channel_id = channel_id #Only replies in this channel are accepted, or from any channel of the kind if None
+        self.timeout = timeout
+        self.code = code
+        self.label = label #Shown to the user when they have to pick between several sessions
+        self.after_message_id = after_message_id #Only messages sent after this one are accepted, so that the command message itself is never taken as a reply
+        self.future = None
+        self.deadline = None
+        self.early_reply = None #A reply that arrived before wait was called
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.dispatcher.close_session(self)
+
+    async def wait(self):
+        '''Waits for a reply and returns it as a Reply. Raises asyncio.TimeoutError if the session expires.'''
+        if self.early_reply is not None:
+            reply, self.early_reply = self.early_reply, None
+            return reply
+        loop = asyncio.get_event_loop()
+        self.future = loop.create_future()
+        self.deadline = loop.time() + self.timeout
+        self.dispatcher.schedule_expiry(self)
+        try:
+            return await self.future
+        finally:
+            self.future = None
+
+    def resolve(self, reply):
+        '''Hands a reply to the waiting command, or keeps it for the next wait if the command isn't waiting yet.'''
+        if self.future is not None and not self.future.done():
+            self.future.set_result(reply)
+        elif self.future is None and self.early_reply is None:
+            self.early_reply = reply
+
+    def accepts_replies(self):
+        '''Returns whether the session can take a reply: it is waiting, or it is about to wait and has no reply kept yet.'''
+        if self.future is None:
+            return self.early_reply is None
+        return not self.future.done()
+
+    def expire(self):
+        '''Makes the waiting command time out.'''
+        if self.future is not None and not self.future.done():
+            self.future.set_exception(asyncio.TimeoutError())
+
+class ReplyDispatcher:
+    '''Keeps track of open sessions and routes messages to them.'''
+    def __init__(self):
+        self.sessions = {} #(user ID, channel kind) --> list of open sessions
+        self.expiry_heap = [] #(deadline, sequence number, session)
+        self.expiry_handle = None
+        self.expiry_handle_deadline = None
+        self.sequence = itertools.count()
+        self.ambiguous_reply_handler = None
+
+    def attach(self, bot, ambiguous_reply_handler=None):
+        '''Starts routing the messages that the bot receives.
+        ambiguous_reply_handler is a coroutine function called with (message, sessions) when a user
+        with several open sessions replies without a session code.'''
+        self.ambiguous_reply_handler = ambiguous_reply_handler
+        bot.add_listener(self.on_message, "on_message")
+
+    def open_session(self, user_id, kind, timeout, channel_id=None, label=None, after_message_id=None):
+        '''Opens a session waiting for a reply from a user. The session is given the lowest code that the user is not using.
+        Pass the ID of the command message as after_message_id: message IDs grow over time, so older messages are ignored.'''
+        user_sessions = self.sessions.setdefault((user_id, kind), [])
+        used_codes = {session.code for session in user_sessions}
+        code = next(code for code in itertools.count(1) if code not in used_codes)
+        session = ReplySession(self, user_id, kind, channel_id, timeout, code, label, after_message_id)
+        user_sessions.append(session)
+        logger.debug("Opened %s session #%s for user %s.", kind, code, user_id)
+        return session
+
+    def close_session(self, session):
+        '''Closes a session. Closing a session that is already closed does nothing.'''
+        key = (session.user_id, session.kind)
+        user_sessions = self.sessions.get(key)
+        if user_sessions is None or session not in user_sessions:
+            return
+        user_sessions.remove(session)
+        if len(user_sessions) == 0:
+            del self.sessions[key]
+        session.expire()
+
+    def schedule_expiry(self, session):
+        '''Adds a session to the shared expiry timer.'''
+        heapq.heappush(self.expiry_heap, (session.deadline, next(self.sequence), session))
+        if self.expiry_handle_deadline is None or session.deadline < self.expiry_handle_deadline:
+            self.reschedule_expiry()
+
+    def reschedule_expiry(self):
+        '''Sets the shared timer to fire at the earliest deadline.'''
+        if self.expiry_handle is not None:
+            self.expiry_handle.cancel()
+            self.expiry_handle = self.expiry_handle_deadline = None
+        if len(self.expiry_heap) > 0:
+            self.expiry_handle_deadline = self.expiry_heap[0][0]
+            self.expiry_handle = asyncio.get_event_loop().call_at(self.expiry_handle_deadline, self.expire_sessions)
+
+    def expire_sessions(self):
+        '''Expires every session whose deadline has passed.'''
+        self.expiry_handle = self.expiry_handle_deadline = None
+        now = asyncio.get_event_loop().time()
+        while len(self.expiry_heap) > 0 and self.expiry_heap[0][0] <= now:
+            deadline, sequence, session = heapq.heappop(self.expiry_heap)
+            if session.future is not None and session.deadline == deadline: #Otherwise, the session is already done
+                logger.debug("Session #%s for user %s expired.", session.code, session.user_id)
+                self.close_session(session)
+        self.reschedule_expiry()
+
+    def find_sessions(self, message):
+        '''Returns the open sessions that a message could be a reply to.'''
+        kind = DM if message.guild is None else GUILD
+        user_sessions = self.sessions.get((message.author.id, kind))
+        if user_sessions is None:
+            return []
+        return [session for session in user_sessions if session.accepts_replies() and (session.channel_id is None or session.channel_id == message.channel.id) and (session.after_message_id is None or message.id > session.after_message_id)]
+
+    async def on_message(self, message):
+        '''Routes a message to the session it is a reply to.'''
+        sessions = self.find_sessions(message)
+        if len(sessions) == 0:
+            return
+        content = message.content
+        code_match = SESSION_CODE_PATTERN.match(content)
+        picked_sessions = [session for session in sessions if code_match is not None and session.code == int(code_match.group(1))]
+        if len(picked_sessions) > 0:
+            #The code is stripped even if only one session is left, since users are told to start their replies with it while they have several
+            content = content[code_match.end():]
+        elif len(sessions) > 1:
+            logger.info("User %s replied without picking one of their sessions.", message.author.id)
+            if self.ambiguous_reply_handler is not None:
+                await self.ambiguous_reply_handler(message, sessions)
+            return
+        else:
+            picked_sessions = sessions
+        picked_sessions[0].resolve(Reply(message, content))
+
+reply_dispatcher = ReplyDispatcher()
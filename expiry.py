@@ -0,0 +1,92 @@
+'''Expiry.py
+Takes the roles of a lock back when a user's authentication expires, for locks that only let users in for a while.
+
+All expiring authentications are kept in one heap, ordered by when they expire, and a single task sleeps until the earliest one.
+Authentications that expire at about the same time are handed over in batches, so hundreds of thousands of them cost
+one heap entry each instead of one task or timer each. The heap only lives in memory: it is rebuilt from storage when the bot starts,
+and authentications that expired while the bot was offline are handed over right away.
+If the handler fails, the batch is put back on the heap and handed over again after EXPIRY_RETRY_DELAY seconds.'''
+
+import os, time, heapq, asyncio, logging
+import data
+
+#Settings
+EXPIRY_BATCH_SIZE = int(os.environ.get("POLICEBOT_EXPIRY_BATCH_SIZE", 500)) #Maximum number of expired authentications handed over at once
+EXPIRY_MAX_SLEEP = 60 #Maximum seconds to sleep before checking the heap again, in case the system clock changes
+EXPIRY_RETRY_DELAY = 60 #Seconds to wait before handing over a batch again when handling it failed
+
+#Logging
+logger = logging.getLogger(__name__)
+
+class ExpiryScheduler:
+    '''Keeps track of when authentications expire, and hands expired ones to a handler.'''
+    def __init__(self):
+        self.heap = [] #(timestamp when it is due, guild ID, channel ID, user ID, expiry timestamp). It is due when it expires, or later if it is retried
+        self.wakeup = None
+        self.task = None
+        self.expiry_handler = None
+
+    def attach(self, expiry_handler):
+        '''Sets the coroutine function that is called with (guild ID, channel ID, list of (user ID, expiry timestamp))
+        for every batch of authentications that have expired. The handler has to check that they have not changed since.'''
+        self.expiry_handler = expiry_handler
+
+    def schedule(self, guild_id, channel_id, user_id, expires_at):
+        '''Adds an authentication that expires at a Unix timestamp.'''
+        self.push(expires_at, guild_id, channel_id, user_id, expires_at)
+
+    def push(self, due_at, guild_id, channel_id, user_id, expires_at):
+        '''Adds an authentication to the heap, to be handed over at the Unix timestamp due_at.'''
+        heapq.heappush(self.heap, (due_at, int(guild_id), channel_id, user_id, expires_at))
+        if self.wakeup is not None and self.heap[0][0] == due_at: #It is due before everything else, so the task sleeps too long
+            self.wakeup.set()
+
+    async def start(self, guild_ids):
+        '''Rebuilds the heap from the stored authentications of the guilds, and starts handing over expired ones.
+        Only the guilds that this process serves are passed, so that cluster workers don't revoke each other's roles.'''
+        if self.task is not None:
+            return
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.ensure_future(self.run())
+        loop = asyncio.get_event_loop()
+        guild_ids = set(str(guild_id) for guild_id in guild_ids)
+        stored_guild_ids = await loop.run_in_executor(None, data.storage_backend.get_guild_ids_with_expirations)
+        started_at = time.perf_counter()
+        scheduled_authentications = 0
+        for guild_id in guild_ids.intersection(stored_guild_ids):
+            expirations = await loop.run_in_executor(None, data.get_authentication_expirations, guild_id)
+            for channel_id, user_id, expires_at in expirations:
+                self.schedule(guild_id, channel_id, user_id, expires_at)
+            scheduled_authentications += len(expirations)
+        logger.info("Scheduled %s expiring authentications in %.2f seconds.", scheduled_authentications, time.perf_counter() - started_at)
+
+    def pop_expired(self, now):
+        '''Removes up to EXPIRY_BATCH_SIZE due authentications from the heap, grouped by (guild ID, channel ID).'''
+        expired = {}
+        for _ in range(EXPIRY_BATCH_SIZE):
+            if len(self.heap) == 0 or self.heap[0][0] > now:
+                break
+            due_at, guild_id, channel_id, user_id, expires_at = heapq.heappop(self.heap)
+            expired.setdefault((guild_id, channel_id), []).append((user_id, expires_at))
+        return expired
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            now = time.time()
+            if len(self.heap) == 0 or self.heap[0][0] > now:
+                timeout = EXPIRY_MAX_SLEEP if len(self.heap) == 0 else min(EXPIRY_MAX_SLEEP, self.heap[0][0] - now)
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for (guild_id, channel_id), expirations in self.pop_expired(now).items():
+                try:
+                    await self.expiry_handler(guild_id, channel_id, expirations)
+                except Exception:
+                    logger.exception("Handling %s expired authentications in guild %s failed! Retrying in %s seconds...", len(expirations), guild_id, EXPIRY_RETRY_DELAY)
+                    for user_id, expires_at in expirations:
+                        self.push(now + EXPIRY_RETRY_DELAY, guild_id, channel_id, user_id, expires_at)
+
+expiry_scheduler = ExpiryScheduler()
@@ -0,0 +1,94 @@
+'''Hashing.py
+Password hashing and verification.
+Hashing is CPU-heavy, so it runs in a dedicated, bounded thread pool instead of on the event loop.'''
+
+import os, time, logging, asyncio, threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import check_password_hash, generate_password_hash
+from metrics import registry, HASH_SECONDS, HASH_QUEUE_SECONDS, HASH_REJECTIONS
+
+#Settings
+HASH_WORKER_COUNT = int(os.environ.get("POLICEBOT_HASH_WORKERS", 2)) #Number of threads hashing passwords
+HASH_QUEUE_LIMIT = int(os.environ.get("POLICEBOT_HASH_QUEUE_LIMIT", 200)) #Maximum number of hash operations queued or running at once
+PASSWORD_HASH_METHOD = "sha256"
+
+#Exceptions
+class HashQueueFullError(Exception):
+    '''Raised when too many hash operations are already waiting.'''
+    pass
+
+#Logging
+logger = logging.getLogger(__name__)
+
+class HashExecutor:
+    '''A bounded executor for password hash operations.
+    It keeps statistics about the queue depth and the time spent hashing.'''
+    def __init__(self, worker_count, queue_limit):
+        self.worker_count = worker_count
+        self.queue_limit = queue_limit
+        self.executor = ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="PasswordHasher")
+        self.queue_depth = 0 #Operations that are queued or running
+        self.max_queue_depth = 0
+        self.completed_operations = 0
+        self.rejected_operations = 0
+        self.hashing_seconds = 0 #Time spent inside the hash functions
+        self.waiting_seconds = 0 #Time spent waiting for a free worker
+        self.statistics_lock = threading.Lock()
+
+    def run_timed(self, operation, submitted_at, function, *args):
+        '''Runs a hash function in a worker thread and records how long it waited and ran.'''
+        started_at = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            finished_at = time.perf_counter()
+            HASH_QUEUE_SECONDS.observe(started_at - submitted_at)
+            HASH_SECONDS.observe(finished_at - started_at, operation=operation)
+            with self.statistics_lock:
+                self.waiting_seconds += started_at - submitted_at
+                self.hashing_seconds += finished_at - started_at
+                self.completed_operations += 1
+
+    async def run(self, operation, function, *args):
+        '''Runs a hash function in the executor and waits for its result.
+        Raises HashQueueFullError if the queue limit has been reached.'''
+        if self.queue_depth >= self.queue_limit:
+            self.rejected_operations += 1
+            HASH_REJECTIONS.inc()
+            logger.warning("Hash queue is full (%s operations)! Rejecting operation...", self.queue_depth)
+            raise HashQueueFullError(f"There are already {self.queue_depth} hash operations queued.")
+        self.queue_depth += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self.executor, self.run_timed, operation, time.perf_counter(), function, *args)
+        finally:
+            self.queue_depth -= 1
+
+    async def check_password(self, password_hash, password):
+        '''Checks a password against a hash.'''
+        return await self.run("check", check_password_hash, password_hash, password)
+
+    async def generate_password_hash(self, password):
+        '''Generates a hash for a password.'''
+        return await self.run("generate", generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+    def get_statistics(self):
+        '''Returns a dict of statistics about the executor.'''
+        with self.statistics_lock:
+            return {
+                "worker_count": self.worker_count,
+                "queue_limit": self.queue_limit,
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "completed_operations": self.completed_operations,
+                "rejected_operations": self.rejected_operations,
+                "hashing_seconds": self.hashing_seconds,
+                "waiting_seconds": self.waiting_seconds
+            }
+
+    def shutdown(self):
+        '''Shuts down the worker threads.'''
+        self.executor.shutdown(wait=False)
+
+hash_executor = HashExecutor(HASH_WORKER_COUNT, HASH_QUEUE_LIMIT)
+registry.gauge("policebot_hash_queue_depth", "Hash operations that are queued or running.", function=lambda: hash_executor.queue_depth)
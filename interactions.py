@@ -0,0 +1,199 @@
+'''Interactions.py
+Unlocking with a button instead of the ?a command.
+
+Lock messages get a persistent "Unlock" button. Pressing it opens a modal asking for the password, and the result is
+sent as an ephemeral response that only the user can see. Authenticating then takes one interaction round-trip,
+instead of deleting the command message, opening a DM, sending the question, waiting for a DM reply and sending the
+result to both the DM and the channel. It also works for users that don't accept DMs.
+
+discord.py 1.7 predates message components and modals, so interactions are read from the raw gateway events
+(on_socket_response) and answered with plain HTTP requests to version 10 of the API.'''
+
+import os, time, asyncio, logging
+from discord.http import Route
+from metrics import COMMAND_SECONDS
+
+#Settings
+INTERACTIONS_ENABLED = os.environ.get("POLICEBOT_INTERACTIONS", "1") == "1" #Whether new lock messages get an Unlock button
+INTERACTION_API_BASE = "https://discord.com/api/v10"
+RESPONSE_DEADLINE = 2 #Seconds to wait for a result before deferring the response. Discord waits 3 seconds for the first response
+
+#Interaction types
+MESSAGE_COMPONENT = 3
+MODAL_SUBMIT = 5
+#Interaction response types
+CHANNEL_MESSAGE_WITH_SOURCE = 4
+DEFERRED_CHANNEL_MESSAGE_WITH_SOURCE = 5
+MODAL = 9
+#Component types and styles
+ACTION_ROW = 1
+BUTTON = 2
+TEXT_INPUT = 4
+PRIMARY_BUTTON = 1
+SHORT_TEXT_INPUT = 1
+EPHEMERAL = 1 << 6 #Message flag for messages that only the user of the interaction can see
+
+#Custom IDs. They are the same on every lock message: the lock is found from the channel of the interaction
+UNLOCK_BUTTON_ID = "policebot:unlock"
+PASSWORD_MODAL_ID = "policebot:password"
+PASSWORD_INPUT_ID = "password"
+
+#Logging
+logger = logging.getLogger(__name__)
+
+class InteractionRoute(Route):
+    '''A route on version 10 of the API.
+    Every interaction gets its own bucket, since discord.py holds a bucket's lock for the whole request,
+    and responses to different interactions would otherwise wait for each other.'''
+    BASE = INTERACTION_API_BASE
+
+    def __init__(self, method, path, **parameters):
+        super().__init__(method, path, **parameters)
+        self.interaction_id = parameters.get("interaction_id")
+
+    @property
+    def bucket(self):
+        return f"{self.channel_id}:{self.guild_id}:{self.interaction_id}:{self.path}"
+
+def generate_unlock_components():
+    '''Returns the components of a lock message: one row with the Unlock button.'''
+    return [{
+        "type": ACTION_ROW,
+        "components": [{"type": BUTTON, "style": PRIMARY_BUTTON, "label": "Unlock", "emoji": {"name": "🔓"}, "custom_id": UNLOCK_BUTTON_ID}]
+    }]
+
+def generate_password_modal(guild_name):
+    '''Returns the modal asking for the password of a lock.'''
+    return {
+        "custom_id": PASSWORD_MODAL_ID,
+        "title": f"Unlock {guild_name}"[:45], #Modal titles can be at most 45 characters long
+        "components": [{
+            "type": ACTION_ROW,
+            "components": [{"type": TEXT_INPUT, "style": SHORT_TEXT_INPUT, "label": "Password", "custom_id": PASSWORD_INPUT_ID, "required": True, "max_length": 4000}]
+        }]
+    }
+
+async def send_lock_message(http, channel_id, embed):
+    '''Sends a lock message with the Unlock button. Returns the message payload.'''
+    route = InteractionRoute("POST", "/channels/{channel_id}/messages", channel_id=channel_id)
+    return await http.request(route, json={"embeds": [embed.to_dict()], "components": generate_unlock_components()})
+
+class Interaction:
+    '''An interaction from the gateway, with methods for responding to it.
+    The first response goes to the interaction callback; later ones edit the original response.'''
+    __slots__ = ("http", "id", "token", "application_id", "type", "guild_id", "channel_id", "user_id", "member_role_ids", "data", "responded")
+
+    def __init__(self, http, payload):
+        self.http = http
+        self.id = int(payload["id"])
+        self.token = payload["token"]
+        self.application_id = int(payload["application_id"])
+        self.type = payload["type"]
+        self.guild_id = int(payload["guild_id"]) if "guild_id" in payload else None
+        self.channel_id = int(payload["channel_id"])
+        member = payload.get("member")
+        user = member["user"] if member is not None else payload["user"]
+        self.user_id = int(user["id"])
+        self.member_role_ids = [int(role_id) for role_id in member["roles"]] if member is not None else []
+        self.data = payload.get("data", {})
+        self.responded = False
+
+    @property
+    def custom_id(self):
+        return self.data.get("custom_id")
+
+    def get_text_input(self, custom_id):
+        '''Returns the value of a text input of a submitted modal, or None if the modal doesn't have it.'''
+        for row in self.data.get("components", []):
+            for component in row.get("components", []):
+                if component.get("custom_id") == custom_id:
+                    return component.get("value")
+        return None
+
+    async def respond(self, response_type, data=None):
+        '''Sends the first response to the interaction.'''
+        route = InteractionRoute("POST", "/interactions/{interaction_id}/{interaction_token}/callback", interaction_id=self.id, interaction_token=self.token)
+        payload = {"type": response_type}
+        if data is not None:
+            payload["data"] = data
+        self.responded = True
+        await self.http.request(route, json=payload)
+
+    async def send(self, embed, ephemeral=True):
+        '''Responds with an embed, or replaces the "thinking" message if the response was deferred.'''
+        if not self.responded:
+            await self.respond(CHANNEL_MESSAGE_WITH_SOURCE, {"embeds": [embed.to_dict()], "flags": EPHEMERAL if ephemeral else 0})
+            return
+        route = InteractionRoute("PATCH", "/webhooks/{application_id}/{interaction_token}/messages/@original", application_id=self.application_id, interaction_token=self.token, interaction_id=self.id)
+        await self.http.request(route, json={"embeds": [embed.to_dict()]})
+
+    async def open_modal(self, modal):
+        await self.respond(MODAL, modal)
+
+    async def wait_or_defer(self, awaitable, ephemeral=True):
+        '''Waits for an awaitable and returns its result. If it takes longer than RESPONSE_DEADLINE, the response is deferred
+        first, so that Discord doesn't give up on the interaction while we wait.'''
+        future = asyncio.ensure_future(awaitable)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), RESPONSE_DEADLINE)
+        except asyncio.TimeoutError:
+            logger.info("Interaction %s is taking long. Deferring the response...", self.id)
+            await self.respond(DEFERRED_CHANNEL_MESSAGE_WITH_SOURCE, {"flags": EPHEMERAL if ephemeral else 0})
+        return await future
+
+class UserCooldown:
+    '''Lets every user do something once every `per` seconds, like commands.cooldown with BucketType.user.'''
+    def __init__(self, per):
+        self.per = per
+        self.expires_at = {} #User ID --> monotonic time when the cooldown of the user ends
+        self.next_prune_at = 0
+
+    def try_use(self, user_id):
+        '''Starts the cooldown of a user and returns 0, or returns the seconds left if the user is on cooldown.'''
+        now = time.monotonic()
+        if now >= self.next_prune_at: #Forget ended cooldowns now and then, instead of on every use
+            self.expires_at = {user_id: expires_at for user_id, expires_at in self.expires_at.items() if expires_at > now}
+            self.next_prune_at = now + self.per
+        expires_at = self.expires_at.get(user_id, 0)
+        if expires_at > now:
+            return expires_at - now
+        self.expires_at[user_id] = now + self.per
+        return 0
+
+class InteractionRouter:
+    '''Routes interactions from the gateway to the handler registered for their custom ID.'''
+    def __init__(self):
+        self.handlers = {} #Custom ID --> coroutine function called with the Interaction
+        self.http = None
+
+    def handler(self, custom_id):
+        '''Decorator registering a coroutine function as the handler of a button or modal.'''
+        def decorator(function):
+            self.handlers[custom_id] = function
+            return function
+        return decorator
+
+    def attach(self, bot):
+        '''Starts handling the interactions that the bot receives.'''
+        self.http = bot.http
+        bot.add_listener(self.on_socket_response, "on_socket_response")
+
+    async def on_socket_response(self, message):
+        if message.get("t") != "INTERACTION_CREATE":
+            return
+        interaction = Interaction(self.http, message["d"])
+        handler = self.handlers.get(interaction.custom_id)
+        if handler is None:
+            logger.debug("No handler for interaction with custom ID %s. Ignoring...", interaction.custom_id)
+            return
+        started_at = time.perf_counter()
+        status = "ok"
+        try:
+            await handler(interaction)
+        except Exception:
+            status = "error"
+            logger.exception("Handling interaction %s failed!", interaction.custom_id)
+        finally:
+            COMMAND_SECONDS.observe(time.perf_counter() - started_at, command=handler.__name__, status=status)
+
+interaction_router = InteractionRouter()
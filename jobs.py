@@ -0,0 +1,206 @@
+'''Jobs.py
+Background jobs that change the roles of many members at once, like giving the roles of a lock to everyone that has
+authenticated with it again, or taking them back.
+
+A job goes through its members one at a time, with one member edit per member. discord.py keeps a rate limit bucket per route
+and guild and waits when it is empty, so a job in a big guild slows down to Discord's rate limit instead of running into 429s,
+and does not hold up other guilds. Every job checkpoints its position in the jobs directory of the data directory, so that a job that was interrupted by a
+restart resumes where it stopped. Jobs only ever add or remove the same roles, so repeating a few members after a restart is harmless.'''
+
+import os, sys, time, asyncio, logging
+from array import array
+from discord import NotFound, HTTPException
+from storage import read_json_from_file, write_json_to_file, write_file_atomically
+import data
+
+#Paths
+JOBS_DIRECTORY_NAME = "jobs" #Directory in the data directory of the storage backend (see StorageBackend.data_path)
+
+#Settings
+JOB_WORKERS = int(os.environ.get("POLICEBOT_JOB_WORKERS", 2)) #Number of jobs that run at the same time
+JOB_CHECKPOINT_INTERVAL = 50 #Members between checkpoints
+JOB_PROGRESS_INTERVAL = 10 #Seconds between progress reports
+
+#Job kinds
+RESYNC = "resync" #Give the roles to every member of the job
+REVOKE = "revoke" #Take the roles from every member of the job
+
+#Logging
+logger = logging.getLogger(__name__)
+
+class RoleJob:
+    '''A job adding or removing a set of roles for a list of members.
+    The state is saved as <job ID>.json, and the member IDs once as <job ID>.users (unsigned 64-bit little-endian IDs).'''
+    def __init__(self, kind, guild_id, channel_id, role_ids, total, progress_channel_id=None, progress_message_id=None,
+                 position=0, changed=0, skipped=0, failed=0, job_id=None):
+        self.job_id = job_id or f"{guild_id}-{channel_id}" #Admins can run one job per lock at a time
+        self.kind = kind
+        self.guild_id = guild_id
+        self.channel_id = channel_id #The channel of the lock that the job is for
+        self.role_ids = role_ids
+        self.total = total
+        self.progress_channel_id = progress_channel_id #Where the progress is reported, or None to not report it
+        self.progress_message_id = progress_message_id
+        self.position = position #Index of the next member to process
+        self.changed = changed
+        self.skipped = skipped #Members that already had the right roles, or have left the guild
+        self.failed = failed
+
+    @property
+    def id(self):
+        return self.job_id
+
+    def get_state(self):
+        return dict(vars(self))
+
+    def get_paths(self, jobs_path):
+        '''Returns the paths of the state and member ID files of the job.'''
+        return os.path.join(jobs_path, f"{self.id}.json"), os.path.join(jobs_path, f"{self.id}.users")
+
+    def save(self, jobs_path):
+        write_json_to_file(self.get_state(), self.get_paths(jobs_path)[0])
+
+    def save_user_ids(self, jobs_path, user_ids):
+        user_id_array = array("Q", user_ids)
+        if sys.byteorder != "little":
+            user_id_array.byteswap()
+        write_file_atomically(user_id_array.tobytes(), self.get_paths(jobs_path)[1], mode="wb")
+
+    def load_user_ids(self, jobs_path):
+        user_ids = array("Q")
+        with open(self.get_paths(jobs_path)[1], "rb") as user_ids_file:
+            user_ids.frombytes(user_ids_file.read())
+        if sys.byteorder != "little":
+            user_ids.byteswap()
+        return user_ids
+
+    def delete(self, jobs_path):
+        for path in self.get_paths(jobs_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+class JobQueue:
+    '''Runs role jobs in a few worker tasks.'''
+    def __init__(self, jobs_path=None, worker_count=JOB_WORKERS):
+        self.jobs_path = jobs_path #None to use the data directory of the storage backend that is in use when the queue starts
+        self.worker_count = worker_count
+        self.jobs = {} #Job ID --> queued or running job
+        self.queue = None
+        self.workers = []
+        self.bot = None
+        self.progress_handler = None
+
+    def attach(self, bot, progress_handler=None):
+        '''Sets the bot that jobs run with.
+        progress_handler is a coroutine function called with (job, finished) every JOB_PROGRESS_INTERVAL seconds and when a job ends.'''
+        self.bot = bot
+        self.progress_handler = progress_handler
+
+    def start(self):
+        '''Starts the workers and resumes the saved jobs of the guilds that the bot is in. Called once the bot is ready.'''
+        if self.queue is not None:
+            return
+        self.queue = asyncio.Queue()
+        self.workers = [asyncio.ensure_future(self.work()) for _ in range(self.worker_count)]
+        if self.jobs_path is None:
+            self.jobs_path = os.path.join(data.storage_backend.data_path, JOBS_DIRECTORY_NAME)
+        os.makedirs(self.jobs_path, exist_ok=True)
+        for filename in sorted(os.listdir(self.jobs_path)):
+            if not filename.endswith(".json"):
+                continue
+            try:
+                job = RoleJob(**read_json_from_file(os.path.join(self.jobs_path, filename)))
+            except (ValueError, TypeError):
+                logger.warning("Job file %s is damaged! Skipping...", filename, exc_info=True)
+                continue
+            if self.bot.get_guild(job.guild_id) is None: #The guild is served by another cluster worker, or the bot has left it
+                continue
+            logger.info("Resuming %s job %s at member %s of %s...", job.kind, job.id, job.position, job.total)
+            self.jobs[job.id] = job
+            self.queue.put_nowait(job)
+
+    def get_job(self, guild_id, channel_id):
+        '''Returns the queued or running job for a lock, or None.'''
+        return self.jobs.get(f"{guild_id}-{channel_id}")
+
+    def submit(self, job, user_ids):
+        '''Saves a new job and queues it.'''
+        os.makedirs(self.jobs_path, exist_ok=True)
+        job.save_user_ids(self.jobs_path, user_ids)
+        job.save(self.jobs_path)
+        self.jobs[job.id] = job
+        self.queue.put_nowait(job)
+        logger.info("Queued %s job %s for %s members.", job.kind, job.id, job.total)
+
+    async def work(self):
+        while True:
+            job = await self.queue.get()
+            try:
+                await self.run_job(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Job %s failed! It will be resumed when the bot restarts.", job.id)
+                self.jobs.pop(job.id, None)
+
+    async def run_job(self, job):
+        user_ids = job.load_user_ids(self.jobs_path)
+        guild = self.bot.get_guild(job.guild_id)
+        last_progress_at = time.monotonic()
+        try:
+            while job.position < job.total:
+                await self.apply_roles(job, guild, user_ids[job.position])
+                job.position += 1
+                if job.position % JOB_CHECKPOINT_INTERVAL == 0:
+                    job.save(self.jobs_path)
+                if job.progress_message_id is not None and time.monotonic() - last_progress_at >= JOB_PROGRESS_INTERVAL:
+                    last_progress_at = time.monotonic()
+                    await self.report_progress(job, False)
+        except asyncio.CancelledError: #The bot is shutting down
+            job.save(self.jobs_path)
+            raise
+        job.delete(self.jobs_path)
+        self.jobs.pop(job.id, None)
+        logger.info("Finished %s job %s: %s changed, %s skipped, %s failed.", job.kind, job.id, job.changed, job.skipped, job.failed)
+        await self.report_progress(job, True)
+
+    async def report_progress(self, job, finished):
+        if self.progress_handler is None or job.progress_message_id is None:
+            return
+        try:
+            await self.progress_handler(job, finished)
+        except HTTPException:
+            logger.warning("Could not report the progress of job %s!", job.id, exc_info=True)
+
+    async def apply_roles(self, job, guild, user_id):
+        '''Adds or removes the roles of a job for one member, with a single request if possible.'''
+        http = self.bot.http
+        try:
+            if len(job.role_ids) == 1: #One role can be added or removed without knowing the member's roles
+                if job.kind == RESYNC:
+                    await http.add_role(job.guild_id, user_id, job.role_ids[0])
+                else:
+                    await http.remove_role(job.guild_id, user_id, job.role_ids[0])
+                job.changed += 1
+                return
+            member = guild.get_member(user_id) if guild is not None else None
+            if member is not None:
+                member_role_ids = {role.id for role in member.roles if not role.is_default()}
+            else:
+                member_role_ids = {int(role_id) for role_id in (await http.get_member(job.guild_id, user_id))["roles"]}
+            if job.kind == RESYNC:
+                new_role_ids = member_role_ids.union(job.role_ids)
+            else:
+                new_role_ids = member_role_ids.difference(job.role_ids)
+            if new_role_ids == member_role_ids:
+                job.skipped += 1
+                return
+            await http.edit_member(job.guild_id, user_id, roles=sorted(new_role_ids))
+            job.changed += 1
+        except NotFound: #The member has left the guild
+            job.skipped += 1
+        except HTTPException:
+            logger.warning("Could not change the roles of member %s in guild %s!", user_id, job.guild_id, exc_info=True)
+            job.failed += 1
+
+job_queue = JobQueue()
@@ -0,0 +1,62 @@
+'''Log_setup.py
+Logging configuration for the bot.
+
+Log records are put on a queue by the thread that logs them, and formatted and written to stderr by a separate
+listener thread, so that the event loop never waits for a write. Levels are set with environment variables:
+* POLICEBOT_LOG_LEVEL - the level for everything (default: INFO)
+* POLICEBOT_LOG_LEVELS - per-module levels, like "data=WARNING,discord=INFO,main=DEBUG"
+Records below the level of their logger are dropped before any formatting is done, as long as
+log calls pass their arguments separately (logger.info("Guild %s", guild_id)) instead of as f-strings.'''
+
+import os, sys, queue, atexit, logging
+from logging.handlers import QueueHandler, QueueListener
+
+#Settings
+LOG_LEVEL = os.environ.get("POLICEBOT_LOG_LEVEL", "INFO")
+LOG_LEVELS = os.environ.get("POLICEBOT_LOG_LEVELS", "discord=INFO")
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+if "POLICEBOT_CLUSTER_WORKER_ID" in os.environ: #Tell the logs of cluster workers apart (see cluster.py)
+    LOG_FORMAT = f"%(asctime)s [worker {os.environ['POLICEBOT_CLUSTER_WORKER_ID']}] %(levelname)s %(name)s: %(message)s"
+
+class UnformattedQueueHandler(QueueHandler):
+    '''A QueueHandler that leaves all formatting to the listener thread.
+    The default QueueHandler formats the message before putting it on the queue, in the thread that logged it.
+    Log arguments must therefore not be changed after they have been logged.'''
+    def prepare(self, record):
+        return record
+
+def parse_log_levels(log_levels):
+    '''Parses a "module=LEVEL,module=LEVEL" string into a dict.'''
+    parsed_log_levels = {}
+    for module_log_level in log_levels.split(","):
+        if "=" not in module_log_level:
+            continue
+        module, level = module_log_level.split("=", 1)
+        parsed_log_levels[module.strip()] = level.strip().upper()
+    return parsed_log_levels
+
+listener = None
+
+def setup_logging(level=LOG_LEVEL, log_levels=LOG_LEVELS):
+    '''Sets up the root logger to log through the queue, and starts the listener thread.'''
+    global listener
+    if listener is not None:
+        return
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root_logger = logging.getLogger()
+    root_logger.handlers = [UnformattedQueueHandler(log_queue)]
+    root_logger.setLevel(level.upper())
+    for module, module_level in parse_log_levels(log_levels).items():
+        logging.getLogger(module).setLevel(module_level)
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging():
+    '''Writes the remaining log records and stops the listener thread.'''
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
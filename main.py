@@ -10,23 +10,40 @@ https://discord.com/oauth2/authorize?client_id=863082773379416115&scope=bot&perm
 You can revoke admin access from the bot, however, make sure that it still is allowed to delete messages, and that it can see all the channels
 that you want it to see, and that it has permissions to delete messages and award roles.
 '''
-import logging, json, os, asyncio
-from discord import Embed, Color, Game, utils, ChannelType
+import logging, os, re, asyncio, time
+from discord import Embed, Color, Game, NotFound
 from discord.ext import commands
 from data import  *
-from werkzeug.security import check_password_hash, generate_password_hash
+import data_async
+from hashing import hash_executor, HashQueueFullError
+from dispatcher import reply_dispatcher, DM, GUILD
+from log_setup import setup_logging
+from metrics import COMMAND_SECONDS, AUTHENTICATION_OUTCOMES, COOLDOWN_REJECTIONS, FILTERED_COMMANDS, instrument_http_client, start_metrics_server
+from cluster import get_sharding_options, receives_direct_messages, SHARD_COUNT, SHARD_IDS
+from jobs import job_queue, RoleJob, RESYNC, REVOKE
+from expiry import expiry_scheduler
+from capture import traffic_capture, CAPTURE_PATH
+from profiling import command_profiler, PROFILE_SAMPLE_RATE, PROFILED_COMMANDS
+from ratelimit import authentication_limiter, ReplyCoalescer, REJECTION_REPLY_INTERVAL
+from interactions import interaction_router, send_lock_message, generate_password_modal, UserCooldown, INTERACTIONS_ENABLED, UNLOCK_BUTTON_ID, PASSWORD_MODAL_ID, PASSWORD_INPUT_ID
 BOT_COMMAND_PREFIX = "?"
-bot = commands.Bot(command_prefix=BOT_COMMAND_PREFIX, help_command=None) #The help command provided is a custom one, see further below
+#The help command provided is a custom one, see further below
+sharding_options = get_sharding_options()
+if sharding_options is None:
+    bot = commands.Bot(command_prefix=BOT_COMMAND_PREFIX, help_command=None)
+else: #Sharded, see cluster.py
+    bot = commands.AutoShardedBot(command_prefix=BOT_COMMAND_PREFIX, help_command=None, **sharding_options)
+direct_messages_received = receives_direct_messages(sharding_options) #False for cluster workers without shard 0, see cluster.py
 
 #Constants
 DEFAULT_COMMAND_COLOR = Color.dark_teal()
 DEFAULT_ERROR_COLOR = Color.red()
-BOT_TOKEN = os.environ["POLICEBOT_BOT_TOKEN"]
+DURATION_PATTERN = re.compile(r"^\s*(\d+)\s*(m|min|mins|minutes?|h|hours?|d|days?|w|weeks?)\s*$", re.IGNORECASE) #Like "24h" or "7 days"
+DURATION_UNIT_SECONDS = {"m": 60, "h": 3600, "d": 86400, "w": 604800}
+BOT_TOKEN = os.environ.get("POLICEBOT_BOT_TOKEN") #Only needed to run the bot, so that main.py can be imported without it (see benchmarks/load_harness.py)
 BOT_INVITE_LINK = "https://discord.com/oauth2/authorize?client_id=863082773379416115&scope=bot&permissions=339078238" #See note above
-#Logging and logging settings
-logging.basicConfig(
-    level=logging.DEBUG
-)
+#Logging and logging settings (see log_setup.py for how to change the levels)
+setup_logging()
 logger = logging.getLogger(__name__)
 
 #Functions
@@ -38,6 +55,56 @@ def generate_error_embed(title="An error occurred", description="Please try agai
         color=DEFAULT_ERROR_COLOR
     )
 
+def get_roles(guild, role_ids):
+    '''Function for getting the roles of a guild with the passed IDs.
+    guild.get_role looks roles up in the ID-keyed role cache that discord.py keeps up to date on role events,
+    so no role list is scanned. Roles that have been deleted are skipped.'''
+    roles = []
+    for role_id in role_ids:
+        role = guild.get_role(role_id)
+        if role is None:
+            logger.warning("Role %s does not exist anymore! Skipping...", role_id)
+            continue
+        roles.append(role)
+    return roles
+
+def parse_duration(text):
+    '''Function for parsing a duration like "30m", "24h", "7 days" or "2w" into seconds. Returns None if the text is not a duration.'''
+    match = DURATION_PATTERN.match(text)
+    if match is None:
+        return None
+    return int(match.group(1)) * DURATION_UNIT_SECONDS[match.group(2)[0].lower()]
+
+def format_duration(seconds):
+    '''Function for formatting a duration in seconds with the largest unit that fits it, like "7 days".'''
+    for unit_name, unit_seconds in (("week", 604800), ("day", 86400), ("hour", 3600), ("minute", 60)):
+        if seconds % unit_seconds == 0:
+            count = seconds // unit_seconds
+            return f"{count} {unit_name}{'s' if count != 1 else ''}"
+    return f"{seconds} seconds"
+
+async def save_authenticated_user(guild_id, channel_id, user_id, lock):
+    '''Function for saving that a user has authenticated with a lock, and scheduling when the authentication expires if the lock has a duration.
+    Returns the Unix timestamp when the authentication expires, or None.'''
+    duration = lock.authentication_duration
+    expires_at = int(time.time()) + duration if duration is not None else None
+    async with get_guild_mutation_lock(guild_id):
+        await data_async.add_authenticated_user(guild_id, channel_id, user_id, expires_at)
+    if expires_at is not None:
+        expiry_scheduler.schedule(guild_id, channel_id, user_id, expires_at)
+    return expires_at
+
+def generate_expiry_text(expires_at):
+    '''Function for generating a sentence telling a user when their access ends, or an empty string if it doesn't.'''
+    return f" Your access ends <t:{expires_at}:R>." if expires_at is not None else ""
+
+def generate_busy_embed():
+    '''Function for generating an error embed for when the bot is too busy checking passwords.'''
+    return generate_error_embed(
+        "I'm swamped right now!",
+        "Lots of people are entering passwords at the same time, so I can't check yours right now. Give it a minute and try again!"
+    )
+
 #Commands
 @bot.command()
 async def ping(ctx):
@@ -61,21 +128,53 @@ async def authenticate(ctx):
     The command has a cooldown per user to avoid bruteforcing.
     The user only has one password attempt and requires to write "?a" in a channel with every authentication attempt.
     This might seem tedious, but if you think about it, it is a great way to prevent bruteforcing since it adds an extra step for someone
-    that would attempt to bruteforce.'''
+    that would attempt to bruteforce.
+    Attempts are also limited per lock and guild (see ratelimit.py), so that raids with many accounts are turned away
+    before the bot deletes their messages, sends them DMs or checks their passwords.'''
+    if authentication_limiter.try_start(ctx.guild.id, ctx.channel.id) is not None:
+        logger.info("Too many authentication attempts in the guild! Rejecting...")
+        if authentication_limiter.should_reply(ctx.channel.id):
+            await ctx.send(embed=generate_busy_embed(), delete_after=REJECTION_REPLY_INTERVAL)
+        return
+    try:
+        await run_authentication(ctx)
+    finally:
+        authentication_limiter.finish(ctx.guild.id)
+
+async def send_unlock_prompt(ctx):
+    '''Function for asking a user to unlock with the Unlock button instead of a DM.
+    Used by cluster workers that don't serve shard 0, since Discord only sends the DM replies to that shard (see cluster.py).'''
+    if not INTERACTIONS_ENABLED:
+        logger.warning("This worker doesn't get DMs and the Unlock button is turned off! Sending error...")
+        await ctx.send(
+            embed=generate_error_embed("I can't ask for the password here!", "Sorry, I can't take passwords in private messages in this server right now. Please ask an administrator of the server."),
+            delete_after=60
+        )
+        return
+    logger.info("This worker doesn't get DMs. Sending an Unlock button...")
+    unlock_embed = Embed(
+        title="🔒 Authentication check! ✋",
+        description=f"Hi there, {ctx.author.mention}! Press **Unlock** below and enter the password. Only you will see my answer.",
+        color=DEFAULT_COMMAND_COLOR
+    )
+    unlock_message_data = await send_lock_message(bot.http, ctx.channel.id, unlock_embed)
+    await ctx.channel.get_partial_message(int(unlock_message_data["id"])).delete(delay=60)
+
+async def run_authentication(ctx):
+    '''Function for running an authentication attempt that is within the limits of the authentication limiter.'''
     logger.info("Got a request to authenticate!")
     logger.info("Attempting to delete original message...")
     #Message deletion can be tricky with permission management. And the deletion of the original message is nice but not mandatory - so we can move on if it fails!
     try:
         await ctx.message.delete()
         logger.info("Original message deleted.")
-    except Exception as e:
+    except Exception:
         logger.warning("Original message could not be deleted!", exc_info=True)
     #First, validate if the channel actually has a lock enabled
     guild_id = str(ctx.guild.id)
     channel_id = ctx.channel.id
     user_id = ctx.author.id
-    tracked_channels = get_channel_ids_with_message(guild_id)
-    if channel_id not in tracked_channels:
+    if not await data_async.is_channel_tracked(guild_id, channel_id):
         logger.warning("The channel is not being tracked by the bot! Sending error message...")
         await ctx.send(
             embed=generate_error_embed("The channel is not being tracked by me!",
@@ -84,7 +183,7 @@ async def authenticate(ctx):
         return
     #If we get here, the channel is being tracked, so we want to get the password
     logger.info("The channel is being tracked by the bot! Finding message...")
-    enabled_lock = get_lock_for_channel_id(guild_id, channel_id)
+    enabled_lock = await data_async.get_lock_for_channel_id(guild_id, channel_id)
     #The function will return None if an enabled lock was not found
     if enabled_lock is None:
         logger.info("It seems like the channel's lock is not active! Sending error...")
@@ -96,7 +195,7 @@ async def authenticate(ctx):
         return
     logger.info("Found an enabled lock.")
     #Check if the user has authenticated
-    if "authenticated_users" in enabled_lock and user_id in enabled_lock["authenticated_users"]:
+    if await data_async.is_user_authenticated(guild_id, channel_id, user_id):
         logger.info("User has already authenticated! Sending error message...")
         await ctx.send(
             embed=generate_error_embed(
@@ -105,49 +204,59 @@ async def authenticate(ctx):
             ),
             delete_after=60
         )
+    if not direct_messages_received:
+        await send_unlock_prompt(ctx)
+        return
     #Now, send the user a DM requesting the password.
-    logger.info("Sending user a DM...")
-    try:
-        password_request_message = Embed(
-            title="🔒 Authentication check! ✋",
-            description=f"Hi there, {ctx.author.mention}, you called the authentication command in the server {ctx.guild.name}. Please reply with the password.\n⚠Policemen doesn't work all day, so you have **1 minute to reply with the password**. After that, you have to use the `?a` command again to get a new message from me.",
-            color=DEFAULT_COMMAND_COLOR
-        )
-        password_request_message.set_footer(text="Make sure that you aren't trying to authenticate in another server at the same time. If so,")
-        await ctx.author.send(
-            embed=password_request_message
-        )
-    except Exception as e:
-        logger.warning("Failed to send user a DM!", exc_info=e)
-        await ctx.send(
-            embed=generate_error_embed(
-                f"{ctx.author.mention}, I could not send you a DM!",
-                "Make sure you accept DMs from people like me (this is usually in your privacy settings). I mean, it's not every day you get a policeman knockin' at ya' door! I need to be able to send you a private message so you can provide me with a password."
+    #The session is opened first, so that a reply can't arrive before we are listening for it
+    with reply_dispatcher.open_session(user_id, DM, timeout=60, label=ctx.guild.name, after_message_id=ctx.message.id) as password_session:
+        logger.info("Sending user a DM...")
+        try:
+            password_request_message = Embed(
+                title="🔒 Authentication check! ✋",
+                description=f"Hi there, {ctx.author.mention}, you called the authentication command in the server {ctx.guild.name}. Please reply with the password.\n⚠Policemen doesn't work all day, so you have **1 minute to reply with the password**. After that, you have to use the `?a` command again to get a new message from me.",
+                color=DEFAULT_COMMAND_COLOR
             )
-        )
-        return
-    #Now, wait for a response to the message
-    def is_dm_from_author(message):
-        '''Checks if the message is a DM from the message author.'''
-        return message.author.id == ctx.author.id and message.channel.type == ChannelType.private
-    logger.info("Waiting for response...")
-    try:
-        response = await bot.wait_for("message", check=is_dm_from_author, timeout=60)
-    except asyncio.TimeoutError:
-        logger.info("User didn't respond!")
-        await ctx.author.send(
-            embed=generate_error_embed("You were too slow, mate!",
-                                       "You didn't send the password to authenticate with in time. Now, don't worry! Go back to the channel and then write `?a` again, and you will get a new chance from me to authenticate. Cheers!")
-        )
-        return
+            password_request_message.set_footer(text=f"Authenticating in several servers at the same time? Start your reply with #{password_session.code} (like \"#{password_session.code} password\") to answer this one.")
+            await ctx.author.send(
+                embed=password_request_message
+            )
+        except Exception as e:
+            logger.warning("Failed to send user a DM!", exc_info=e)
+            await ctx.send(
+                embed=generate_error_embed(
+                    f"{ctx.author.mention}, I could not send you a DM!",
+                    "Make sure you accept DMs from people like me (this is usually in your privacy settings). I mean, it's not every day you get a policeman knockin' at ya' door! I need to be able to send you a private message so you can provide me with a password."
+                )
+            )
+            return
+        #Now, wait for a response to the message
+        logger.info("Waiting for response...")
+        try:
+            response = await password_session.wait()
+        except asyncio.TimeoutError:
+            logger.info("User didn't respond!")
+            AUTHENTICATION_OUTCOMES.inc(outcome="timeout")
+            await ctx.author.send(
+                embed=generate_error_embed("You were too slow, mate!",
+                                           "You didn't send the password to authenticate with in time. Now, don't worry! Go back to the channel and then write `?a` again, and you will get a new chance from me to authenticate. Cheers!")
+            )
+            return
     logger.info("Got a response! Using that as password...")
     user_entered_password = response.content
     logger.info("Found an enabled lock, checking password...")
     #Get the password for the lock
-    lock_password = enabled_lock["password"]
+    lock_password = enabled_lock.password
     #Check if the passwords are equal
-    if check_password_hash(lock_password, user_entered_password) is False:
+    try:
+        password_is_correct = await hash_executor.check_password(lock_password, user_entered_password)
+    except HashQueueFullError:
+        logger.warning("The password could not be checked since the hash queue is full!")
+        await ctx.author.send(embed=generate_busy_embed())
+        return
+    if password_is_correct is False:
         logger.info("An incorrect password was entered!")
+        AUTHENTICATION_OUTCOMES.inc(outcome="wrong_password")
         error_embed = generate_error_embed(
             "✋ Access denied! ✋",
             f"Sorry, {ctx.author.mention}, it seems like you didn't enter the correct password. I'm therefore doin' my job and keeping you out!"
@@ -164,30 +273,22 @@ async def authenticate(ctx):
         return
     else:
         logger.info("A correct password was entered!")
+        AUTHENTICATION_OUTCOMES.inc(outcome="success")
         #Now, we award the listed role IDs to the user
-        role_ids_to_award = enabled_lock["award_role_ids"]
-        roles = []
-        for role_id in role_ids_to_award:
-            logger.info(f"Adding role ID {role_id}...")
-            role = utils.get(ctx.guild.roles, id=role_id)
-            roles.append(role)
-            logger.info("Role ID added.")
-            logger.info("Awarding role...")
-            await ctx.author.add_roles(role)
-            logger.info("Role awarded.")
+        role_ids_to_award = enabled_lock.award_role_ids
+        roles = get_roles(ctx.guild, role_ids_to_award)
+        logger.info("Awarding %s roles...", len(roles))
+        #All roles are added in one request, instead of one request per role. No request is needed if all roles were deleted
+        if roles:
+            await ctx.author.add_roles(*roles, atomic=False)
+        logger.info("Roles awarded.")
         #Add user to list of authenticated users
-        guild_configuration = get_guild_configuration(guild_id)
-        enabled_lock_index = guild_configuration["enabled_locks"].index(enabled_lock) #Get index of enabled lock in configuration
-        if "authenticated_users" not in enabled_lock:
-            enabled_lock["authenticated_users"] = []
-        enabled_lock["authenticated_users"].append(user_id)
-        guild_configuration["enabled_locks"][enabled_lock_index] = enabled_lock
-        logger.info("Updating guild configuration...")
-        update_guild_config(guild_id, guild_configuration)
-        logger.info("Guild configuration updated.")
+        logger.info("Saving authenticated user...")
+        expires_at = await save_authenticated_user(guild_id, channel_id, user_id, enabled_lock)
+        logger.info("Authenticated user saved.")
         final_embed = Embed(
             title="✅ Oh yeah, that's correct!",
-            description=f"I have now let ya in, {ctx.author.mention}! I awarded you some roles since you enterred the correct password.",
+            description=f"I have now let ya in, {ctx.author.mention}! I awarded you some roles since you enterred the correct password.{generate_expiry_text(expires_at)}",
             color=DEFAULT_COMMAND_COLOR
         )
         logger.info("Sending final embed to user...")
@@ -207,7 +308,13 @@ async def add_lock(ctx):
             "Currently, only server admins can create lock messages."
         ))
         return
+    #Replies to the questions are only accepted from the admin, in the channel where the command was called
+    with reply_dispatcher.open_session(ctx.author.id, GUILD, timeout=120, channel_id=ctx.channel.id, label=ctx.guild.name, after_message_id=ctx.message.id) as reply_session:
+        await ask_lock_questions(ctx, reply_session)
 
+async def ask_lock_questions(ctx, reply_session):
+    '''Asks the questions for creating a lock and creates it.
+    Replies are received through reply_session.'''
     logger.info("Check passed, asking questions...")
     #General for all questions
     no_response_error_message = generate_error_embed("No response!",
@@ -221,17 +328,19 @@ async def add_lock(ctx):
     question_1_embed.set_footer(text="The password will never be stored in plain text. It will be stored in hashed SHA256 format (aka. with strong security).")
     await ctx.send(embed=question_1_embed)
     logger.info("Question 1 sent.")
-    def is_from_user(message):
-       '''Checks if the message is from the same user that called the command'''
-       return message.author.id == ctx.author.id
     #Wait for question 1 response
     try:
-        password_message = await bot.wait_for("message", check=is_from_user, timeout=120) #Wait for a reply with a timeout of 120 seconds
-    except TimeoutError:
+        password_message = (await reply_session.wait()).message #Wait for a reply with a timeout of 120 seconds
+    except asyncio.TimeoutError:
         logger.info("No response from user!")
         await ctx.send(embed=no_response_error_message)
         return
-    password = generate_password_hash(password_message.content, "sha256")
+    try:
+        password = await hash_executor.generate_password_hash(password_message.content)
+    except HashQueueFullError:
+        logger.warning("The password could not be hashed since the hash queue is full!")
+        await ctx.send(embed=generate_busy_embed())
+        return
     logger.info("Password retrieved. Asking for roles to add...")
     #Question 2, which roles should be awarded?
     question_2_embed = Embed(
@@ -242,8 +351,8 @@ async def add_lock(ctx):
     await ctx.send(embed=question_2_embed)
     #Wait for question 2 response
     try:
-        roles_message = await bot.wait_for("message", check=is_from_user, timeout=120) #Wait for a reply with a timeout of 120 seconds
-    except TimeoutError:
+        roles_message = (await reply_session.wait()).message #Wait for a reply with a timeout of 120 seconds
+    except asyncio.TimeoutError:
         logger.info("No response from user!")
         await ctx.send(embed=no_response_error_message)
         return
@@ -268,8 +377,8 @@ async def add_lock(ctx):
     await ctx.send(embed=question_3_embed)
     #Wait for question 3 response
     try:
-        channel_message = await bot.wait_for("message", check=is_from_user, timeout=120) #Wait for a reply with a timeout of 120 seconds
-    except TimeoutError:
+        channel_message = (await reply_session.wait()).message #Wait for a reply with a timeout of 120 seconds
+    except asyncio.TimeoutError:
         logger.info("No response from user!")
         await ctx.send(embed=no_response_error_message)
         return
@@ -285,10 +394,10 @@ async def add_lock(ctx):
     mentioned_channel = channel_message.channel_mentions[0]
     channel_id = mentioned_channel.id
     #Check if a lock has been created in the channel already
-    server_config = get_guild_configuration(str(ctx.guild.id))
+    server_config = await data_async.get_guild_configuration(str(ctx.guild.id))
     if server_config != None:
         logger.info("Server configuration found. Checking for lock for this channel already...")
-        channel_lock = get_lock_for_channel_id(str(ctx.guild.id), channel_id, return_only_enabled_locks=False)
+        channel_lock = await data_async.get_lock_for_channel_id(str(ctx.guild.id), channel_id, return_only_enabled_locks=False)
         if channel_lock != None:
             logger.warning("Error! A lock for the channel exists! Returning error...")
             await ctx.send(embed=generate_error_embed(
@@ -299,7 +408,7 @@ async def add_lock(ctx):
             logger.info("No lock for the channel exist.")
     else: #Create a configuration for later
         logger.info("Guild configuration does not exist. Creating one for later...")
-        create_guild_configuration(ctx.guild.id)
+        await data_async.create_guild_configuration(ctx.guild.id)
     logger.info("Channel retrieved. Asking for custom message....")
     #Question 4, what message to show?
     question_4_embed = Embed(
@@ -311,13 +420,40 @@ async def add_lock(ctx):
     await ctx.send(embed=question_4_embed)
     #Wait for question 4 response
     try:
-        custom_text_message = await bot.wait_for("message", check=is_from_user, timeout=120) #Wait for a reply with a timeout of 120 seconds
-    except TimeoutError:
+        custom_text_message = (await reply_session.wait()).message #Wait for a reply with a timeout of 120 seconds
+    except asyncio.TimeoutError:
         logger.info("No response from user!")
         await ctx.send(embed=no_response_error_message)
         return
     custom_text = custom_text_message.content
-    logger.info("Custom text retrieved. Sending message...")
+    logger.info("Custom text retrieved. Asking for how long access should last...")
+    #Question 5, should the roles be taken back after a while?
+    question_5_embed = Embed(
+        title="Step 5: How long should access last?",
+        description="Should I take the roles back after a while? Reply with a duration, like `30m`, `24h`, `7d` or `2w`, and people will have to enter the password again after that time.",
+        color=DEFAULT_COMMAND_COLOR
+    )
+    question_5_embed.set_footer(text="Write \"forever\" and people will keep the roles!")
+    await ctx.send(embed=question_5_embed)
+    #Wait for question 5 response
+    try:
+        duration_message = (await reply_session.wait()).message #Wait for a reply with a timeout of 120 seconds
+    except asyncio.TimeoutError:
+        logger.info("No response from user!")
+        await ctx.send(embed=no_response_error_message)
+        return
+    if duration_message.content.strip().lower() == "forever":
+        authentication_duration = None
+    else:
+        authentication_duration = parse_duration(duration_message.content)
+        if authentication_duration is None or authentication_duration == 0:
+            logger.info("The duration could not be parsed! Sending error message...")
+            await ctx.send(embed=generate_error_embed(
+                "That's not a duration",
+                "I didn't understand how long access should last. Write something like `24h` or `7d`, or `forever`.\nCall the creation command again to restart the setup."
+            ))
+            return
+    logger.info("Duration retrieved. Sending message...")
     #Send the lock message
     lock_embed = Embed(
         title="📢The police is protecting here ✋",
@@ -330,9 +466,16 @@ async def add_lock(ctx):
         lock_embed.add_field(name=f"Custom message from {ctx.author.name}", value=f"`{custom_text}`", inline=False)
     else:
         logger.info("Custom text will not be added.")
+    if authentication_duration is not None:
+        lock_embed.add_field(name="⏳ Access expires", value=f"I take the roles back {format_duration(authentication_duration)} after you entered the password. Then you can just enter it again!", inline=False)
     #Add information about how to unlock
-    lock_embed.add_field(name="🔒 How to gain access to the locked channels?", value="Type `?a` in this channel, and I will send you a private message asking for the password.", inline=False)
-    lock_message = await mentioned_channel.send(embed=lock_embed)
+    if INTERACTIONS_ENABLED: #The lock message gets an Unlock button, see interactions.py
+        lock_embed.add_field(name="🔒 How to gain access to the locked channels?", value="Press **Unlock** below and enter the password. You can also type `?a` in this channel, and I will send you a private message asking for the password.", inline=False)
+        lock_message_data = await send_lock_message(bot.http, channel_id, lock_embed)
+        lock_message = mentioned_channel.get_partial_message(int(lock_message_data["id"]))
+    else:
+        lock_embed.add_field(name="🔒 How to gain access to the locked channels?", value="Type `?a` in this channel, and I will send you a private message asking for the password.", inline=False)
+        lock_message = await mentioned_channel.send(embed=lock_embed)
     logger.info("Lock message sent.")
     logger.info("Saving lock...")
     lock_data = generate_lock_data(
@@ -340,13 +483,20 @@ async def add_lock(ctx):
         password,
         custom_text,
         award_role_ids,
-        lock_message
+        lock_message,
+        authentication_duration=authentication_duration
     )
     logger.info("Data generated. Adding to config...")
-    server_config = get_guild_configuration(ctx.guild.id)
-    server_config["enabled_locks"].append(lock_data)
-    logger.info("Writing data...")
-    update_guild_config(ctx.guild.id, server_config)
+    async with get_guild_mutation_lock(ctx.guild.id):
+        #Another admin might have created a lock for the channel while we were asking questions
+        if await data_async.get_lock_for_channel_id(ctx.guild.id, channel_id, return_only_enabled_locks=False) is not None:
+            logger.warning("A lock for the channel was created during the setup! Removing lock message and returning error...")
+            await lock_message.delete()
+            await ctx.send(embed=generate_error_embed(
+                "Lock message already created!",
+                "Someone created a lock in this channel while we were setting this one up. You can only have one lock message per channel."))
+            return
+        await data_async.add_guild_lock(ctx.guild.id, lock_data)
     logger.info("Data written. Sending confirmation message...")
     confirmation_message = Embed(
         title="✅ Message created!",
@@ -372,27 +522,26 @@ async def remove_lock(ctx):
     #Get guild ID and channel ID and find lock
     guild_id = str(ctx.guild.id)
     channel_id = ctx.channel.id
-    lock_for_channel = get_lock_for_channel_id(guild_id, channel_id, return_only_enabled_locks=False)
-    if lock_for_channel == None:
-        logger.info("No lock found! Sending error message...")
-        await ctx.send(
-            embed=generate_error_embed(
-                "No lock found for channel",
-                "I couldn't find an enabled lock. Make sure that you type this command in the same channel where I have sent a message asking users to authenticate. Cheers!"
+    async with get_guild_mutation_lock(guild_id):
+        lock_for_channel = await data_async.get_lock_for_channel_id(guild_id, channel_id, return_only_enabled_locks=False)
+        if lock_for_channel == None:
+            logger.info("No lock found! Sending error message...")
+            await ctx.send(
+                embed=generate_error_embed(
+                    "No lock found for channel",
+                    "I couldn't find an enabled lock. Make sure that you type this command in the same channel where I have sent a message asking users to authenticate. Cheers!"
+                )
             )
-        )
-        return
-    logger.info("Lock found! Removing from configuration...")
-    #Remove lock from configuration
-    guild_configuration = get_guild_configuration(guild_id)
-    guild_configuration["enabled_locks"].remove(lock_for_channel)
-    logger.info("Enabled lock removed in memory. Removing lock message...")
-    #Remove the lock message sent by the bot
-    lock_message = await ctx.fetch_message(lock_for_channel["sent_information_message"]["id"])
-    logger.info("Message retrieved. Removing...")
-    await lock_message.delete()
-    logger.info("Message deleted. Updating configuration...")
-    update_guild_config(guild_id, guild_configuration)
+            return
+        logger.info("Lock found! Removing from configuration...")
+        #Remove the lock message sent by the bot. We already know its ID, so it is deleted without fetching it first
+        lock_message = ctx.channel.get_partial_message(lock_for_channel.sent_information_message_id)
+        try:
+            await lock_message.delete()
+        except NotFound:
+            logger.info("The lock message has already been deleted.")
+        logger.info("Message deleted. Updating configuration...")
+        await data_async.remove_guild_lock(guild_id, channel_id)
     logger.info("Guild configuration updated. Sending confirmation message...")
     final_message = Embed(
         title="✅ Lock removed",
@@ -403,6 +552,91 @@ async def remove_lock(ctx):
     await ctx.send(embed=final_message)
     logger.info("Message sent and lock removed. All good!")
 
+async def start_role_job(ctx, kind):
+    '''Starts a job that gives the roles of the lock in the channel to everyone that has authenticated with it (resync),
+    or takes them back (revoke). Used by the resync_roles and revoke_roles commands.'''
+    #Check if the author is the server admin
+    if not ctx.author.guild_permissions.administrator:
+        logger.info("The user is not an admin!")
+        await ctx.send(embed=generate_error_embed(
+            "You are not a server admin!",
+            "Currently, only server admins can change the roles of authenticated users."
+        ))
+        return
+    guild_id = str(ctx.guild.id)
+    channel_id = ctx.channel.id
+    if job_queue.get_job(ctx.guild.id, channel_id) is not None:
+        logger.info("A job is already running for the lock! Sending error message...")
+        await ctx.send(embed=generate_error_embed(
+            "Already on it!",
+            "I'm already changing the roles of the members of this lock. Wait until I'm done, then try again."
+        ))
+        return
+    async with get_guild_mutation_lock(guild_id):
+        lock = await data_async.get_lock_for_channel_id(guild_id, channel_id, return_only_enabled_locks=False)
+        if lock is None:
+            logger.info("No lock found! Sending error message...")
+            await ctx.send(embed=generate_error_embed(
+                "No lock found for channel",
+                "I couldn't find a lock. Make sure that you type this command in the same channel where I have sent a message asking users to authenticate. Cheers!"
+            ))
+            return
+        if kind == RESYNC and len(ctx.message.role_mentions) > 0: #The roles of the lock are replaced, for example after they were recreated
+            logger.info("Roles were mentioned. Updating the roles of the lock...")
+            lock = lock.replace(award_role_ids=[role.id for role in ctx.message.role_mentions])
+            await data_async.update_guild_lock(guild_id, lock)
+        user_ids = sorted(await data_async.get_authenticated_users(guild_id, channel_id))
+        if kind == REVOKE: #The members have to authenticate again to get the roles back
+            await data_async.clear_authenticated_users(guild_id, channel_id)
+    role_ids = [role.id for role in get_roles(ctx.guild, lock.award_role_ids)]
+    if len(role_ids) == 0 or len(user_ids) == 0:
+        logger.info("No roles or no authenticated users! Sending error message...")
+        await ctx.send(embed=generate_error_embed(
+            "Nothing to do!",
+            "The lock doesn't have any roles that still exist, or nobody has authenticated with it yet. Mention the new roles after the command to change the roles of the lock."
+        ))
+        return
+    job = RoleJob(kind, ctx.guild.id, channel_id, role_ids, len(user_ids))
+    progress_message = await ctx.send(embed=generate_job_progress_embed(job, False))
+    job.progress_channel_id = progress_message.channel.id
+    job.progress_message_id = progress_message.id
+    job_queue.submit(job, user_ids)
+
+def generate_job_progress_embed(job, finished):
+    '''Function for generating the embed that shows the progress of a role job.'''
+    if job.kind == RESYNC:
+        title = "✅ Roles given back!" if finished else "⏳ Giving roles back..."
+        description = "I'm giving the roles of this lock to everyone that has authenticated with it."
+    else:
+        title = "✅ Roles taken back!" if finished else "⏳ Taking roles back..."
+        description = "I'm taking the roles of this lock from everyone that has authenticated with it. They have to authenticate again to get them back."
+    embed = Embed(
+        title=title,
+        description=f"{description}\n➡**{job.position} of {job.total} members done.** {job.changed} changed, {job.skipped} already right or gone, {job.failed} failed.",
+        color=DEFAULT_COMMAND_COLOR
+    )
+    if not finished:
+        embed.set_footer(text="I'm going as fast as Discord lets me. This message is updated every few seconds.")
+    return embed
+
+async def on_job_progress(job, finished):
+    '''Called by the job queue to report the progress of a role job, by editing the progress message.'''
+    await bot.http.edit_message(job.progress_channel_id, job.progress_message_id, embed=generate_job_progress_embed(job, finished).to_dict())
+
+@bot.command(aliases=["sr"])
+async def resync_roles(ctx):
+    '''The resync_roles command gives the roles of the lock in the channel to everyone that has authenticated with it again,
+    for example after an admin has recreated a role. Roles mentioned after the command become the new roles of the lock first.'''
+    logger.info("Got a request to resync roles!")
+    await start_role_job(ctx, RESYNC)
+
+@bot.command(aliases=["rr"])
+async def revoke_roles(ctx):
+    '''The revoke_roles command takes the roles of the lock in the channel from everyone that has authenticated with it.
+    They have to authenticate again to get them back.'''
+    logger.info("Got a request to revoke roles!")
+    await start_role_job(ctx, REVOKE)
+
 @bot.command()
 async def help(ctx):
     '''The help command. This command is hard-coded, because the bot is simple to use and doesn't have that many commands.'''
@@ -412,9 +646,10 @@ async def help(ctx):
         description="I'm PolicemanBot, and I can help you to lock your Discord servers with a password, by giving out certain roles to people who know the right password.",
         color=DEFAULT_COMMAND_COLOR
     )
-    final_message.add_field(name="Lock a set of roles with a password", value="Type `?al` or `?add_lock` in any channel to get presented with an interactive process.", inline=False)
+    final_message.add_field(name="Lock a set of roles with a password", value="Type `?al` or `?add_lock` in any channel to get presented with an interactive process. You can choose to take the roles back after a while, like after 24 hours.", inline=False)
     final_message.add_field(name="Remove an existing lock", value="Type `?rm` or `?remove_lock` in the channel where I sent the message about an active lock to remove it.", inline=False)
-    final_message.add_field(name="Unlocking", value="Type `?a` or `?authenticate` in the channel where I sent the message about an active lock to get a private message asking you for the password.", inline=False)
+    final_message.add_field(name="Fix or take back roles", value="Type `?sr` or `?resync_roles` in the channel of a lock to give its roles to everyone that has authenticated again (mention roles after the command to replace the roles of the lock), or `?rr` or `?revoke_roles` to take them back.", inline=False)
+    final_message.add_field(name="Unlocking", value="Press the Unlock button on the message about an active lock, or type `?a` or `?authenticate` in its channel to get a private message asking you for the password.", inline=False)
     final_message.add_field(name="Permissions", value="Every server member can try to authenticate, but only admins can delete or add locks.", inline=False)
     final_message.add_field(name="Invite link", value="Invite me to your own server using the `?il` or `?invite_link` command.", inline=False)
     await ctx.send(embed=final_message)
@@ -431,20 +666,199 @@ async def invite_link(ctx):
     final_message.add_field(name="Link:", value=BOT_INVITE_LINK, inline=False)
     await ctx.send(embed=final_message)
 
+@bot.command()
+@commands.is_owner()
+async def profile(ctx, state=None, percentage: float=None):
+    '''Owner-only command for profiling commands (see profiling.py).
+    "?profile on 5" profiles 5% of the invocations of the profiled commands, "?profile off" stops, and "?profile" shows whether it is on.'''
+    logger.info("Got a request to the profile command!")
+    if state == "on" and percentage is not None and not 0 < percentage <= 100:
+        logger.info("The percentage is out of range! Sending error...")
+        await ctx.send(embed=generate_error_embed("Invalid percentage", "The percentage of invocations to profile has to be more than 0 and at most 100, like `?profile on 5`."))
+        return
+    if state == "on":
+        command_profiler.enable(percentage / 100 if percentage is not None else PROFILE_SAMPLE_RATE)
+    elif state == "off":
+        command_profiler.disable()
+    if command_profiler.enabled:
+        description = f"I'm profiling {command_profiler.sample_rate:.0%} of the invocations of {', '.join(sorted(PROFILED_COMMANDS))}, and writing the profiles to `{command_profiler.profiles_path}`."
+    else:
+        description = "I'm not profiling anything. Use `?profile on <percentage>` to start."
+    await ctx.send(embed=Embed(title="Profiling", description=description, color=DEFAULT_COMMAND_COLOR))
+
+#Interactions (see interactions.py)
+unlock_cooldown = UserCooldown(30) #Same cooldown as the authenticate command
+
+@interaction_router.handler(UNLOCK_BUTTON_ID)
+async def unlock_button(interaction):
+    '''Called when someone presses the Unlock button on a lock message. Opens a modal asking for the password.'''
+    logger.info("Got a press on an Unlock button!")
+    guild_id = str(interaction.guild_id)
+    if await data_async.get_lock_for_channel_id(guild_id, interaction.channel_id) is None:
+        logger.info("The channel does not have an enabled lock! Sending error...")
+        await interaction.send(generate_error_embed("The channel is not being tracked by me!", "It seems like this channel's does not have an active lock currently."))
+        return
+    if await data_async.is_user_authenticated(guild_id, interaction.channel_id, interaction.user_id):
+        logger.info("User has already authenticated! Sending error...")
+        await interaction.send(generate_error_embed("You have already authenticated", "Hey, you have already authenticated and I have awarded you the roles."))
+        return
+    guild = bot.get_guild(interaction.guild_id)
+    await interaction.open_modal(generate_password_modal(guild.name if guild is not None else "the server"))
+
+@interaction_router.handler(PASSWORD_MODAL_ID)
+async def unlock_password(interaction):
+    '''Called when someone submits the password modal. Checks the password and awards the roles of the lock.'''
+    logger.info("Got a password from the Unlock modal!")
+    guild_id = str(interaction.guild_id)
+    channel_id = interaction.channel_id
+    user_id = interaction.user_id
+    retry_after = unlock_cooldown.try_use(user_id)
+    if retry_after > 0:
+        logger.info("The user is on cooldown! Sending error...")
+        COOLDOWN_REJECTIONS.inc(command="unlock_password")
+        await interaction.send(generate_error_embed("Command on cooldown", f"Sorry about the inconvenience, but you may only try a password every 30 seconds. You may try again in {round(retry_after, 2)} seconds."))
+        return
+    enabled_lock = await data_async.get_lock_for_channel_id(guild_id, channel_id)
+    if enabled_lock is None:
+        logger.info("The channel does not have an enabled lock! Sending error...")
+        await interaction.send(generate_error_embed("The channel is not being tracked by me!", "It seems like this channel's does not have an active lock currently."))
+        return
+    if authentication_limiter.try_start(guild_id, channel_id) is not None:
+        logger.info("Too many authentication attempts in the guild! Rejecting...")
+        await interaction.send(generate_busy_embed())
+        return
+    #The password check can take a while if many people are unlocking, so the response is deferred if it does
+    try:
+        password_is_correct = await interaction.wait_or_defer(hash_executor.check_password(enabled_lock.password, interaction.get_text_input(PASSWORD_INPUT_ID) or ""))
+    except HashQueueFullError:
+        logger.warning("The password could not be checked since the hash queue is full!")
+        await interaction.send(generate_busy_embed())
+        return
+    finally:
+        authentication_limiter.finish(guild_id)
+    if password_is_correct is False:
+        logger.info("An incorrect password was entered!")
+        AUTHENTICATION_OUTCOMES.inc(outcome="wrong_password")
+        error_embed = generate_error_embed("✋ Access denied! ✋", "Sorry, it seems like you didn't enter the correct password. I'm therefore doin' my job and keeping you out!")
+        error_embed.set_footer(text="You may try again in 30 seconds.")
+        await interaction.send(error_embed)
+        return
+    logger.info("A correct password was entered!")
+    AUTHENTICATION_OUTCOMES.inc(outcome="success")
+    #The member's roles are in the interaction, so all roles are set in one request without fetching the member
+    guild = bot.get_guild(interaction.guild_id)
+    award_role_ids = [role.id for role in get_roles(guild, enabled_lock.award_role_ids)] if guild is not None else enabled_lock.award_role_ids
+    member_role_ids = set(interaction.member_role_ids)
+    if not member_role_ids.issuperset(award_role_ids):
+        logger.info("Awarding %s roles...", len(award_role_ids))
+        await bot.http.edit_member(interaction.guild_id, user_id, roles=sorted(member_role_ids.union(award_role_ids)))
+        logger.info("Roles awarded.")
+    logger.info("Saving authenticated user...")
+    expires_at = await save_authenticated_user(guild_id, channel_id, user_id, enabled_lock)
+    logger.info("Authenticated user saved. Sending final embed...")
+    await interaction.send(Embed(
+        title="✅ Oh yeah, that's correct!",
+        description=f"I have now let ya in! I awarded you some roles since you enterred the correct password.{generate_expiry_text(expires_at)}",
+        color=DEFAULT_COMMAND_COLOR
+    ))
+
+#Expiring authentications (see expiry.py)
+async def on_authentications_expired(guild_id, channel_id, expirations):
+    '''Called by the expiry scheduler with a batch of authentications that have expired.
+    They are removed, and a job takes the roles of the lock back from the users.'''
+    guild_id = str(guild_id)
+    async with get_guild_mutation_lock(guild_id):
+        lock = await data_async.get_lock_for_channel_id(guild_id, channel_id, return_only_enabled_locks=False)
+        if lock is None: #The lock has been removed since
+            return
+        user_ids = await data_async.remove_expired_authentications(guild_id, channel_id, expirations)
+    guild = bot.get_guild(int(guild_id))
+    role_ids = [role.id for role in get_roles(guild, lock.award_role_ids)] if guild is not None else []
+    if len(user_ids) == 0 or len(role_ids) == 0:
+        return
+    logger.info("Taking roles back from %s users whose authentication expired...", len(user_ids))
+    job = RoleJob(REVOKE, int(guild_id), channel_id, role_ids, len(user_ids), job_id=f"{guild_id}-{channel_id}-expired-{time.time_ns()}")
+    job_queue.submit(job, user_ids)
+
+#Hooks
+@bot.before_invoke
+async def start_command_timer(ctx):
+    '''Called before every command. Remembers when the command started, for the command latency metric.'''
+    ctx.started_at = time.perf_counter()
+    if command_profiler.enabled:
+        command_profiler.start(ctx)
+
+@bot.after_invoke
+async def stop_command_timer(ctx):
+    '''Called after every command, even if it failed. Records the command latency metric.'''
+    COMMAND_SECONDS.observe(time.perf_counter() - ctx.started_at, command=ctx.command.name, status="error" if ctx.command_failed else "ok")
+    if command_profiler.enabled:
+        await command_profiler.stop(ctx)
+
 #Events
+async def is_possible_command(message):
+    '''Function for checking if a message should go through command handling, which builds a context and parses the message.
+    Messages without the prefix, unknown commands, and ?authenticate in channels without a lock are dropped.
+    Replies to waiting commands don't need command handling, since the reply dispatcher gets every message.'''
+    content = message.content
+    if not content.startswith(BOT_COMMAND_PREFIX) or message.author.bot:
+        return False
+    words = content[len(BOT_COMMAND_PREFIX):].split(None, 1)
+    command = bot.all_commands.get(words[0]) if len(words) > 0 else None
+    if command is None:
+        FILTERED_COMMANDS.inc(reason="unknown_command")
+        return False
+    if command is authenticate and message.guild is not None and not await data_async.is_channel_tracked(message.guild.id, message.channel.id):
+        FILTERED_COMMANDS.inc(reason="untracked_channel")
+        return False
+    return True
+
+@bot.event
+async def on_message(message):
+    if await is_possible_command(message):
+        await bot.process_commands(message)
+
+async def on_ambiguous_reply(message, sessions):
+    '''Called when a user that is authenticating in several servers replies without saying which server the reply is for.'''
+    session_list = "\n".join(f"`#{session.code}` - {session.label}" for session in sessions)
+    await message.channel.send(
+        embed=generate_error_embed(
+            "Which server was that for?",
+            f"You're authenticating in more than one server right now, so start your reply with the code of the server, like `#1 password`.\n{session_list}"
+        )
+    )
+
+reply_dispatcher.attach(bot, on_ambiguous_reply)
+interaction_router.attach(bot)
+job_queue.attach(bot, on_job_progress)
+expiry_scheduler.attach(on_authentications_expired)
+instrument_http_client(bot.http)
+
 @bot.event
 async def on_ready(*args):
     logger.info("Bot is ready!")
+    await start_metrics_server()
+    if PRELOAD_GUILDS:
+        guild_ids = [guild.id for guild in bot.guilds]
+        await bot.loop.run_in_executor(None, preload_guild_configurations, guild_ids)
+    job_queue.start()
+    await expiry_scheduler.start([guild.id for guild in bot.guilds])
     logger.info("Changing presence...")
     await bot.change_presence(activity=Game(name=f"{BOT_COMMAND_PREFIX}help | PolicemanBot - lock any server with a password!"))
 
+cooldown_replies = ReplyCoalescer(REJECTION_REPLY_INTERVAL) #Cooldown errors are only sent once per channel at a time, so that a raid can't make the bot send one per account
+
 @bot.event
 async def on_command_error(ctx, error):
     logger.warning("Currently handling an error - yikes, that's no good!")
     original_error = getattr(error, "original", error)
-    logger.info(f"Original error: {original_error}.")
+    logger.info("Original error: %s.", original_error)
     if isinstance(error, commands.CommandOnCooldown):
         logger.info("The error is a cooldown error! Sending message...")
+        COOLDOWN_REJECTIONS.inc(command=ctx.command.name)
+        if not cooldown_replies.should_reply(ctx.channel.id):
+            logger.info("A cooldown error was sent in the channel recently! Skipping message...")
+            return
         await ctx.send(
             embed=generate_error_embed(
                 "Command on cooldown",
@@ -453,6 +867,8 @@ async def on_command_error(ctx, error):
         )
     elif isinstance(error, commands.CommandNotFound):
         logger.info("The command was not found! Ignoring exception...")
+    elif isinstance(error, commands.NotOwner):
+        logger.info("The command is only for the bot owner! Ignoring exception...")
     else:
         logger.critical("The exception was unhandled!")
         await ctx.send(
@@ -461,5 +877,46 @@ async def on_command_error(ctx, error):
         )
 
 #Logg in and start the bot
-logger.info("Logging in bot...")
-bot.run(BOT_TOKEN)
+def get_guild_snapshot_path():
+    '''Returns the path of the guild snapshot. Every worker of a cluster has its own snapshot, since it serves its own guilds.'''
+    if sharding_options is None:
+        return GUILD_SNAPSHOT_PATH
+    return os.path.join(DATA_PATH, f"guild_snapshot-{SHARD_COUNT}-{SHARD_IDS or 'all'}.bin")
+
+def get_capture_path():
+    '''Returns the path of the traffic capture. Every worker of a cluster writes its own capture, since it serves its own guilds.'''
+    if sharding_options is None:
+        return CAPTURE_PATH
+    root, extension = os.path.splitext(CAPTURE_PATH)
+    if extension == ".gz": #Like trace.jsonl.gz
+        root, inner_extension = os.path.splitext(root)
+        extension = inner_extension + extension
+    return f"{root}-{SHARD_COUNT}-{SHARD_IDS or 'all'}{extension}"
+
+def run_bot():
+    '''Starts the guild configuration flusher and runs the bot until it is stopped.'''
+    if BOT_TOKEN is None:
+        raise KeyError("The POLICEBOT_BOT_TOKEN environment variable has to be set to the bot token.")
+    if not direct_messages_received:
+        logger.warning("This worker doesn't serve shard 0, so it doesn't get DMs. ?a answers with an Unlock button instead of asking for the password in a DM (see cluster.py).")
+    if GUILD_SNAPSHOT_ENABLED:
+        logger.info("Loading guild snapshot...")
+        load_guild_snapshot(get_guild_snapshot_path())
+    logger.info("Starting guild configuration flusher...")
+    start_guild_configuration_flusher()
+    command_profiler.install_signal_handler(bot.loop)
+    if CAPTURE_PATH is not None:
+        traffic_capture.start(bot, get_capture_path(), DURATION_PATTERN)
+    logger.info("Logging in bot...")
+    try:
+        bot.run(BOT_TOKEN)
+    finally:
+        logger.info("Bot stopped. Writing pending guild configurations...")
+        data_async.io_executor.shutdown() #Changes that are still being written finish first
+        traffic_capture.stop()
+        stop_guild_configuration_flusher()
+    if GUILD_SNAPSHOT_ENABLED: #Only written after a clean shutdown, since it has to match the data in storage
+        write_guild_snapshot(get_guild_snapshot_path())
+
+if __name__ == "__main__":
+    run_bot()
@@ -0,0 +1,371 @@
+'''Maintenance.py
+Offline checks and repairs for the data directory of the JSON storage backend.
+
+Stop the bot before running this, since it changes guild data without going through the bot's cache. The guild directories
+in data/guilds are checked by a pool of processes, which:
+* validate config.json, and remove locks that the bot can not use, and all but the last lock of a channel
+* rebuild a damaged config.json from the journal, if the journal has the locks
+* compact the journal into new snapshots, dropping incomplete or broken records
+* remove duplicate authenticated users, repair snapshots that end with a partially written entry,
+  and forget when authentications expire for users that are not authenticated
+* move authenticated users stored in config.json by older versions of the bot into snapshots
+* delete snapshots of channels without a lock, temporary files left behind by interrupted writes,
+  and guild directories without locks (like the ones left behind when an admin abandons ?add_lock)
+Damaged role jobs in data/jobs are removed as well, and so are guild snapshots (data/guild_snapshot*.bin), since they would bring back the old data.
+Files are only ever replaced with atomic renames. Run it with --dry-run first to see what it would change:
+python maintenance.py --dry-run --report maintenance_report.json
+
+Whether the channel of a lock still exists can only be checked with Discord, so locks are only removed if their data is broken.'''
+
+import os, json, time, shutil, logging, argparse
+from collections import Counter
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from storage import JSONStorageBackend, read_json_from_file, DATA_PATH, AUTHENTICATED_USERS_DIRECTORY_NAME, \
+    JOURNAL_ADD_LOCK, JOURNAL_UPDATE_LOCK, JOURNAL_SET_CONFIGURATION
+from data import GuildLockIndex
+from models import GuildConfig
+from jobs import RoleJob, JOBS_DIRECTORY_NAME
+
+#Settings
+MAINTENANCE_WORKERS = os.cpu_count() or 1
+MAINTENANCE_CHUNK_SIZE = 64 #Guilds handed to a worker process at once
+PROGRESS_INTERVAL = 10000 #Guilds between progress messages
+#Lock keys that the bot needs, and their types
+LOCK_SCHEMA = {
+    "channel_id": int,
+    "enabled": bool,
+    "password": str,
+    "award_role_ids": list,
+    "sent_information_message": dict
+}
+#Lock keys that the bot can do without, and their types
+OPTIONAL_LOCK_SCHEMA = {
+    "custom_message": (str, type(None)),
+    "created_at": (str, type(None)),
+    "authentication_duration": (int, type(None))
+}
+USER_ID_SIZE = 8 #Bytes per user ID in authenticated users snapshots
+EXPIRATION_SIZE = 16 #Bytes per (user ID, expiry timestamp) pair in expirations snapshots
+
+#Logging
+logger = logging.getLogger(__name__)
+
+class MaintenanceReport:
+    '''The changes made to a guild directory (or the jobs or snapshots), and the problems that could not be fixed.'''
+    def __init__(self, subject):
+        self.subject = subject
+        self.changes = []
+        self.problems = []
+        self.counts = Counter() #Kind of change --> number of changed things
+        self.needs_rewrite = False #Whether the guild data has changed and new snapshots have to be written
+
+    def change(self, kind, description, count=1, rewrite=True):
+        '''Records a change. Changes to the guild data (rewrite=True) are written as new snapshots.'''
+        self.changes.append(description)
+        self.counts[kind] += count
+        self.needs_rewrite = self.needs_rewrite or rewrite
+
+def remove_file(path, dry_run):
+    if not dry_run:
+        os.remove(path)
+
+def read_journal(journal_path):
+    '''Reads the records of a journal. Returns (records, number of incomplete records).'''
+    records = []
+    incomplete_records = 0
+    if not os.path.exists(journal_path):
+        return records, incomplete_records
+    with open(journal_path, "r") as journal_file:
+        for line in journal_file:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                incomplete_records += 1
+    return records, incomplete_records
+
+def get_lock_problem(lock):
+    '''Returns why a lock can not be used by the bot, or None if it can.'''
+    if not isinstance(lock, dict):
+        return "it is not an object"
+    for key, key_type in LOCK_SCHEMA.items():
+        if not isinstance(lock.get(key), key_type):
+            return f"{key} is missing or not a {key_type.__name__}"
+    if not all(isinstance(role_id, int) for role_id in lock["award_role_ids"]):
+        return "award_role_ids has something else than role IDs"
+    if not isinstance(lock["sent_information_message"].get("id"), int):
+        return "sent_information_message has no message ID"
+    return None
+
+def validate_configuration(configuration, report, source):
+    '''Removes the locks of a configuration that the bot can not use, and all but the last lock of every channel, like the bot's index does.
+    Returns False if the configuration itself can not be used.'''
+    if not isinstance(configuration, dict) or not isinstance(configuration.get("enabled_locks"), list):
+        return False
+    if "configuration_created_at" not in configuration:
+        configuration["configuration_created_at"] = None
+        report.change("fixed_configurations", f"Added the missing configuration_created_at to {source}")
+    locks = []
+    positions = {} #Channel ID --> position in locks
+    for position, lock in enumerate(configuration["enabled_locks"]):
+        problem = get_lock_problem(lock)
+        if problem is not None:
+            report.change("removed_locks", f"Removed lock {position} from {source}, since {problem}")
+            continue
+        for key, key_types in OPTIONAL_LOCK_SCHEMA.items():
+            if key in lock and not isinstance(lock[key], key_types):
+                lock[key] = None
+                report.change("fixed_locks", f"Reset {key} of the lock for channel {lock['channel_id']} in {source}, since it had the wrong type")
+        channel_id = lock["channel_id"]
+        if channel_id in positions:
+            locks[positions[channel_id]] = lock
+            report.change("removed_locks", f"Removed an older duplicate lock for channel {channel_id} from {source}")
+        else:
+            positions[channel_id] = len(locks)
+            locks.append(lock)
+    configuration["enabled_locks"] = locks
+    return True
+
+def is_usable_journal_record(record, report):
+    '''Checks the lock or configuration in a journal record before it is applied.'''
+    if not isinstance(record, dict):
+        return False
+    if record.get("op") in (JOURNAL_ADD_LOCK, JOURNAL_UPDATE_LOCK):
+        return get_lock_problem(record.get("lock")) is None
+    if record.get("op") == JOURNAL_SET_CONFIGURATION:
+        return validate_configuration(record.get("configuration"), report, "a journal record")
+    return True
+
+def check_authenticated_users(backend, guild_index, channel_id, report):
+    '''Loads the snapshots of a lock, and marks them for rewriting if they have duplicates or end with a partially written entry.'''
+    snapshots = (
+        (backend.get_authenticated_users_path(guild_index.guild_id, channel_id), USER_ID_SIZE, guild_index.get_authenticated_users, "users"),
+        (backend.get_authentication_expirations_path(guild_index.guild_id, channel_id), EXPIRATION_SIZE, guild_index.get_authentication_expirations, "expirations")
+    )
+    for path, entry_size, load, entry_name in snapshots:
+        if not os.path.exists(path):
+            continue
+        size = os.path.getsize(path)
+        duplicates = size // entry_size - len(load(channel_id))
+        filename = os.path.basename(path)
+        if size % entry_size != 0:
+            guild_index.changed_authenticated_users.add(channel_id)
+            report.change("repaired_files", f"Repaired {filename}, which ended with a partially written entry")
+        if duplicates > 0:
+            guild_index.changed_authenticated_users.add(channel_id)
+            report.change("removed_duplicates", f"Removed {duplicates} duplicate {entry_name} from {filename}", duplicates)
+
+def maintain_guild(guilds_path, guild_id, dry_run=False):
+    '''Checks and repairs the directory of a guild. Runs in a worker process, and returns a MaintenanceReport.'''
+    report = MaintenanceReport(guild_id)
+    try:
+        check_guild(JSONStorageBackend(guilds_path), guild_id, dry_run, report)
+    except Exception as exception:
+        logger.exception("Checking guild %s failed!", guild_id)
+        report.problems.append(f"Checking the guild failed: {exception!r}")
+    return report
+
+def check_guild(backend, guild_id, dry_run, report):
+    guild_path, configuration_path = backend.get_guild_paths(guild_id)
+    authenticated_users_path = os.path.join(guild_path, AUTHENTICATED_USERS_DIRECTORY_NAME)
+    if not guild_id.isdigit():
+        report.problems.append("The directory name is not a guild ID. Leaving it alone...")
+        return
+    for directory in (guild_path, authenticated_users_path):
+        if not os.path.isdir(directory):
+            continue
+        for filename in os.listdir(directory):
+            if filename.endswith(".tmp"):
+                remove_file(os.path.join(directory, filename), dry_run)
+                report.change("removed_files", f"Removed {filename}, left behind by an interrupted write", rewrite=False)
+    #Read and validate the configuration
+    records, incomplete_records = read_journal(backend.get_journal_path(guild_id))
+    try:
+        configuration = read_json_from_file(configuration_path)
+        damaged = not validate_configuration(configuration, report, "config.json")
+    except FileNotFoundError:
+        configuration, damaged = None, False
+    except ValueError: #Truncated or otherwise not JSON
+        configuration, damaged = None, True
+    if configuration is None or damaged:
+        has_locks_in_journal = any(isinstance(record, dict) and record.get("op") in (JOURNAL_ADD_LOCK, JOURNAL_UPDATE_LOCK, JOURNAL_SET_CONFIGURATION) for record in records)
+        if damaged and has_locks_in_journal:
+            configuration = GuildConfig().to_dict()
+            report.change("rebuilt_configurations", "Rebuilt the damaged config.json from the journal")
+        elif damaged:
+            report.problems.append("config.json is damaged, and the journal has no locks to rebuild it from. Leaving it alone...")
+            return
+        else: #The bot ignores a guild without config.json
+            if not dry_run:
+                shutil.rmtree(guild_path)
+            report.change("removed_directories", "Removed the directory, since it has no config.json", rewrite=False)
+            return
+    #Authenticated users stored in the configuration by older versions of the bot
+    legacy_user_ids = {lock["channel_id"]: lock.pop("authenticated_users") for lock in configuration["enabled_locks"] if "authenticated_users" in lock}
+    guild_index = GuildLockIndex(guild_id, GuildConfig.from_dict(configuration), storage_backend=backend)
+    for channel_id in guild_index.channel_ids:
+        check_authenticated_users(backend, guild_index, channel_id, report)
+    for channel_id, user_ids in legacy_user_ids.items():
+        if not isinstance(user_ids, list) or not all(isinstance(user_id, int) for user_id in user_ids):
+            report.change("fixed_locks", f"Removed the broken list of authenticated users of channel {channel_id} from config.json")
+            continue
+        for user_id in user_ids:
+            guild_index.add_authenticated_user(channel_id, user_id)
+        report.change("migrated_users", f"Moved {len(set(user_ids))} authenticated users of channel {channel_id} from config.json into a snapshot", len(set(user_ids)))
+    #Compact the journal
+    skipped_records = incomplete_records
+    for record in records:
+        if not is_usable_journal_record(record, report):
+            skipped_records += 1
+            continue
+        try:
+            guild_index.apply_journal_record(record)
+        except (KeyError, TypeError, ValueError):
+            skipped_records += 1
+    if len(records) > 0:
+        report.change("compacted_records", f"Compacted {len(records)} journal records into snapshots", len(records))
+    if skipped_records > 0:
+        report.change("skipped_records", f"Dropped {skipped_records} incomplete or broken journal records", skipped_records)
+    #Expirations of users that are not authenticated
+    for channel_id in guild_index.channel_ids:
+        authenticated_users = guild_index.get_authenticated_users(channel_id)
+        authentication_expirations = guild_index.get_authentication_expirations(channel_id)
+        stale_user_ids = [user_id for user_id in authentication_expirations if user_id not in authenticated_users]
+        for user_id in stale_user_ids:
+            del authentication_expirations[user_id]
+        if len(stale_user_ids) > 0:
+            guild_index.changed_authenticated_users.add(channel_id)
+            report.change("removed_expirations", f"Forgot when {len(stale_user_ids)} authentications for channel {channel_id} expire, since the users are not authenticated", len(stale_user_ids))
+    if len(guild_index.channel_ids) == 0:
+        if not dry_run:
+            shutil.rmtree(guild_path)
+        report.change("removed_directories", "Removed the directory, since the guild has no locks", rewrite=False)
+        return
+    #Snapshots of channels without a lock
+    if os.path.isdir(authenticated_users_path):
+        for filename in sorted(os.listdir(authenticated_users_path)):
+            channel_id = filename.split(".", 1)[0]
+            if filename.endswith(".tmp"):
+                continue
+            if not filename.endswith(".bin") or not channel_id.isdigit():
+                report.problems.append(f"Unknown file {AUTHENTICATED_USERS_DIRECTORY_NAME}/{filename}. Leaving it alone...")
+            elif int(channel_id) not in guild_index.channel_ids:
+                remove_file(os.path.join(authenticated_users_path, filename), dry_run)
+                report.change("removed_files", f"Removed {filename}, since channel {channel_id} has no lock", rewrite=False)
+    if report.needs_rewrite and not dry_run:
+        changed_channel_ids = guild_index.changed_authenticated_users
+        backend.write_guild(
+            guild_id,
+            guild_index.configuration.to_dict(),
+            {channel_id: guild_index.get_authenticated_users(channel_id) for channel_id in changed_channel_ids},
+            {channel_id: guild_index.get_authentication_expirations(channel_id) for channel_id in changed_channel_ids}
+        )
+
+def maintain_jobs(jobs_path, dry_run=False):
+    '''Removes role jobs that can not be resumed, since their state or member IDs are damaged or missing.'''
+    report = MaintenanceReport("jobs")
+    if not os.path.isdir(jobs_path):
+        return report
+    filenames = set(os.listdir(jobs_path))
+    for filename in sorted(filenames):
+        path = os.path.join(jobs_path, filename)
+        job_id, extension = os.path.splitext(filename)
+        if extension == ".tmp":
+            remove_file(path, dry_run)
+            report.change("removed_files", f"Removed {filename}, left behind by an interrupted write")
+        elif extension == ".json":
+            user_ids_path = os.path.join(jobs_path, f"{job_id}.users")
+            try:
+                job = RoleJob(**read_json_from_file(path))
+                problem = None if os.path.getsize(user_ids_path) == job.total * USER_ID_SIZE and 0 <= job.position <= job.total else "its member IDs don't match its state"
+            except FileNotFoundError:
+                problem = "its member IDs are missing"
+            except (ValueError, TypeError):
+                problem = "its state is damaged"
+            if problem is not None:
+                for job_path in (path, user_ids_path):
+                    if os.path.exists(job_path):
+                        remove_file(job_path, dry_run)
+                report.change("removed_jobs", f"Removed job {job_id}, since {problem}")
+        elif extension == ".users":
+            if f"{job_id}.json" not in filenames:
+                remove_file(path, dry_run)
+                report.change("removed_files", f"Removed {filename}, since its job has no state")
+        else:
+            report.problems.append(f"Unknown file {filename}. Leaving it alone...")
+    return report
+
+def remove_guild_snapshots(data_path, dry_run=False):
+    '''Removes the guild snapshots written on shutdown, since they hold the guild data from before the maintenance.'''
+    report = MaintenanceReport("snapshots")
+    for filename in sorted(os.listdir(data_path)):
+        if filename.startswith("guild_snapshot") and filename.endswith(".bin"):
+            remove_file(os.path.join(data_path, filename), dry_run)
+            report.change("removed_files", f"Removed {filename}, since it holds the guild data from before the maintenance")
+    return report
+
+def run_maintenance(data_path=DATA_PATH, worker_count=MAINTENANCE_WORKERS, dry_run=False):
+    '''Checks and repairs every guild directory, the role jobs and the guild snapshots. Returns a summary of what was changed.'''
+    guilds_path = os.path.join(data_path, "guilds")
+    started_at = time.perf_counter()
+    with os.scandir(guilds_path) as entries:
+        guild_ids = sorted(entry.name for entry in entries if entry.is_dir())
+    logger.info("Checking %s guild directories with %s processes%s...", len(guild_ids), worker_count, " (dry run)" if dry_run else "")
+    reports = []
+    counts = Counter()
+    rewritten_guilds = 0
+    with ProcessPoolExecutor(max_workers=worker_count) as executor:
+        guild_reports = executor.map(partial(maintain_guild, guilds_path, dry_run=dry_run), guild_ids, chunksize=MAINTENANCE_CHUNK_SIZE)
+        for checked_guilds, report in enumerate(guild_reports, 1):
+            if report.needs_rewrite and "removed_directories" not in report.counts:
+                rewritten_guilds += 1
+            if len(report.changes) > 0 or len(report.problems) > 0: #Only keep the reports that have something to say, since there can be many guilds
+                reports.append(report)
+                counts.update(report.counts)
+            if checked_guilds % PROGRESS_INTERVAL == 0:
+                logger.info("Checked %s of %s guilds...", checked_guilds, len(guild_ids))
+    jobs_report = maintain_jobs(os.path.join(data_path, JOBS_DIRECTORY_NAME), dry_run)
+    counts.update(jobs_report.counts)
+    reports.append(jobs_report)
+    if sum(counts.values()) > 0:
+        snapshots_report = remove_guild_snapshots(data_path, dry_run)
+        counts.update(snapshots_report.counts)
+        reports.append(snapshots_report)
+    return {
+        "dry_run": dry_run,
+        "seconds": round(time.perf_counter() - started_at, 2),
+        "checked_guilds": len(guild_ids),
+        "rewritten_guilds": rewritten_guilds,
+        "counts": dict(counts),
+        "problems": sum(len(report.problems) for report in reports),
+        "reports": {report.subject: {"changes": report.changes, "problems": report.problems} for report in reports if len(report.changes) > 0 or len(report.problems) > 0}
+    }
+
+def print_summary(summary, verbose=False):
+    '''Prints what was changed, and every change and problem if verbose is True (problems are always printed).'''
+    for subject, report in summary["reports"].items():
+        for change in report["changes"] if verbose else []:
+            print(f"{subject}: {change}")
+        for problem in report["problems"]:
+            print(f"{subject}: PROBLEM: {problem}")
+    print(f"{'Dry run, nothing was changed. ' if summary['dry_run'] else ''}Checked {summary['checked_guilds']} guilds in {summary['seconds']} seconds.")
+    print(f"{summary['rewritten_guilds']} guilds {'would get' if summary['dry_run'] else 'got'} new snapshots.")
+    for kind, count in sorted(summary["counts"].items()):
+        print(f"{kind.replace('_', ' ').capitalize()}: {count}")
+    print(f"Problems that need a look: {summary['problems']}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline checks and repairs for the data directory. Stop the bot first!")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be changed")
+    parser.add_argument("--workers", type=int, default=MAINTENANCE_WORKERS, help="number of worker processes (default: the number of CPUs)")
+    parser.add_argument("--data-path", default=DATA_PATH, help="the data directory (default: data/ next to this script)")
+    parser.add_argument("--report", help="write every change and problem as JSON to this file")
+    parser.add_argument("--verbose", action="store_true", help="print every change, not just the totals")
+    arguments = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    summary = run_maintenance(arguments.data_path, arguments.workers, arguments.dry_run)
+    print_summary(summary, arguments.verbose)
+    if arguments.report is not None:
+        with open(arguments.report, "w") as report_file:
+            json.dump(summary, report_file, indent=4)
+        print(f"Report written to {arguments.report}.")
@@ -0,0 +1,212 @@
+'''Metrics.py
+Counters, gauges and histograms for the bot, exposed in the Prometheus text format.
+
+The metrics are served over HTTP from the bot's own event loop (see start_metrics_server).
+The address is set with the POLICEBOT_METRICS_HOST and POLICEBOT_METRICS_PORT environment variables.
+Set POLICEBOT_METRICS_PORT to 0 to turn the endpoint off.'''
+
+import os, time, asyncio, logging, threading
+from bisect import bisect_left
+
+#Settings
+METRICS_HOST = os.environ.get("POLICEBOT_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("POLICEBOT_METRICS_PORT", 9464))
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+#Logging
+logger = logging.getLogger(__name__)
+
+def escape_label_value(value):
+    '''Escapes a label value for the Prometheus text format.'''
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(labelnames, labelvalues, extra=""):
+    '''Formats label names and values as a Prometheus label set.'''
+    labels = [f'{name}="{escape_label_value(value)}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+class Metric:
+    '''Base class for metrics. Metrics can have labels, and keep one value per combination of label values.'''
+    type = None
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock() #Metrics are also updated from background threads
+        self.values = {}
+
+    def get_labelvalues(self, labels):
+        '''Returns the label values for a dict of labels, in the order of the label names.'''
+        return tuple(labels[labelname] for labelname in self.labelnames)
+
+    def render(self):
+        '''Returns the metric in the Prometheus text format.'''
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+        with self.lock:
+            for labelvalues, value in sorted(self.values.items()):
+                lines.extend(self.render_value(labelvalues, value))
+        return "\n".join(lines)
+
+    def render_value(self, labelvalues, value):
+        return [f"{self.name}{format_labels(self.labelnames, labelvalues)} {value}"]
+
+class Counter(Metric):
+    '''A value that only goes up.'''
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        labelvalues = self.get_labelvalues(labels)
+        with self.lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+class Gauge(Metric):
+    '''A value that can go up and down. A gauge can also read its value from a function when it is rendered.'''
+    type = "gauge"
+
+    def __init__(self, name, description, labelnames=(), function=None):
+        super().__init__(name, description, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.get_labelvalues(labels)] = value
+
+    def render(self):
+        if self.function is not None:
+            self.set(self.function())
+        return super().render()
+
+class Histogram(Metric):
+    '''Counts observations in buckets, and keeps their sum and count.'''
+    type = "histogram"
+
+    def __init__(self, name, description, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        labelvalues = self.get_labelvalues(labels)
+        with self.lock:
+            observations = self.values.get(labelvalues)
+            if observations is None:
+                observations = self.values[labelvalues] = [[0] * (len(self.buckets) + 1), 0, 0] #Bucket counts, sum, count
+            observations[0][bisect_left(self.buckets, value)] += 1
+            observations[1] += value
+            observations[2] += 1
+
+    def time(self, **labels):
+        '''Returns a context manager that observes the time spent inside it.'''
+        return Timer(self, labels)
+
+    def render_value(self, labelvalues, observations):
+        bucket_counts, observation_sum, observation_count = observations
+        lines = []
+        cumulative_count = 0
+        for bucket, bucket_count in zip(self.buckets + ("+Inf",), bucket_counts):
+            cumulative_count += bucket_count
+            bucket_label = f'le="{bucket}"'
+            lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labelvalues, bucket_label)} {cumulative_count}")
+        lines.append(f"{self.name}_sum{format_labels(self.labelnames, labelvalues)} {observation_sum}")
+        lines.append(f"{self.name}_count{format_labels(self.labelnames, labelvalues)} {observation_count}")
+        return lines
+
+class Timer:
+    '''Context manager that observes the time spent inside it in a histogram.'''
+    __slots__ = ("histogram", "labels", "started_at")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.started_at, **self.labels)
+
+class Registry:
+    '''A collection of metrics.'''
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        '''Returns all metrics in the Prometheus text format.'''
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+registry = Registry()
+
+#Metrics
+COMMAND_SECONDS = registry.histogram("policebot_command_seconds", "Time spent running commands.", ["command", "status"])
+STORAGE_SECONDS = registry.histogram("policebot_storage_seconds", "Time spent in storage operations.", ["operation"])
+HASH_SECONDS = registry.histogram("policebot_hash_seconds", "Time spent hashing or checking passwords, excluding queueing.", ["operation"])
+HASH_QUEUE_SECONDS = registry.histogram("policebot_hash_queue_seconds", "Time hash operations waited for a free worker.")
+HASH_REJECTIONS = registry.counter("policebot_hash_rejections_total", "Hash operations rejected because the queue was full.")
+AUTHENTICATION_OUTCOMES = registry.counter("policebot_authentication_outcomes_total", "Outcomes of authentication attempts that reached the DM stage.", ["outcome"])
+COOLDOWN_REJECTIONS = registry.counter("policebot_cooldown_rejections_total", "Commands rejected because they were on cooldown.", ["command"])
+FILTERED_COMMANDS = registry.counter("policebot_filtered_commands_total", "Messages with the command prefix dropped before command handling.", ["reason"])
+SHED_AUTHENTICATIONS = registry.counter("policebot_shed_authentications_total", "Authentication attempts rejected by the per-lock and per-guild limits.", ["reason"])
+DISCORD_HTTP_SECONDS = registry.histogram("policebot_discord_http_seconds", "Latency of requests to the Discord HTTP API.", ["method", "route", "status"])
+
+def instrument_http_client(http_client):
+    '''Wraps the request method of a discord.py HTTPClient so that the latency of every request is recorded.
+    Requests are labelled with their route template (like /channels/{channel_id}/messages), not the filled in path.'''
+    request = http_client.request
+
+    async def timed_request(route, **kwargs):
+        started_at = time.perf_counter()
+        status = "ok"
+        try:
+            return await request(route, **kwargs)
+        except Exception as e:
+            status = str(getattr(e, "status", "error"))
+            raise
+        finally:
+            DISCORD_HTTP_SECONDS.observe(time.perf_counter() - started_at, method=route.method, route=route.path, status=status)
+
+    http_client.request = timed_request
+
+async def handle_metrics_request(reader, writer):
+    '''Handles one HTTP request to the metrics server.'''
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+        #Read (and ignore) the headers
+        while (await asyncio.wait_for(reader.readline(), timeout=10)) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, content_type, body = "200 OK", "text/plain; version=0.0.4; charset=utf-8", registry.render().encode("utf-8")
+        else:
+            status, content_type, body = "404 Not Found", "text/plain; charset=utf-8", b"Not found. Metrics are served at /metrics.\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+metrics_server = None
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    '''Starts serving the metrics on the running event loop. Does nothing if the port is 0 or the server is already running.'''
+    global metrics_server
+    if metrics_server is not None or port == 0:
+        return
+    metrics_server = await asyncio.start_server(handle_metrics_request, host, port)
+    logger.info("Serving metrics on http://%s:%s/metrics", host, port)
@@ -0,0 +1,113 @@
+'''Models.py
+Compact models for guild configurations and locks.
+
+The guild configuration cache in data.py can hold the configurations of every guild of the bot, so they are kept
+as slotted objects instead of nested dicts: IDs are ints, timestamps are Unix timestamps instead of strings, and
+role IDs are tuples. Storage backends and journal records keep using the JSON layout that the bot has always used,
+and the models are converted from and to it with from_dict and to_dict.'''
+
+import datetime
+
+#Lock keys in the JSON layout that have their own attribute
+LOCK_KEYS = frozenset(("enabled", "channel_id", "password", "custom_message", "award_role_ids", "sent_information_message", "created_at", "authentication_duration"))
+
+def parse_timestamp(text):
+    '''Parses a timestamp stored as str(datetime), like "2021-07-10 12:00:00.123456+00:00", into a Unix timestamp.
+    Timestamps without a timezone are in UTC, like every timestamp the bot writes. Returns None for missing timestamps,
+    and the text itself if it can't be parsed, so that it is written back as it was.'''
+    if not isinstance(text, str):
+        return None
+    try:
+        parsed = datetime.datetime.fromisoformat(text)
+    except ValueError:
+        return text
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+def format_timestamp(timestamp):
+    '''Formats a Unix timestamp the way timestamps are stored in the JSON layout. None and text that parse_timestamp could not parse are returned as they are.'''
+    return str(datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)) if isinstance(timestamp, (int, float)) else timestamp
+
+class Lock:
+    '''A password lock for a channel. Locks are shared by the cache, so they are not changed after they have been created:
+    use replace to get a changed copy.'''
+    __slots__ = ("channel_id", "enabled", "password", "custom_message", "award_role_ids", "sent_information_message_id", "created_at", "authentication_duration", "extra")
+
+    def __init__(self, channel_id, password, award_role_ids, sent_information_message_id, custom_message=None, enabled=True,
+                 created_at=None, authentication_duration=None, extra=None):
+        self.channel_id = channel_id
+        self.enabled = enabled
+        self.password = password #The password hash
+        self.custom_message = custom_message
+        self.award_role_ids = tuple(award_role_ids)
+        self.sent_information_message_id = sent_information_message_id #The ID of the lock message sent by the bot
+        self.created_at = created_at #Unix timestamp, the stored text if it could not be parsed, or None
+        self.authentication_duration = authentication_duration #Seconds until the roles are taken back from a user that authenticated, or None
+        self.extra = extra #Keys of the JSON layout without their own attribute (like authenticated users stored by older versions of the bot), or None
+
+    @classmethod
+    def from_dict(cls, lock):
+        '''Creates a lock from the JSON layout.'''
+        extra = {key: value for key, value in lock.items() if key not in LOCK_KEYS}
+        return cls(
+            lock["channel_id"],
+            lock["password"],
+            lock["award_role_ids"],
+            lock["sent_information_message"]["id"],
+            custom_message=lock.get("custom_message"),
+            enabled=lock["enabled"],
+            created_at=parse_timestamp(lock.get("created_at")),
+            authentication_duration=lock.get("authentication_duration"),
+            extra=extra if len(extra) > 0 else None
+        )
+
+    def to_dict(self):
+        '''Returns the lock in the JSON layout.'''
+        lock = {
+            "enabled": self.enabled,
+            "channel_id": self.channel_id,
+            "password": self.password,
+            "custom_message": self.custom_message,
+            "award_role_ids": list(self.award_role_ids),
+            "sent_information_message": {
+                "id": self.sent_information_message_id
+            },
+            "created_at": format_timestamp(self.created_at),
+            "authentication_duration": self.authentication_duration
+        }
+        if self.extra is not None:
+            lock.update(self.extra)
+        return lock
+
+    def replace(self, **changes):
+        '''Returns a copy of the lock with some attributes changed.'''
+        attributes = {name: getattr(self, name) for name in self.__slots__}
+        attributes.update(changes)
+        return Lock(**attributes)
+
+    def __repr__(self):
+        return f"<Lock channel_id={self.channel_id} enabled={self.enabled} award_role_ids={self.award_role_ids}>"
+
+class GuildConfig:
+    '''The configuration of a guild: its locks, in the order they were added, and when the configuration was created.'''
+    __slots__ = ("locks", "created_at")
+
+    def __init__(self, locks=None, created_at=None):
+        self.locks = locks if locks is not None else []
+        self.created_at = created_at #Unix timestamp, the stored text if it could not be parsed, or None
+
+    @classmethod
+    def from_dict(cls, configuration):
+        '''Creates a guild configuration from the JSON layout.'''
+        return cls([Lock.from_dict(lock) for lock in configuration["enabled_locks"]], parse_timestamp(configuration.get("configuration_created_at")))
+
+    def to_dict(self):
+        '''Returns the guild configuration in the JSON layout.'''
+        return {
+            "enabled_locks": [lock.to_dict() for lock in self.locks],
+            "configuration_created_at": format_timestamp(self.created_at)
+        }
+
+    def __repr__(self):
+        return f"<GuildConfig locks={len(self.locks)}>"
@@ -0,0 +1,109 @@
+'''Profiling.py
+Opt-in profiling of live commands, for finding out where the time goes when commands get slow.
+
+Profiling is off until the bot owner turns it on with ?profile, or sends SIGUSR1 to the bot process.
+While it is on, a fraction of the invocations of the profiled commands run under cProfile, and their profiles are written
+in the pstats format to the profiles directory next to data/, which keeps the newest ones. Only one invocation is profiled
+at a time. Commands spend most of their time waiting for Discord, so a profile also shows what the rest of the event loop
+did in the meantime. The lag of the event loop is logged every few seconds as well.
+When profiling is off, the command hooks only check a flag.'''
+
+import os, time, random, signal, asyncio, cProfile, logging
+from storage import SCRIPT_DIRECTORY
+
+#Paths
+PROFILES_PATH = os.path.join(SCRIPT_DIRECTORY, "profiles")
+
+#Settings
+PROFILE_SAMPLE_RATE = float(os.environ.get("POLICEBOT_PROFILE_SAMPLE_RATE", 0.1)) #Fraction of the invocations to profile when profiling is turned on without one
+PROFILE_MAX_FILES = int(os.environ.get("POLICEBOT_PROFILE_MAX_FILES", 50)) #Number of profiles kept in the profiles directory
+PROFILED_COMMANDS = frozenset(("authenticate", "add_lock", "remove_lock"))
+LOOP_LAG_SAMPLE_INTERVAL = 0.1 #Seconds between event loop lag samples
+LOOP_LAG_LOG_INTERVAL = 10 #Seconds between event loop lag reports
+
+#Logging
+logger = logging.getLogger(__name__)
+
+class CommandProfiler:
+    '''Profiles a sample of command invocations while it is enabled, and reports the event loop lag.'''
+    def __init__(self, profiles_path=PROFILES_PATH, max_files=PROFILE_MAX_FILES):
+        self.profiles_path = profiles_path
+        self.max_files = max_files
+        self.enabled = False
+        self.sample_rate = 0
+        self.active = None #(context, profile) of the invocation that is being profiled
+        self.lag_task = None
+
+    def enable(self, sample_rate=PROFILE_SAMPLE_RATE):
+        '''Starts profiling a fraction of the invocations of the profiled commands, and reporting the event loop lag.'''
+        self.sample_rate = sample_rate
+        self.enabled = True
+        if self.lag_task is None:
+            self.lag_task = asyncio.ensure_future(self.report_loop_lag())
+        logger.info("Profiling %.0f%% of the invocations of %s. Profiles are written to %s.", sample_rate * 100, ", ".join(sorted(PROFILED_COMMANDS)), self.profiles_path)
+
+    def disable(self):
+        '''Stops profiling. An invocation that is being profiled is not written.'''
+        self.enabled = False
+        if self.active is not None:
+            self.active[1].disable()
+            self.active = None
+        if self.lag_task is not None:
+            self.lag_task.cancel()
+            self.lag_task = None
+        logger.info("Stopped profiling.")
+
+    def toggle(self):
+        '''Enables profiling with the default sample rate if it is off, or disables it if it is on. Used for SIGUSR1.'''
+        if self.enabled:
+            self.disable()
+        else:
+            self.enable()
+
+    def install_signal_handler(self, loop):
+        '''Makes SIGUSR1 toggle profiling, on systems that have it.'''
+        if hasattr(signal, "SIGUSR1"):
+            loop.add_signal_handler(signal.SIGUSR1, self.toggle)
+
+    def start(self, ctx):
+        '''Called before a command is invoked while profiling is enabled. Starts profiling a sample of the invocations.'''
+        if self.active is not None or ctx.command.name not in PROFILED_COMMANDS or random.random() >= self.sample_rate:
+            return
+        profile = cProfile.Profile()
+        self.active = (ctx, profile)
+        profile.enable()
+
+    async def stop(self, ctx):
+        '''Called after a command has been invoked while profiling is enabled. Writes the profile of the invocation if it was profiled.'''
+        if self.active is None or self.active[0] is not ctx:
+            return
+        profile = self.active[1]
+        profile.disable()
+        self.active = None
+        filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{ctx.command.name}-{ctx.message.id}.pstats"
+        await asyncio.get_event_loop().run_in_executor(None, self.write_profile, profile, filename)
+
+    def write_profile(self, profile, filename):
+        '''Writes a profile to the profiles directory, and deletes the oldest profiles if there are too many.'''
+        os.makedirs(self.profiles_path, exist_ok=True)
+        profile.dump_stats(os.path.join(self.profiles_path, filename))
+        logger.info("Wrote profile %s.", filename)
+        filenames = sorted(filename for filename in os.listdir(self.profiles_path) if filename.endswith(".pstats"))
+        for old_filename in filenames[:max(0, len(filenames) - self.max_files)]:
+            os.remove(os.path.join(self.profiles_path, old_filename))
+
+    async def report_loop_lag(self):
+        '''Measures how late the event loop wakes up from short sleeps, and logs the average and worst lag now and then.'''
+        loop = asyncio.get_event_loop()
+        lags = []
+        reported_at = loop.time()
+        while True:
+            slept_at = loop.time()
+            await asyncio.sleep(LOOP_LAG_SAMPLE_INTERVAL)
+            lags.append(loop.time() - slept_at - LOOP_LAG_SAMPLE_INTERVAL)
+            if loop.time() - reported_at >= LOOP_LAG_LOG_INTERVAL:
+                logger.info("Event loop lag over the last %s samples: %.1f ms on average, %.1f ms at most.", len(lags), sum(lags) / len(lags) * 1000, max(lags) * 1000)
+                lags = []
+                reported_at = loop.time()
+
+command_profiler = CommandProfiler()
@@ -0,0 +1,115 @@
+'''Ratelimit.py
+Load shedding for authentication attempts.
+
+The cooldown of ?authenticate is per user, so a raid with thousands of accounts still costs a message deletion, a DM,
+a waiting session and a password check for every account. Every attempt therefore takes a token from a bucket of its lock and
+a bucket of its guild, and holds one of its guild's pending slots until the password has been checked. Attempts that get
+no token or slot are rejected before any Discord API call or hashing, and the replies telling users about it are coalesced
+to one per channel at a time, so that one guild under attack can't starve the rest of the bot.'''
+
+import os, time, logging
+from metrics import registry, SHED_AUTHENTICATIONS
+
+#Settings (0 turns a limit off)
+LOCK_ATTEMPTS_PER_MINUTE = int(os.environ.get("POLICEBOT_LOCK_ATTEMPTS_PER_MINUTE", 60)) #Authentication attempts per lock and minute, which can all be used at once
+GUILD_ATTEMPTS_PER_MINUTE = int(os.environ.get("POLICEBOT_GUILD_ATTEMPTS_PER_MINUTE", 120)) #Authentication attempts per guild and minute, which can all be used at once
+GUILD_PENDING_LIMIT = int(os.environ.get("POLICEBOT_GUILD_PENDING_LIMIT", 50)) #Authentication attempts per guild that can be waiting for a password or a password check at once
+REJECTION_REPLY_INTERVAL = 10 #Seconds between replies about rejected attempts in the same channel
+
+#Rejection reasons
+LOCK_RATE = "lock_rate"
+GUILD_RATE = "guild_rate"
+GUILD_PENDING = "guild_pending"
+
+#Logging
+logger = logging.getLogger(__name__)
+
+class TokenBuckets:
+    '''A token bucket per key. Buckets hold up to a minute of tokens and refill continuously.'''
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60 #Tokens per second
+        self.buckets = {} #Key --> (tokens, monotonic time when they were counted). Keys without a bucket are full
+        self.next_prune_at = 0
+
+    def get_tokens(self, key, now):
+        '''Returns the tokens that a key has at a monotonic time.'''
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            return self.capacity
+        tokens, counted_at = bucket
+        return min(self.capacity, tokens + (now - counted_at) * self.rate)
+
+    def take(self, key, now):
+        '''Takes a token from a key. Check get_tokens first, since the bucket can go below zero.'''
+        if now >= self.next_prune_at: #Forget full buckets now and then, instead of on every attempt
+            self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket[0] + (now - bucket[1]) * self.rate < self.capacity}
+            self.next_prune_at = now + 60
+        self.buckets[key] = (self.get_tokens(key, now) - 1, now)
+
+class ReplyCoalescer:
+    '''Lets something be replied to once per interval and key, like once per channel.'''
+    def __init__(self, interval):
+        self.interval = interval
+        self.replied_at = {} #Key --> monotonic time of the last reply
+        self.next_prune_at = 0
+
+    def should_reply(self, key):
+        '''Returns True and starts the interval of a key if it can be replied to now, or False if it was replied to recently.'''
+        now = time.monotonic()
+        if now >= self.next_prune_at:
+            self.replied_at = {key: replied_at for key, replied_at in self.replied_at.items() if now - replied_at < self.interval}
+            self.next_prune_at = now + self.interval
+        if now - self.replied_at.get(key, -self.interval) < self.interval:
+            return False
+        self.replied_at[key] = now
+        return True
+
+class AuthenticationLimiter:
+    '''Limits the authentication attempts per lock and guild, and the attempts that are pending at once per guild.'''
+    def __init__(self, lock_attempts_per_minute=LOCK_ATTEMPTS_PER_MINUTE, guild_attempts_per_minute=GUILD_ATTEMPTS_PER_MINUTE,
+                 guild_pending_limit=GUILD_PENDING_LIMIT, rejection_reply_interval=REJECTION_REPLY_INTERVAL):
+        self.lock_buckets = TokenBuckets(lock_attempts_per_minute) if lock_attempts_per_minute > 0 else None
+        self.guild_buckets = TokenBuckets(guild_attempts_per_minute) if guild_attempts_per_minute > 0 else None
+        self.guild_pending_limit = guild_pending_limit
+        self.pending = {} #Guild ID --> attempts in progress
+        self.rejection_replies = ReplyCoalescer(rejection_reply_interval)
+
+    def try_start(self, guild_id, channel_id):
+        '''Starts an attempt to authenticate with the lock of a channel. Returns None if the attempt may go on,
+        in which case finish has to be called when it is done, or the reason that it was rejected.'''
+        guild_id = int(guild_id)
+        now = time.monotonic()
+        if self.guild_pending_limit > 0 and self.pending.get(guild_id, 0) >= self.guild_pending_limit:
+            reason = GUILD_PENDING
+        elif self.guild_buckets is not None and self.guild_buckets.get_tokens(guild_id, now) < 1:
+            reason = GUILD_RATE
+        elif self.lock_buckets is not None and self.lock_buckets.get_tokens(channel_id, now) < 1:
+            reason = LOCK_RATE
+        else:
+            if self.guild_buckets is not None:
+                self.guild_buckets.take(guild_id, now)
+            if self.lock_buckets is not None:
+                self.lock_buckets.take(channel_id, now)
+            self.pending[guild_id] = self.pending.get(guild_id, 0) + 1
+            return None
+        SHED_AUTHENTICATIONS.inc(reason=reason)
+        logger.debug("Rejected an authentication attempt in guild %s (%s).", guild_id, reason)
+        return reason
+
+    def finish(self, guild_id):
+        '''Ends an attempt that was started with try_start.'''
+        guild_id = int(guild_id)
+        pending = self.pending.get(guild_id, 0) - 1
+        if pending > 0:
+            self.pending[guild_id] = pending
+        else:
+            self.pending.pop(guild_id, None)
+
+    def should_reply(self, channel_id):
+        '''Returns whether a rejected attempt in a channel should be replied to, since the last reply there was a while ago.'''
+        return self.rejection_replies.should_reply(channel_id)
+
+authentication_limiter = AuthenticationLimiter()
+
+registry.gauge("policebot_pending_authentications", "Authentication attempts waiting for a password or a password check.", function=lambda: sum(authentication_limiter.pending.values()))
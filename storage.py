@@ -0,0 +1,539 @@
+'''Storage.py
+Storage backends for guild data. data.py keeps guild data cached in memory and uses one of these backends to persist it.
+
+Two backends are available, selected with the POLICEBOT_STORAGE_BACKEND environment variable:
+* "json" (the default) - one directory per guild in data/guilds, see JSONStorageBackend
+* "sqlite" - a single SQLite database in WAL mode, see SQLiteStorageBackend
+
+Changes are passed to the backends as change records (dicts with an "op" key and the data of the change).
+An existing data/guilds tree can be imported into a SQLite database with:
+python storage.py import-json [database path]'''
+
+import os, sys, json, logging, sqlite3, threading
+from array import array
+from metrics import STORAGE_SECONDS
+from models import GuildConfig
+
+#Paths
+SCRIPT_PATH = os.path.realpath(__file__)
+SCRIPT_DIRECTORY = os.path.dirname(SCRIPT_PATH)
+DATA_PATH = os.path.join(SCRIPT_DIRECTORY, "data/")
+GUILDS_PATH = os.path.join(DATA_PATH, "guilds/")
+SQLITE_DATABASE_PATH = os.environ.get("POLICEBOT_SQLITE_PATH", os.path.join(DATA_PATH, "policebot.sqlite3"))
+AUTHENTICATED_USERS_DIRECTORY_NAME = "authenticated_users"
+JOURNAL_FILENAME = "journal.log"
+
+#Settings
+STORAGE_BACKEND = os.environ.get("POLICEBOT_STORAGE_BACKEND", "json")
+JOURNAL_FSYNC = os.environ.get("POLICEBOT_JOURNAL_FSYNC", "1") != "0" #Whether to fsync every journal record
+SQLITE_BUSY_TIMEOUT = 30 #Seconds to wait for a write lock held by another process, like another cluster worker
+
+#Change record operations
+JOURNAL_ADD_LOCK = "add_lock"
+JOURNAL_UPDATE_LOCK = "update_lock"
+JOURNAL_REMOVE_LOCK = "remove_lock"
+JOURNAL_AUTHENTICATE = "authenticate"
+JOURNAL_SET_CONFIGURATION = "set_configuration"
+JOURNAL_CLEAR_AUTHENTICATED_USERS = "clear_authenticated_users"
+JOURNAL_DEAUTHENTICATE = "deauthenticate"
+
+#Logging
+logger = logging.getLogger(__name__)
+
+#File helpers
+def read_json_from_file(filepath):
+    '''Read JSON from a file and returns it as a dict'''
+    logger.debug("Reading JSON from filepath %s...", filepath)
+    with STORAGE_SECONDS.time(operation="read_json"):
+        with open(filepath, "r") as json_file:
+            return json.loads(json_file.read())
+
+def write_file_atomically(data, filepath, mode="w"):
+    '''Writes data to a file by writing a temporary file and renaming it over the original,
+    so that the file contains either the old or the new data even if the process crashes.'''
+    temporary_filepath = f"{filepath}.tmp"
+    with open(temporary_filepath, mode) as temporary_file:
+        temporary_file.write(data)
+        temporary_file.flush()
+        os.fsync(temporary_file.fileno())
+    os.replace(temporary_filepath, filepath)
+
+def write_json_to_file(data, filepath):
+    '''Updates JSON to a file.'''
+    logger.debug("Updating JSON from filepath %s...", filepath)
+    with STORAGE_SECONDS.time(operation="write_json"):
+        write_file_atomically(json.dumps(data), filepath)
+
+#Backends
+class StorageBackend:
+    '''The interface that storage backends implement.'''
+    #Whether changes are kept in a journal that has to be compacted with write_guild from time to time
+    uses_journal = False
+    #The data directory that the backend stores its data in, which other data of the bot (like role jobs) is kept next to
+    data_path = DATA_PATH
+
+    def load_guild(self, guild_id):
+        '''Returns a (configuration, change records) tuple for a guild.
+        The change records have not been applied to the configuration yet.
+        The configuration is None if the guild does not have one.'''
+        raise NotImplementedError
+
+    def load_authenticated_users(self, guild_id, channel_id):
+        '''Returns the set of authenticated user IDs for the lock in a channel.'''
+        raise NotImplementedError
+
+    def load_authentication_expirations(self, guild_id, channel_id):
+        '''Returns a dict mapping authenticated user IDs to when their authentication expires (a Unix timestamp),
+        for the users of the lock in a channel whose authentication expires.'''
+        raise NotImplementedError
+
+    def create_guild(self, guild_id, configuration):
+        '''Stores a new guild configuration.'''
+        raise NotImplementedError
+
+    def record_change(self, guild_id, record):
+        '''Stores a change record for a guild.'''
+        raise NotImplementedError
+
+    def write_guild(self, guild_id, configuration, authenticated_users, authentication_expirations=None):
+        '''Stores the complete configuration of a guild, replacing everything stored before.
+        authenticated_users maps channel IDs to sets of user IDs, and only the channels in it are written.
+        authentication_expirations maps the same channel IDs to dicts of user ID --> expiry timestamp (see load_authentication_expirations).'''
+        raise NotImplementedError
+
+    def delete_authenticated_users(self, guild_id, channel_id):
+        '''Deletes the authenticated users of the lock in a channel.'''
+        raise NotImplementedError
+
+    def get_guild_ids(self):
+        '''Returns the IDs of all guilds that have stored data.'''
+        raise NotImplementedError
+
+    def get_guild_ids_with_expirations(self):
+        '''Returns the IDs of the guilds that might have authentications that expire.'''
+        raise NotImplementedError
+
+    def close(self):
+        '''Releases the resources held by the backend.'''
+        pass
+
+class JSONStorageBackend(StorageBackend):
+    '''Stores every guild in its own directory in data/guilds, containing:
+    * config.json - a snapshot of the guild configuration
+    * authenticated_users/<channel ID>.bin - snapshots of the authenticated users for every lock,
+      as sequences of unsigned 64-bit little-endian user IDs
+    * authenticated_users/<channel ID>.expirations.bin - snapshots of when authentications expire, for locks where they do,
+      as pairs of unsigned 64-bit little-endian user IDs and Unix timestamps
+    * journal.log - change records written since the snapshots were written, one JSON record per line
+    Changes are appended to the journal, and write_guild compacts the journal into new snapshots.'''
+    uses_journal = True
+
+    def __init__(self, guilds_path=GUILDS_PATH):
+        self.guilds_path = guilds_path
+        self.data_path = os.path.dirname(os.path.normpath(guilds_path))
+
+    def get_guild_paths(self, guild_id):
+        '''Returns the guild directory and configuration filepath for a guild.'''
+        guild_path = os.path.join(self.guilds_path, str(guild_id))
+        guild_configuration_path = os.path.join(guild_path, "config.json")
+        return guild_path, guild_configuration_path
+
+    def get_journal_path(self, guild_id):
+        '''Returns the filepath of the journal for a guild.'''
+        return os.path.join(self.guilds_path, str(guild_id), JOURNAL_FILENAME)
+
+    def get_authenticated_users_path(self, guild_id, channel_id):
+        '''Returns the filepath of the authenticated users snapshot for a lock.'''
+        return os.path.join(self.guilds_path, str(guild_id), AUTHENTICATED_USERS_DIRECTORY_NAME, f"{channel_id}.bin")
+
+    def get_authentication_expirations_path(self, guild_id, channel_id):
+        '''Returns the filepath of the authentication expirations snapshot for a lock.'''
+        return os.path.join(self.guilds_path, str(guild_id), AUTHENTICATED_USERS_DIRECTORY_NAME, f"{channel_id}.expirations.bin")
+
+    def load_guild(self, guild_id):
+        logger.debug("Loading configuration for %s...", guild_id)
+        guild_path, guild_configuration_path = self.get_guild_paths(guild_id)
+        if not os.path.exists(guild_configuration_path):
+            logger.debug("Guild configuration does not exist.")
+            return None, []
+        return read_json_from_file(guild_configuration_path), self.read_journal_records(guild_id)
+
+    def read_journal_records(self, guild_id):
+        '''Reads the journal records of a guild.
+        A record that was only partially written (for example because of a crash) is ignored,
+        and cut off the end of the journal so that the next record doesn't get appended to its line.'''
+        journal_path = self.get_journal_path(guild_id)
+        if not os.path.exists(journal_path):
+            return []
+        with open(journal_path, "rb+") as journal_file:
+            data = journal_file.read()
+            complete_length = data.rfind(b"\n") + 1
+            if complete_length < len(data):
+                logger.warning("Removing an incomplete journal record from the end of the journal of guild %s.", guild_id)
+                journal_file.truncate(complete_length)
+        records = []
+        for line in data[:complete_length].decode("utf-8", "replace").splitlines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logger.warning("Ignoring an incomplete journal record for guild %s.", guild_id)
+        return records
+
+    def load_authenticated_users(self, guild_id, channel_id):
+        authenticated_users_path = self.get_authenticated_users_path(guild_id, channel_id)
+        user_ids = array("Q")
+        if os.path.exists(authenticated_users_path):
+            logger.debug("Reading authenticated users from %s...", authenticated_users_path)
+            with STORAGE_SECONDS.time(operation="read_authenticated_users"), open(authenticated_users_path, "rb") as authenticated_users_file:
+                data = authenticated_users_file.read()
+            data = data[:len(data) - len(data) % user_ids.itemsize] #Ignore a partially written ID at the end
+            user_ids.frombytes(data)
+            if sys.byteorder != "little":
+                user_ids.byteswap()
+        return set(user_ids)
+
+    def load_authentication_expirations(self, guild_id, channel_id):
+        authentication_expirations_path = self.get_authentication_expirations_path(guild_id, channel_id)
+        values = array("Q")
+        if os.path.exists(authentication_expirations_path):
+            with STORAGE_SECONDS.time(operation="read_authentication_expirations"), open(authentication_expirations_path, "rb") as authentication_expirations_file:
+                data = authentication_expirations_file.read()
+            data = data[:len(data) - len(data) % (2 * values.itemsize)] #Ignore a partially written pair at the end
+            values.frombytes(data)
+            if sys.byteorder != "little":
+                values.byteswap()
+        return dict(zip(values[0::2], values[1::2]))
+
+    def create_guild(self, guild_id, configuration):
+        guild_path, guild_configuration_path = self.get_guild_paths(guild_id)
+        if not os.path.exists(guild_path): #If the guild directory does not exist
+            logger.info("Guild directory does not exist. Creating...")
+            os.makedirs(guild_path)
+        write_json_to_file(configuration, guild_configuration_path)
+
+    def record_change(self, guild_id, record):
+        with STORAGE_SECONDS.time(operation="journal_append"), open(self.get_journal_path(guild_id), "a") as journal_file:
+            journal_file.write(json.dumps(record) + "\n")
+            if JOURNAL_FSYNC:
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+
+    def write_guild(self, guild_id, configuration, authenticated_users, authentication_expirations=None):
+        for channel_id, user_ids in authenticated_users.items():
+            self.write_authenticated_users(guild_id, channel_id, user_ids)
+            self.write_authentication_expirations(guild_id, channel_id, (authentication_expirations or {}).get(channel_id, {}))
+        guild_path, guild_configuration_path = self.get_guild_paths(guild_id)
+        write_json_to_file(configuration, guild_configuration_path)
+        #The snapshots now contain everything in the journal, so it can be emptied
+        journal_path = self.get_journal_path(guild_id)
+        if os.path.exists(journal_path):
+            write_file_atomically("", journal_path)
+
+    def write_authenticated_users(self, guild_id, channel_id, user_ids):
+        '''Writes the authenticated users snapshot for a lock.'''
+        authenticated_users_path = self.get_authenticated_users_path(guild_id, channel_id)
+        os.makedirs(os.path.dirname(authenticated_users_path), exist_ok=True)
+        user_ids = array("Q", sorted(user_ids))
+        if sys.byteorder != "little":
+            user_ids.byteswap()
+        with STORAGE_SECONDS.time(operation="write_authenticated_users"):
+            write_file_atomically(user_ids.tobytes(), authenticated_users_path, mode="wb")
+
+    def write_authentication_expirations(self, guild_id, channel_id, expirations):
+        '''Writes the authentication expirations snapshot for a lock, or deletes it if no authentications expire.'''
+        authentication_expirations_path = self.get_authentication_expirations_path(guild_id, channel_id)
+        if len(expirations) == 0:
+            if os.path.exists(authentication_expirations_path):
+                os.remove(authentication_expirations_path)
+            return
+        values = array("Q")
+        for user_id, expires_at in sorted(expirations.items()):
+            values.append(user_id)
+            values.append(expires_at)
+        if sys.byteorder != "little":
+            values.byteswap()
+        with STORAGE_SECONDS.time(operation="write_authentication_expirations"):
+            write_file_atomically(values.tobytes(), authentication_expirations_path, mode="wb")
+
+    def delete_authenticated_users(self, guild_id, channel_id):
+        for path in (self.get_authenticated_users_path(guild_id, channel_id), self.get_authentication_expirations_path(guild_id, channel_id)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def get_guild_ids(self):
+        return [guild_id for guild_id in os.listdir(self.guilds_path) if os.path.isdir(os.path.join(self.guilds_path, guild_id))]
+
+    def get_guild_ids_with_expirations(self):
+        #Guilds with an expirations snapshot, and guilds with a journal that might hold authentications that have not been compacted
+        guild_ids = []
+        for guild_id in self.get_guild_ids():
+            authenticated_users_path = os.path.join(self.guilds_path, guild_id, AUTHENTICATED_USERS_DIRECTORY_NAME)
+            journal_path = self.get_journal_path(guild_id)
+            if (os.path.exists(journal_path) and os.path.getsize(journal_path) > 0) or \
+                    (os.path.isdir(authenticated_users_path) and any(filename.endswith(".expirations.bin") for filename in os.listdir(authenticated_users_path))):
+                guild_ids.append(guild_id)
+        return guild_ids
+
+class SQLiteStorageBackend(StorageBackend):
+    '''Stores all guilds in one SQLite database in WAL mode, with the tables:
+    * guilds - one row per guild configuration
+    * locks - one row per lock, with a unique index on (guild_id, channel_id)
+    * authenticated_users - one row per (lock, user), with (lock_id, user_id) as primary key, and when the authentication expires
+    Lock keys that do not have their own column are stored as JSON in locks.extra.'''
+    #Lock keys stored in their own columns (the sent information message ID is stored in sent_information_message_id)
+    LOCK_COLUMNS = ("enabled", "password", "custom_message", "award_role_ids", "created_at")
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS guilds (
+        guild_id INTEGER PRIMARY KEY,
+        configuration_created_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS locks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        guild_id INTEGER NOT NULL REFERENCES guilds(guild_id) ON DELETE CASCADE,
+        channel_id INTEGER NOT NULL,
+        enabled INTEGER NOT NULL,
+        password TEXT NOT NULL,
+        custom_message TEXT,
+        award_role_ids TEXT NOT NULL,
+        sent_information_message_id INTEGER,
+        created_at TEXT,
+        extra TEXT
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS locks_guild_id_channel_id ON locks(guild_id, channel_id);
+    CREATE TABLE IF NOT EXISTS authenticated_users (
+        lock_id INTEGER NOT NULL REFERENCES locks(id) ON DELETE CASCADE,
+        user_id INTEGER NOT NULL,
+        expires_at INTEGER,
+        PRIMARY KEY (lock_id, user_id)
+    ) WITHOUT ROWID;
+    '''
+
+    def __init__(self, database_path=SQLITE_DATABASE_PATH):
+        self.database_path = database_path
+        self.data_path = os.path.dirname(os.path.abspath(database_path))
+        #The connection is shared between the event loop and background threads, so access to it is serialized
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(database_path, timeout=SQLITE_BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA foreign_keys=ON")
+        self.connection.executescript(self.SCHEMA)
+        if "expires_at" not in [row[1] for row in self.connection.execute("PRAGMA table_info(authenticated_users)")]: #Databases created before expiring authentications
+            self.connection.execute("ALTER TABLE authenticated_users ADD COLUMN expires_at INTEGER")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS authenticated_users_expires_at ON authenticated_users(expires_at) WHERE expires_at IS NOT NULL")
+
+    def lock_from_row(self, row):
+        '''Converts a row from the locks table to a lock dict.'''
+        channel_id, enabled, password, custom_message, award_role_ids, sent_information_message_id, created_at, extra = row
+        lock = {
+            "enabled": bool(enabled),
+            "channel_id": channel_id,
+            "password": password,
+            "custom_message": custom_message,
+            "award_role_ids": json.loads(award_role_ids),
+            "sent_information_message": {
+                "id": sent_information_message_id
+            },
+            "created_at": created_at
+        }
+        if extra is not None:
+            lock.update(json.loads(extra))
+        return lock
+
+    def lock_to_parameters(self, guild_id, lock):
+        '''Converts a lock dict to the parameters of an upsert into the locks table.'''
+        extra = {key: value for key, value in lock.items() if key not in self.LOCK_COLUMNS and key not in ("channel_id", "sent_information_message", "authenticated_users")}
+        return (
+            int(guild_id),
+            lock["channel_id"],
+            int(lock["enabled"]),
+            lock["password"],
+            lock.get("custom_message"),
+            json.dumps(lock["award_role_ids"]),
+            lock["sent_information_message"]["id"],
+            lock.get("created_at"),
+            json.dumps(extra) if len(extra) > 0 else None
+        )
+
+    def load_guild(self, guild_id):
+        with self.lock, STORAGE_SECONDS.time(operation="sqlite_load_guild"):
+            guild_row = self.connection.execute("SELECT configuration_created_at FROM guilds WHERE guild_id = ?", (int(guild_id),)).fetchone()
+            if guild_row is None:
+                return None, []
+            lock_rows = self.connection.execute(
+                "SELECT channel_id, enabled, password, custom_message, award_role_ids, sent_information_message_id, created_at, extra FROM locks WHERE guild_id = ? ORDER BY id",
+                (int(guild_id),)
+            ).fetchall()
+        configuration = {
+            "enabled_locks": [self.lock_from_row(lock_row) for lock_row in lock_rows],
+            "configuration_created_at": guild_row[0]
+        }
+        return configuration, []
+
+    def load_authenticated_users(self, guild_id, channel_id):
+        with self.lock, STORAGE_SECONDS.time(operation="sqlite_load_authenticated_users"):
+            rows = self.connection.execute(
+                "SELECT user_id FROM authenticated_users WHERE lock_id = (SELECT id FROM locks WHERE guild_id = ? AND channel_id = ?)",
+                (int(guild_id), channel_id)
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def load_authentication_expirations(self, guild_id, channel_id):
+        with self.lock, STORAGE_SECONDS.time(operation="sqlite_load_authentication_expirations"):
+            rows = self.connection.execute(
+                "SELECT user_id, expires_at FROM authenticated_users WHERE lock_id = (SELECT id FROM locks WHERE guild_id = ? AND channel_id = ?) AND expires_at IS NOT NULL",
+                (int(guild_id), channel_id)
+            ).fetchall()
+        return dict(rows)
+
+    def create_guild(self, guild_id, configuration):
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.upsert_guild(guild_id, configuration)
+                self.connection.execute("COMMIT")
+            except:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def upsert_guild(self, guild_id, configuration):
+        '''Replaces the guild row and the locks of a guild. Must be called in a transaction.'''
+        self.connection.execute(
+            "INSERT INTO guilds (guild_id, configuration_created_at) VALUES (?, ?) ON CONFLICT(guild_id) DO UPDATE SET configuration_created_at = excluded.configuration_created_at",
+            (int(guild_id), configuration["configuration_created_at"])
+        )
+        channel_ids = [lock["channel_id"] for lock in configuration["enabled_locks"]]
+        self.connection.execute(
+            f"DELETE FROM locks WHERE guild_id = ? AND channel_id NOT IN ({','.join('?' * len(channel_ids))})",
+            (int(guild_id), *channel_ids)
+        )
+        for lock in configuration["enabled_locks"]:
+            self.upsert_lock(guild_id, lock)
+
+    def upsert_lock(self, guild_id, lock):
+        '''Inserts or replaces a lock. The lock keeps its authenticated users if it is replaced.'''
+        self.connection.execute(
+            '''INSERT INTO locks (guild_id, channel_id, enabled, password, custom_message, award_role_ids, sent_information_message_id, created_at, extra)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(guild_id, channel_id) DO UPDATE SET enabled = excluded.enabled, password = excluded.password,
+            custom_message = excluded.custom_message, award_role_ids = excluded.award_role_ids,
+            sent_information_message_id = excluded.sent_information_message_id, created_at = excluded.created_at, extra = excluded.extra''',
+            self.lock_to_parameters(guild_id, lock)
+        )
+
+    def record_change(self, guild_id, record):
+        operation = record["op"]
+        with self.lock, STORAGE_SECONDS.time(operation="sqlite_record_change"):
+            self.connection.execute("BEGIN")
+            try:
+                if operation in (JOURNAL_ADD_LOCK, JOURNAL_UPDATE_LOCK):
+                    self.upsert_lock(guild_id, record["lock"])
+                elif operation == JOURNAL_REMOVE_LOCK:
+                    self.connection.execute("DELETE FROM locks WHERE guild_id = ? AND channel_id = ?", (int(guild_id), record["channel_id"]))
+                elif operation == JOURNAL_AUTHENTICATE:
+                    self.connection.execute(
+                        "INSERT OR IGNORE INTO authenticated_users (lock_id, user_id, expires_at) SELECT id, ?, ? FROM locks WHERE guild_id = ? AND channel_id = ?",
+                        (record["user_id"], record.get("expires_at"), int(guild_id), record["channel_id"])
+                    )
+                elif operation == JOURNAL_DEAUTHENTICATE:
+                    self.connection.executemany(
+                        "DELETE FROM authenticated_users WHERE lock_id = (SELECT id FROM locks WHERE guild_id = ? AND channel_id = ?) AND user_id = ?",
+                        ((int(guild_id), record["channel_id"], user_id) for user_id in record["user_ids"])
+                    )
+                elif operation == JOURNAL_SET_CONFIGURATION:
+                    self.upsert_guild(guild_id, record["configuration"])
+                elif operation == JOURNAL_CLEAR_AUTHENTICATED_USERS:
+                    self.connection.execute(
+                        "DELETE FROM authenticated_users WHERE lock_id IN (SELECT id FROM locks WHERE guild_id = ? AND channel_id = ?)",
+                        (int(guild_id), record["channel_id"])
+                    )
+                else:
+                    logger.warning("Unknown change record operation %s for guild %s! Ignoring...", operation, guild_id)
+                self.connection.execute("COMMIT")
+            except:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def write_guild(self, guild_id, configuration, authenticated_users, authentication_expirations=None):
+        with self.lock, STORAGE_SECONDS.time(operation="sqlite_write_guild"):
+            self.connection.execute("BEGIN")
+            try:
+                self.upsert_guild(guild_id, configuration)
+                for channel_id, user_ids in authenticated_users.items():
+                    lock_id = self.connection.execute("SELECT id FROM locks WHERE guild_id = ? AND channel_id = ?", (int(guild_id), channel_id)).fetchone()[0]
+                    expirations = (authentication_expirations or {}).get(channel_id, {})
+                    self.connection.execute("DELETE FROM authenticated_users WHERE lock_id = ?", (lock_id,))
+                    self.connection.executemany(
+                        "INSERT INTO authenticated_users (lock_id, user_id, expires_at) VALUES (?, ?, ?)",
+                        ((lock_id, user_id, expirations.get(user_id)) for user_id in user_ids)
+                    )
+                self.connection.execute("COMMIT")
+            except:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def delete_authenticated_users(self, guild_id, channel_id):
+        pass #Authenticated users are deleted together with their lock
+
+    def get_guild_ids(self):
+        with self.lock:
+            return [str(row[0]) for row in self.connection.execute("SELECT guild_id FROM guilds")]
+
+    def get_guild_ids_with_expirations(self):
+        with self.lock:
+            return [str(row[0]) for row in self.connection.execute(
+                "SELECT DISTINCT locks.guild_id FROM authenticated_users JOIN locks ON locks.id = authenticated_users.lock_id WHERE authenticated_users.expires_at IS NOT NULL"
+            )]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+STORAGE_BACKENDS = {
+    "json": JSONStorageBackend,
+    "sqlite": SQLiteStorageBackend
+}
+
+def create_storage_backend(name=STORAGE_BACKEND):
+    '''Function for creating the storage backend with a certain name.'''
+    if name not in STORAGE_BACKENDS:
+        raise ValueError(f"Unknown storage backend {name}! Available backends: {', '.join(STORAGE_BACKENDS)}")
+    logger.info("Using the %s storage backend.", name)
+    return STORAGE_BACKENDS[name]()
+
+def import_json_guilds(json_backend, destination_backend):
+    '''Function for copying every guild stored by a JSON backend to another backend.
+    Journals are replayed, so the copied data includes changes that have not been compacted yet.
+    Returns the number of imported guilds.'''
+    from data import GuildLockIndex #Imported here since data.py imports this module
+    imported_guilds = 0
+    for guild_id in json_backend.get_guild_ids():
+        configuration, records = json_backend.load_guild(guild_id)
+        if configuration is None:
+            logger.warning("Guild %s does not have a configuration! Skipping...", guild_id)
+            continue
+        guild_index = GuildLockIndex(guild_id, GuildConfig.from_dict(configuration), storage_backend=json_backend)
+        for record in records:
+            guild_index.apply_journal_record(record)
+        #Authenticated users stored in the configuration by older versions of the bot
+        for lock in guild_index.configuration.locks:
+            for user_id in (lock.extra or {}).pop("authenticated_users", []):
+                guild_index.add_authenticated_user(lock.channel_id, user_id)
+        authenticated_users = {channel_id: guild_index.get_authenticated_users(channel_id) for channel_id in guild_index.channel_ids}
+        authentication_expirations = {channel_id: guild_index.get_authentication_expirations(channel_id) for channel_id in guild_index.channel_ids}
+        destination_backend.write_guild(guild_id, guild_index.configuration.to_dict(), authenticated_users, authentication_expirations)
+        imported_guilds += 1
+        logger.info("Imported guild %s.", guild_id)
+    return imported_guilds
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 2 or sys.argv[1] != "import-json":
+        print("Usage: python storage.py import-json [database path]")
+        sys.exit(1)
+    database_path = sys.argv[2] if len(sys.argv) > 2 else SQLITE_DATABASE_PATH
+    print(f"Importing {GUILDS_PATH} into {database_path}...")
+    sqlite_backend = SQLiteStorageBackend(database_path)
+    imported_guilds = import_json_guilds(JSONStorageBackend(), sqlite_backend)
+    sqlite_backend.close()
+    print(f"Imported {imported_guilds} guilds. Set POLICEBOT_STORAGE_BACKEND=sqlite to use the database.")
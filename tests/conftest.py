@@ -0,0 +1,4 @@
+import os, sys
+
+#The modules of the bot live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
@@ -0,0 +1,57 @@
+import re, time, types
+import pytest
+from capture import TrafficCapture
+from dispatcher import reply_dispatcher, ReplySession, DM, GUILD
+
+DURATION_PATTERN = re.compile(r"^\s*(\d+)\s*(m|min|mins|minutes?|h|hours?|d|days?|w|weeks?)\s*$", re.IGNORECASE) #Like main.DURATION_PATTERN
+USER_ID, GUILD_ID, CHANNEL_ID = 100, 200, 300
+
+@pytest.fixture
+def capture():
+    '''A traffic capture of a bot with the ?al and ?a commands, that keeps its events in memory.'''
+    capture = TrafficCapture()
+    capture.bot = types.SimpleNamespace(command_prefix="?", all_commands={"al": None, "a": None}, get_guild=lambda guild_id: None)
+    capture.key = b"key"
+    capture.duration_pattern = DURATION_PATTERN
+    capture.started_at = time.monotonic()
+    yield capture
+    reply_dispatcher.sessions.clear()
+
+def open_session(kind, code, channel_id=None):
+    session = ReplySession(reply_dispatcher, USER_ID, kind, channel_id, 60, code, "Session", None)
+    reply_dispatcher.sessions.setdefault((USER_ID, kind), []).append(session)
+    return session
+
+def get_content(capture, content, guild_id=None):
+    payload = {"id": 1, "author": {"id": USER_ID}, "channel_id": CHANNEL_ID, "content": content}
+    if guild_id is not None:
+        payload["guild_id"] = guild_id
+    return capture.get_message_event(payload)["content"]
+
+@pytest.mark.parametrize("password", ["forever", "nomessagepls", "24h", "30 days", "#2 12h", "?al"])
+def test_dm_password_is_hashed(capture, password):
+    open_session(DM, 1)
+    assert get_content(capture, password) == capture.hash_text(password)
+
+def test_session_code_is_kept(capture):
+    open_session(DM, 1)
+    open_session(DM, 2)
+    assert get_content(capture, "#2 24h") == "#2 " + capture.hash_text("24h")
+
+def test_session_code_is_kept_for_last_remaining_session(capture):
+    open_session(DM, 2)
+    assert get_content(capture, "#2 pw") == "#2 " + capture.hash_text("pw")
+
+@pytest.mark.parametrize("password", ["forever", "nomessagepls", "24h", "?help me"])
+def test_add_lock_password_is_hashed(capture, password):
+    open_session(GUILD, 1, CHANNEL_ID)
+    assert get_content(capture, password, GUILD_ID) == capture.hash_text(password)
+
+def test_add_lock_answers_are_kept_at_their_steps(capture):
+    open_session(GUILD, 1, CHANNEL_ID)
+    replies = ["forever", "<@&5> 24h", "<#300>", "nomessagepls", "forever"]
+    contents = [get_content(capture, reply, GUILD_ID) for reply in replies]
+    assert contents == [capture.hash_text("forever"), f"<@&{capture.get_pseudonym(5)}> " + capture.hash_text("24h"), f"<#{capture.get_pseudonym(CHANNEL_ID)}>", "nomessagepls", "forever"]
+
+def test_command_arguments_are_hashed(capture):
+    assert get_content(capture, "?al forever", GUILD_ID) == "?al " + capture.hash_text("forever")
@@ -0,0 +1,15 @@
+import cluster
+
+def test_every_guild_is_served_by_one_worker():
+    shard_count = 10
+    worker_shard_ids = cluster.split_shards(shard_count, 4)
+    assert sorted(shard_id for shard_ids in worker_shard_ids for shard_id in shard_ids) == list(range(shard_count))
+    for guild_id in (0, 1 << 22, 863082773379416115, 81384788765712384):
+        shard_id = cluster.get_guild_shard_id(guild_id, shard_count)
+        assert sum(shard_id in shard_ids for shard_ids in worker_shard_ids) == 1
+
+def test_only_workers_with_shard_zero_receive_direct_messages():
+    worker_shard_ids = cluster.split_shards(10, 4)
+    assert [cluster.receives_direct_messages({"shard_count": 10, "shard_ids": shard_ids}) for shard_ids in worker_shard_ids] == [True, False, False, False]
+    assert cluster.receives_direct_messages(None)
+    assert cluster.receives_direct_messages({"shard_count": None, "shard_ids": None})
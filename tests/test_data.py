@@ -0,0 +1,75 @@
+import types
+import pytest
+import data, storage, models
+
+@pytest.fixture
+def backend(tmp_path):
+    '''A JSON storage backend in a temporary directory, with a guild configuration cache that only fits one guild.'''
+    backend = storage.JSONStorageBackend(str(tmp_path / "guilds"))
+    data.set_storage_backend(backend)
+    max_size = data.guild_configuration_cache.max_size
+    data.guild_configuration_cache.max_size = 1
+    yield backend
+    data.guild_configuration_cache.max_size = max_size
+    data.guild_configuration_cache.clear()
+
+def restart():
+    '''Forgets the cached guilds without compacting their journals, like a restart after a crash.'''
+    data.guild_configuration_cache.entries.clear()
+    data.guild_configuration_cache.journal_lengths.clear()
+    data.tracked_channels.clear()
+
+def test_evicted_guild_journal_is_compacted(backend, tmp_path):
+    data.create_guild_configuration("1")
+    data.add_guild_lock("1", data.generate_lock_data(10, "hash", "Locked", [5], types.SimpleNamespace(id=11)))
+    data.add_authenticated_user("1", 10, 100)
+    assert "1" in data.guild_configuration_cache.journal_lengths
+    data.create_guild_configuration("2") #Evicts guild 1
+    assert "1" not in data.guild_configuration_cache.entries
+    data.guild_configuration_cache.flush(force=True)
+    assert data.guild_configuration_cache.journal_lengths == {}
+    assert "1" not in data.guild_configuration_cache.entries
+    configuration, change_records = backend.load_guild("1")
+    assert change_records == []
+    assert [lock["channel_id"] for lock in configuration["enabled_locks"]] == [10]
+    assert backend.load_authenticated_users("1", 10) == {100}
+    assert data.is_user_authenticated("1", 10, 100)
+    assert data.write_guild_snapshot(str(tmp_path / "guild_snapshot.bin"))
+
+def test_authenticated_users_in_configuration_are_migrated(backend, monkeypatch):
+    lock = data.generate_lock_data(10, "hash", "Locked", [5], types.SimpleNamespace(id=11)).to_dict()
+    lock["authenticated_users"] = [100, 101]
+    lock["color"] = "red"
+    backend.create_guild("1", {"enabled_locks": [lock], "configuration_created_at": "2021-07-10 12:00:00"})
+    loaded_locks = []
+    from_dict = models.Lock.from_dict
+    monkeypatch.setattr(models.Lock, "from_dict", classmethod(lambda cls, lock: loaded_locks.append(from_dict(lock)) or loaded_locks[-1]))
+    guild_index = data.get_guild_lock_index("1")
+    assert loaded_locks[0].extra == {"authenticated_users": [100, 101], "color": "red"} #Locks are shared, so the loaded lock is replaced instead of changed
+    assert guild_index.get_lock(10).extra == {"color": "red"}
+    assert data.is_user_authenticated("1", 10, 101)
+    configuration, change_records = backend.load_guild("1")
+    assert "authenticated_users" not in configuration["enabled_locks"][0] and configuration["enabled_locks"][0]["color"] == "red"
+    assert configuration["configuration_created_at"] == "2021-07-10 12:00:00+00:00"
+    assert backend.load_authenticated_users("1", 10) == {100, 101}
+
+def test_change_after_torn_journal_record_survives_reload(backend):
+    data.create_guild_configuration("1")
+    data.add_guild_lock("1", data.generate_lock_data(10, "hash", "Locked", [5], types.SimpleNamespace(id=11)))
+    data.add_authenticated_user("1", 10, 100)
+    with open(backend.get_journal_path("1"), "a") as journal_file:
+        journal_file.write('{"type": "add_authenticated_us') #A record cut off by a crash
+    restart()
+    data.add_authenticated_user("1", 10, 101)
+    restart()
+    assert data.is_user_authenticated("1", 10, 100)
+    assert data.is_user_authenticated("1", 10, 101)
+
+def test_guild_loaded_while_waiting_for_lock_is_not_loaded_again(backend, monkeypatch):
+    data.create_guild_configuration("1")
+    guild_index = data.get_guild_lock_index("1")
+    cache_get = data.guild_configuration_cache.get
+    misses = [(False, None)] #The first lookup misses, like it would have before another thread loaded the guild
+    monkeypatch.setattr(data.guild_configuration_cache, "get", lambda guild_id: misses.pop() if misses else cache_get(guild_id))
+    monkeypatch.setattr(backend, "load_guild", lambda guild_id: pytest.fail("The guild was loaded again"))
+    assert data.get_guild_lock_index("1") is guild_index
@@ -0,0 +1,24 @@
+import asyncio, types
+from dispatcher import ReplyDispatcher, DM
+
+USER_ID = 100
+
+def send_direct_message(dispatcher, message_id, content):
+    message = types.SimpleNamespace(id=message_id, guild=None, author=types.SimpleNamespace(id=USER_ID), channel=types.SimpleNamespace(id=1), content=content)
+    asyncio.run(dispatcher.on_message(message))
+
+def test_session_code_is_stripped_for_last_remaining_session():
+    dispatcher = ReplyDispatcher()
+    first_session = dispatcher.open_session(USER_ID, DM, 60, label="First")
+    second_session = dispatcher.open_session(USER_ID, DM, 60, label="Second")
+    send_direct_message(dispatcher, 1, "#1 pwA")
+    assert first_session.early_reply.content == "pwA"
+    dispatcher.close_session(first_session)
+    send_direct_message(dispatcher, 2, "#2 pwB")
+    assert second_session.early_reply.content == "pwB"
+
+def test_single_session_keeps_content_without_its_code():
+    dispatcher = ReplyDispatcher()
+    session = dispatcher.open_session(USER_ID, DM, 60)
+    send_direct_message(dispatcher, 1, "#2 pw")
+    assert session.early_reply.content == "#2 pw"
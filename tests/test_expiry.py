@@ -0,0 +1,23 @@
+import time, asyncio
+import expiry
+
+def test_failed_batch_is_handed_over_again(monkeypatch):
+    monkeypatch.setattr(expiry, "EXPIRY_RETRY_DELAY", 0.05)
+    calls = []
+    async def expiry_handler(guild_id, channel_id, expirations):
+        calls.append((guild_id, channel_id, expirations))
+        if len(calls) == 1:
+            raise RuntimeError("The first attempt fails")
+    async def run():
+        scheduler = expiry.ExpiryScheduler()
+        scheduler.attach(expiry_handler)
+        scheduler.wakeup = asyncio.Event()
+        expires_at = int(time.time()) - 1
+        scheduler.schedule("1", 10, 100, expires_at)
+        task = asyncio.ensure_future(scheduler.run())
+        await asyncio.sleep(0.3)
+        task.cancel()
+        return expires_at, scheduler.heap
+    expires_at, heap = asyncio.run(run())
+    assert calls == [(1, 10, [(100, expires_at)])] * 2
+    assert heap == []
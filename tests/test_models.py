@@ -0,0 +1,15 @@
+from models import Lock, parse_timestamp, format_timestamp
+
+def make_lock(created_at):
+    return {"enabled": True, "channel_id": 10, "password": "hash", "custom_message": None, "award_role_ids": [5], "sent_information_message": {"id": 11}, "created_at": created_at}
+
+def test_timestamp_with_timezone_round_trips():
+    assert Lock.from_dict(make_lock("2021-07-10 12:00:00.123456+00:00")).to_dict()["created_at"] == "2021-07-10 12:00:00.123456+00:00"
+
+def test_timestamp_without_timezone_is_utc():
+    assert parse_timestamp("2021-07-10 12:00:00") == parse_timestamp("2021-07-10 12:00:00+00:00")
+    assert format_timestamp(parse_timestamp("2021-07-10 12:00:00")) == "2021-07-10 12:00:00+00:00"
+
+def test_unparseable_timestamp_is_kept():
+    assert Lock.from_dict(make_lock("last tuesday")).to_dict()["created_at"] == "last tuesday"
+    assert Lock.from_dict(make_lock(None)).to_dict()["created_at"] is None